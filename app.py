@@ -1,9 +1,16 @@
-import dash, yaml
+import dash, datetime, flask, functools, json, mimetypes, os, yaml
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 import dash_html_components as html
-from dash.dependencies import Input, Output
-from scripts.plots import GeneratePlots
+from dash.dependencies import ClientsideFunction, Input, Output
+from dash.exceptions import PreventUpdate
+from werkzeug.utils import safe_join
+from scripts.plot_settings import pie_variables, period_labels
+from scripts.figure_cache import FigureCache
+from scripts.hub_registry import HubRegistry, IdleSweeper, SnapshotWatcher
+from scripts.instrumentation import Histogram, process_memory, render_metric, size_buckets
+from scripts.responses import accepted_encoding, compact_figure, prepare_response
+from scripts.static_export import latest_export
 
 
 external_stylesheets = [
@@ -19,28 +26,239 @@ external_stylesheets = [
 #----------[ Configuration ]----------#
 config_file = 'config.yaml'
 with open(config_file) as f:
-    configuration = yaml.safe_load(f)           # DATA_IMPORT must be in format 'DDMMYYYY'
+    configuration = yaml.safe_load(f)           # DATA_IMPORT must be in format 'DDMMYYYY', or 'latest'
+datahubs = configuration.get('DATAHUBS', [configuration['DATAHUB']])        # Data hubs that can be selected, DATAHUB is shown by default
 
 
 #----------[ Data Definition and Figure Generation ]----------#
 
-plots = GeneratePlots(configuration['DATAHUB'], configuration['DATA_IMPORT'])
+# Figures are built on first request by the callbacks below, rather than when the app is started,
+# and are kept in a bounded cache shared by all sessions of this worker
+figure_cache = FigureCache(configuration.get('FIGURE_CACHE_SIZE', 64))
 
-datahub_stats = plots.return_stats()        # Data hub general statistics HTML object
-stacked_raw_subs = plots.submissions()          # Stacked line graph for raw number of submissions
-stacked_cum_subs = plots.cumulative_submissions()           # Stacked line graph for cumulative number of submissions
-sub_map = plots.submissions_map()       # Submissions map
 
-# Pie chart is called on under 'Callbacks' as it is more interactive, with a drop-down
+def load_hub(datahub, date):
+    """
+    Load a data hub snapshot to build figures from
+    :param datahub: Name of data hub
+    :param date: Date of the snapshot (DDMMYYYY)
+    :return: GeneratePlots object
+    """
+    from scripts.plots import GeneratePlots       # Loads pandas and plotly, which are only needed once a data hub is viewed
+    return GeneratePlots(datahub, date, configuration.get('MAP_TOLERANCE'))
+
+
+# Data hubs are loaded when they are first selected, and evicted when idle or over the memory budget
+hub_registry = HubRegistry(load_hub,
+                           max_memory_mb=configuration.get('HUB_MEMORY_MB', 1024),
+                           idle_seconds=configuration.get('HUB_IDLE_SECONDS', 3600))
+
+# With DATA_IMPORT set to 'latest', new snapshots saved by visualisation_prep.py are picked up without a restart
+snapshot_watcher = None
+if configuration['DATA_IMPORT'] == 'latest':
+    snapshot_watcher = SnapshotWatcher(hub_registry, datahubs, configuration.get('SNAPSHOT_POLL_SECONDS', 60))
+    snapshot_watcher.start()
+else:
+    IdleSweeper(hub_registry, configuration.get('SNAPSHOT_POLL_SECONDS', 60)).start()       # Idle data hubs are released even when no requests are made
+
+
+# Metrics of this worker, exposed at /metrics
+callback_seconds = Histogram('dashboard_callback_seconds', 'Time taken by each callback')
+figure_build_seconds = Histogram('dashboard_figure_build_seconds', 'Time taken to build each figure, when not cached')
+figure_bytes = Histogram('dashboard_figure_bytes', 'Size of each figure built, as sent to the browser', size_buckets)
+response_bytes = Histogram('dashboard_response_bytes', 'Size of each response as sent, by endpoint and compression', size_buckets)
+uncompressed_bytes = Histogram('dashboard_response_uncompressed_bytes', 'Size of each response before compression, by endpoint', size_buckets)
+
+
+def snapshot_date(datahub):
+    """
+    Obtain the date of the snapshot to present for a data hub
+    :param datahub: Name of data hub
+    :return: Snapshot date (DDMMYYYY), None if no snapshot of the data hub has been saved yet (with DATA_IMPORT set to 'latest')
+    """
+    if snapshot_watcher is not None:
+        return snapshot_watcher.snapshot_date(datahub)
+    return configuration['DATA_IMPORT']
+
+
+def datahub_from_path(pathname):
+    """
+    Obtain the data hub selected by the URL path (e.g. /dcc_grusin)
+    :param pathname: Path of the URL
+    :return: Name of data hub, the default data hub if the path does not name one
+    """
+    datahub = (pathname or '').strip('/')
+    return datahub if datahub in datahubs else configuration['DATAHUB']
+
+
+def cached_figure(datahub, figure_id, *params):
+    """
+    Obtain a figure of the current snapshot of a data hub from the cache, building it if needed
+    :param datahub: Name of data hub
+    :param figure_id: Name of the GeneratePlots method which builds the figure
+    :param params: Parameters of the figure
+    :return: Figure (or HTML) object
+    """
+    date = snapshot_date(datahub)
+    return figure_cache.get(datahub, date, figure_id, functools.partial(build_figure, datahub, date, figure_id), *params)
+
+
+def build_figure(datahub, date, figure_id, *params):
+    """
+    Build a figure of a data hub snapshot, recording its build time and size
+    :param datahub: Name of data hub
+    :param date: Date of the snapshot (DDMMYYYY)
+    :param figure_id: Name of the GeneratePlots method which builds the figure
+    :param params: Parameters of the figure
+    :return: Figure (or HTML) object
+    """
+    import plotly       # Loaded already by the data hub, for its JSON encoder
+    plots = hub_registry.get(datahub, date)     # Loading the data hub is not counted in the build time
+    with figure_build_seconds.time(figure=figure_id):
+        figure = compact_figure(getattr(plots, figure_id)(*params), configuration.get('FIGURE_DECIMALS', 3))        # Rounded, as cached and sent
+    figure_bytes.observe(len(json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder)), figure=figure_id)
+    return figure
+
+
+def filters_from(start_date, end_date, countries, platforms):
+    """
+    Obtain the filter key of the filter controls
+    :param start_date: First day of submission to keep ('YYYY-MM-DD', or None)
+    :param end_date: Last day of submission to keep ('YYYY-MM-DD', or None)
+    :param countries: Countries to keep, empty for all
+    :param platforms: Instrument platforms to keep, empty for all
+    :return: Filter key, which figures are cached by
+    """
+    from scripts.filter_index import make_filters       # Loads pandas, which is only needed once a data hub is viewed
+    return make_filters(first_created=(start_date, end_date), country=countries, instrument_platform=platforms)
+
+
+def timed_callback(callback):
+    """
+    Record the time taken by a callback
+    :param callback: Callback function
+    :return: Callback function, timed
+    """
+    @functools.wraps(callback)
+    def timed(*args):
+        with callback_seconds.time(callback=callback.__name__):
+            return callback(*args)
+    return timed
 
 
 #----------[ App Information and Layout ]----------#
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 app.title = "Data Hubs Dashboard"
+server = app.server     # For WSGI servers, e.g. gunicorn app:server
+
+
+@server.after_request
+def optimise_response(response):
+    # Compress responses (e.g. figures sent by the callbacks), and answer GET requests for unchanged content with a 304
+    buffered = not (response.direct_passthrough or response.is_streamed)       # Files are sent as they are read
+    size = len(response.get_data()) if buffered else response.content_length
+    response = prepare_response(response, flask.request)
+    sent = len(response.get_data()) if buffered else response.content_length
+    endpoint = flask.request.endpoint or 'other'
+    if size is not None:
+        uncompressed_bytes.observe(size, endpoint=endpoint)
+    if sent is not None:
+        response_bytes.observe(sent, endpoint=endpoint, encoding=response.headers.get('Content-Encoding', 'identity'))
+    return response
+
+
+def send_export(directory, filename, immutable=False):
+    """
+    Send a file of the static dashboards, with an ETag of the file as saved, and its compressed copy when accepted
+    :param directory: Directory of the file
+    :param filename: Path of the file within the directory
+    :param immutable: Whether the file never changes once saved (i.e. it is named by its version), so is cached by browsers
+                      and proxies for a year. Otherwise it is revalidated on each use, as a snapshot can be exported again.
+    :return: Flask response
+    """
+    compressed = (accepted_encoding(flask.request.headers.get('Accept-Encoding'), ['gzip']) is not None and
+                  os.path.isfile(safe_join(directory, filename + '.gz') or ''))      # Only gzip compressed copies are exported
+    sent = filename + '.gz' if compressed else filename
+    path = safe_join(directory, sent)
+    if path is None or not os.path.isfile(path):
+        flask.abort(404)
+    saved = os.stat(path)
+    response = flask.send_from_directory(directory, sent, etag=False, mimetype=mimetypes.guess_type(filename)[0],
+                                         download_name=os.path.basename(filename))
+    if compressed:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    response.set_etag('{:x}-{:x}{}'.format(saved.st_mtime_ns, saved.st_size, '-gzip' if compressed else ''))       # Changes when the file is saved again
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable' if immutable else 'no-cache'
+    return response.make_conditional(flask.request)
+
+
+@server.route("/export/<datahub>/")
+@server.route("/export/<datahub>/<date>/")
+@server.route("/export/<datahub>/<date>/<path:filename>")
+def export_file(datahub, date=None, filename='index.html'):
+    # Static dashboards exported by visualisation_prep.py, revalidated on each use as a snapshot can be exported again
+    output = configuration.get('EXPORT_DIR', 'export')
+    if datahub not in datahubs or not os.path.isdir(os.path.join(output, datahub)):
+        flask.abort(404)
+    if date is None:
+        latest = latest_export(output, datahub)
+        if latest is None:
+            flask.abort(404)
+        response = flask.redirect('/export/{}/{}/'.format(datahub, latest))
+        response.headers['Cache-Control'] = 'no-cache'      # Changes with each export
+        return response
+    try:
+        datetime.datetime.strptime(date, '%d%m%Y')
+    except ValueError:
+        flask.abort(404)
+    return send_export(os.path.join(output, datahub, date), filename)
+
+
+@server.route("/export/<datahub>/<filename>")
+def export_shared_file(datahub, filename):
+    # plotly.js shared by the static dashboards of a data hub, named by its version
+    try:
+        datetime.datetime.strptime(filename, '%d%m%Y')
+        return flask.redirect('/export/{}/{}/'.format(datahub, filename))       # A bundle, without the trailing slash
+    except ValueError:
+        pass
+    output = configuration.get('EXPORT_DIR', 'export')
+    if datahub not in datahubs or not (filename.startswith('plotly-') and filename.endswith('.min.js')):
+        flask.abort(404)
+    return send_export(os.path.join(output, datahub), filename, immutable=True)
+
+
+@server.route("/_hubs")
+def hub_status():
+    # Memory and load (switch) time of each loaded data hub, resident memory of this worker, usage of the figure cache and the last snapshot reloads
+    return flask.jsonify(datahubs=hub_registry.stats(), worker=dict(process_memory(), pid=os.getpid()), figure_cache=figure_cache.stats(),
+                         reloads=snapshot_watcher.reloads if snapshot_watcher is not None else {})
+
+
+@server.route("/metrics")
+def metrics():
+    # Metrics of this worker in the Prometheus text format, each worker of a WSGI server keeping its own
+    cache = figure_cache.stats()
+    lookups = cache['hits'] + cache['misses']
+    hubs = hub_registry.stats()
+    lines = callback_seconds.render() + figure_build_seconds.render() + figure_bytes.render() + response_bytes.render() + uncompressed_bytes.render()
+    lines += render_metric('dashboard_figure_cache_hits_total', 'Figures served from the cache', 'counter', [({}, cache['hits'])])
+    lines += render_metric('dashboard_figure_cache_misses_total', 'Figures built as they were not cached', 'counter', [({}, cache['misses'])])
+    lines += render_metric('dashboard_figure_cache_hit_ratio', 'Fraction of figures served from the cache', 'gauge', [({}, round(cache['hits'] / lookups, 4) if lookups else 0)])
+    lines += render_metric('dashboard_figure_cache_size', 'Number of figures cached', 'gauge', [({}, cache['size'])])
+    lines += render_metric('dashboard_hub_memory_mb', 'Memory held by each loaded data hub snapshot', 'gauge', [({'datahub': hub['datahub'], 'date': hub['date']}, hub['memory_mb']) for hub in hubs])
+    lines += render_metric('dashboard_hub_load_seconds', 'Time taken to load each loaded data hub snapshot', 'gauge', [({'datahub': hub['datahub'], 'date': hub['date']}, hub['load_seconds']) for hub in hubs])
+    memory = process_memory()
+    lines += render_metric('dashboard_worker_resident_memory_mb', 'Resident memory of this worker, to size the number of workers per node', 'gauge', [({'pid': os.getpid()}, memory['resident_mb'])] if memory else [])
+    lines += render_metric('dashboard_worker_peak_resident_memory_mb', 'Peak resident memory of this worker', 'gauge', [({'pid': os.getpid()}, memory['peak_resident_mb'])] if memory else [])
+    return flask.Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 
 app.layout = html.Div(
     [
+        dcc.Location(id="url", refresh=False),
         # Top Title Banner #
         dbc.Row(
             dbc.Col(
@@ -49,9 +267,17 @@ app.layout = html.Div(
                         html.H1(children="Data Hub Dashboard",
                                 className="header-title"
                         ),
-                        html.H3(children=configuration['DATAHUB'],
+                        html.H3(id="datahub_name",
                                 className="sub-header",
                         ),
+                        dcc.Dropdown(
+                            id="datahub",
+                            value=configuration['DATAHUB'],
+                            options=[{'value': x, 'label': x} for x in datahubs],
+                            clearable=False,
+                            style={} if len(datahubs) > 1 else {'display': 'none'},
+                            className="datahub-dropdown"
+                        ),
                         html.P(
                             children="This dashboard presents information related to your data hub.",
                             className="header-description",
@@ -66,12 +292,37 @@ app.layout = html.Div(
         dbc.Row(
             children=[
                 html.Div(
-                    children=datahub_stats,
+                    id="datahub_stats",
                     className="tiles",
                 ),
             ],
             className="banner",
         ),
+        # Filters, applied to the map, pie chart and submission plots #
+        dbc.Row(
+            children=[
+                dcc.DatePickerRange(
+                    id="date-range",
+                    display_format="YYYY-MM-DD",
+                    start_date_placeholder_text="First submission",
+                    end_date_placeholder_text="Last submission",
+                    clearable=True
+                ),
+                dcc.Dropdown(
+                    id="country-filter",
+                    multi=True,
+                    placeholder="All countries",
+                    className="filter"
+                ),
+                dcc.Dropdown(
+                    id="platform-filter",
+                    multi=True,
+                    placeholder="All platforms",
+                    className="filter"
+                ),
+            ],
+            className="filters",
+        ),
         # Submissions Map #
         dbc.Row(
             dbc.Col(
@@ -79,8 +330,7 @@ app.layout = html.Div(
                     html.Div(
                         html.Div(
                             children=dcc.Graph(
-                                id="submissions_map",
-                                figure=sub_map
+                                id="submissions_map"
                             ),
                             className="large-card"
                         ),
@@ -100,10 +350,11 @@ app.layout = html.Div(
                                 id="variable",
                                 value="instrument_platform",
                                 options=[{'value': x, 'label': x.replace("_", " ").capitalize()}
-                                        for x in ['instrument_platform', 'library_selection', 'library_source', 'library_strategy']],
+                                        for x in pie_variables],
                                 clearable=False
                             ),
                             dcc.Graph(id="pie-chart"),
+                            dcc.Store(id="pie-counts"),     # Counts of every pie chart variable, the pie chart is switched between them in the browser
                         ],
                     ),
                     className="card",
@@ -112,14 +363,25 @@ app.layout = html.Div(
             ],
             className="row-two"
         ),
+        dbc.Row(
+            dbc.Col(
+                dcc.RadioItems(
+                    id="granularity",
+                    value="month",
+                    options=[{'value': x, 'label': x.capitalize()} for x in period_labels],
+                    className="granularity",
+                    inputClassName="granularity-input"
+                ),
+                width=12
+            )
+        ),
         dbc.Row(
             [
                 dbc.Col(
                     html.Div(
                         children=dcc.Graph(
                             id="stacked_cumulative_submissions",
-                            config={"displayModeBar": False},
-                            figure=stacked_cum_subs
+                            config={"displayModeBar": False}
                         ),
                     ),
                     className="card",
@@ -129,8 +391,7 @@ app.layout = html.Div(
                     html.Div(
                         children=dcc.Graph(
                             id="stacked_raw_submissions",
-                            config={"displayModeBar": False},
-                            figure=stacked_raw_subs
+                            config={"displayModeBar": False}
                         ),
                     ),
                     className="card",
@@ -161,12 +422,92 @@ app.layout = html.Div(
 #----------[ Callbacks ]----------#
 
 @app.callback(
+    [Output("url", "pathname"),
+     Output("datahub", "value")],
+    [Input("url", "pathname"),
+     Input("datahub", "value")]
+)
+@timed_callback
+def select_datahub(pathname, datahub):
+    # Keep the URL path and the data hub drop-down in step, whichever of them was changed
+    if dash.callback_context.triggered[0]['prop_id'] != "datahub.value":
+        datahub = datahub_from_path(pathname)
+    return "/{}".format(datahub), datahub
+
+
+@app.callback(
+    [Output("datahub_name", "children"),
+     Output("datahub_stats", "children"),
+     Output("date-range", "min_date_allowed"),
+     Output("date-range", "max_date_allowed"),
+     Output("date-range", "start_date"),
+     Output("date-range", "end_date"),
+     Output("country-filter", "options"),
+     Output("country-filter", "value"),
+     Output("platform-filter", "options"),
+     Output("platform-filter", "value")],
+    [Input("datahub", "value")]
+)
+@timed_callback
+def generate_page(datahub):
+    if snapshot_date(datahub) is None:
+        # Presented once a snapshot is saved, the figures are left empty meanwhile
+        return (datahub, html.P("No snapshot of this data hub has been saved yet.", className="header-description"),
+                None, None, None, None, [], [], [], [])
+    datahub_stats = cached_figure(datahub, 'return_stats')        # Data hub general statistics HTML object
+    options = cached_figure(datahub, 'filter_options')      # Values the data hub can be filtered on, filters are cleared when switching data hubs
+    first, last = options['first_created']
+    return (datahub, datahub_stats, first, last, None, None,
+            [{'value': x, 'label': x} for x in options['country']], [],
+            [{'value': x, 'label': x} for x in options['instrument_platform']], [])
+
+
+@app.callback(
+    [Output("submissions_map", "figure"),
+     Output("pie-counts", "data")],
+    [Input("datahub", "value"),
+     Input("date-range", "start_date"),
+     Input("date-range", "end_date"),
+     Input("country-filter", "value"),
+     Input("platform-filter", "value")]
+)
+@timed_callback
+def generate_holdings(datahub, start_date, end_date, countries, platforms):
+    if snapshot_date(datahub) is None:
+        raise PreventUpdate     # No snapshot of the data hub yet
+    filters = filters_from(start_date, end_date, countries, platforms)
+    sub_map = cached_figure(datahub, 'submissions_map', filters)       # Submissions map
+    pie_counts = cached_figure(datahub, 'pie_counts', filters)       # Counts for the pie chart of every variable
+    return sub_map, pie_counts
+
+
+@app.callback(
+    [Output("stacked_cumulative_submissions", "figure"),
+     Output("stacked_raw_submissions", "figure")],
+    [Input("datahub", "value"),
+     Input("granularity", "value"),
+     Input("date-range", "start_date"),
+     Input("date-range", "end_date"),
+     Input("country-filter", "value"),
+     Input("platform-filter", "value")]
+)
+@timed_callback
+def generate_submissions(datahub, granularity, start_date, end_date, countries, platforms):
+    if snapshot_date(datahub) is None:
+        raise PreventUpdate     # No snapshot of the data hub yet
+    filters = filters_from(start_date, end_date, countries, platforms)
+    stacked_cum_subs = cached_figure(datahub, 'cumulative_submissions', granularity, filters)           # Stacked line graph for cumulative number of submissions
+    stacked_raw_subs = cached_figure(datahub, 'submissions', granularity, filters)          # Stacked line graph for raw number of submissions
+    return stacked_cum_subs, stacked_raw_subs
+
+
+# Built in the browser (assets/dashboard.js), switching the pie chart variable does not send a request
+app.clientside_callback(
+    ClientsideFunction(namespace="dashboard", function_name="pie_chart"),
     Output("pie-chart", "figure"),
-    [Input("variable", "value")]
+    [Input("pie-counts", "data"),
+     Input("variable", "value")]
 )
-def generate_chart(variable):
-    fig = plots.datahub_pie(variable)       # Create pie chart
-    return fig
 
 
 #----------[ Main ]----------#
@@ -0,0 +1,16 @@
+// Callbacks run in the browser, loaded by Dash from the assets directory
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    dashboard: {
+        // Build the pie chart of a variable from the counts of every variable (GeneratePlots.pie_counts),
+        // so that switching variables needs no request to the server
+        pie_chart: function(pie_counts, variable) {
+            if (!pie_counts || !pie_counts.counts[variable]) {
+                return window.dash_clientside.no_update;
+            }
+            var counts = pie_counts.counts[variable];
+            var trace = Object.assign({}, pie_counts.trace, {labels: counts.labels, values: counts.values});
+            var layout = Object.assign({}, pie_counts.layout, {title: Object.assign({}, pie_counts.layout.title, {text: counts.title})});
+            return {data: [trace], layout: layout};
+        }
+    }
+});
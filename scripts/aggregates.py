@@ -0,0 +1,159 @@
+#!/usr/bin/env/python3
+# This script handles the counting of records per dimension, which the dashboard plots are built from
+
+__author__ = 'Nadim Rahman'
+
+import numpy as np
+import pandas as pd
+from result_types import result_types
+
+# Dimensions counted for each result type, from the result type registry. 'day' is derived from first_created and
+# 'country' is the country without any region (e.g. 'United Kingdom' for 'United Kingdom:London'). Days are counted as
+# integer periods (days since 1 January 1970) and only converted to 'YYYY-MM-DD' labels in the aggregate table
+cube_dimensions = {result_type: search['aggregations'] for result_type, search in result_types.items()}
+cube_columns = ['result_type', 'dimension', 'value', 'count']
+
+
+def day_periods(dates):
+    """
+    Convert dates to integer daily periods, so that days are counted without formatting every date
+    :param dates: Series of dates
+    :return: Series of days since 1 January 1970, missing where there is no date
+    """
+    return (pd.to_datetime(dates, errors='coerce') - pd.Timestamp('1970-01-01')).dt.days
+
+
+def day_labels(periods):
+    """
+    Convert integer daily periods to labels
+    :param periods: Iterable of days since 1 January 1970
+    :return: Index of 'YYYY-MM-DD' labels
+    """
+    return pd.to_datetime(np.asarray(periods, dtype='int64'), unit='D').strftime('%Y-%m-%d')
+
+
+def dimension_values(df, dimension):
+    """
+    Obtain the values of a dimension for each record
+    :param df: Data frame of records
+    :param dimension: Dimension to obtain values for
+    :return: Series of values, missing where the record has no value
+    """
+    if dimension == 'day':
+        return day_periods(df['first_created'])
+    elif dimension == 'country':
+        return df['country'].astype(object).str.split(':').str[0]
+    return df[dimension]
+
+
+def count_dimensions(df, dimensions):
+    """
+    Count the records per value of each dimension
+    :param df: Data frame of records (or a chunk of them)
+    :param dimensions: Dimensions to count
+    :return: Dictionary of dimension to Series of counts, indexed by value (by integer period for 'day')
+    """
+    counts = {}
+    for dimension in dimensions:
+        values = dimension_values(df, dimension).value_counts(dropna=True)
+        values = values[values > 0]     # Unused categories of categorical columns are counted as 0
+        values.index = values.index.astype(int) if dimension == 'day' else values.index.astype(str)
+        counts[dimension] = values
+    return counts
+
+
+def merge_counts(partials):
+    """
+    Merge counts made over separate chunks of records
+    :param partials: Iterable of dictionaries of dimension to Series of counts
+    :return: Dictionary of dimension to Series of counts, indexed by value (by integer period for 'day')
+    """
+    merged = {}
+    for counts in partials:
+        for dimension, values in counts.items():
+            merged[dimension] = values if dimension not in merged else merged[dimension].add(values, fill_value=0)
+    return {dimension: values.astype(int) for dimension, values in merged.items()}
+
+
+def summary_columns(result_type):
+    """
+    Obtain the columns needed to summarise a result type, so that only these are loaded
+    :param result_type: Result type to summarise
+    :return: List of columns, for the data hub stats and the dimensions counted
+    """
+    columns = [column for column in result_types[result_type]['stats'].values() if column != 'rows']
+    columns += ['first_created' if dimension == 'day' else dimension for dimension in cube_dimensions[result_type]]
+    return list(dict.fromkeys(columns))
+
+
+def summarise_chunk(chunk, result_type):
+    """
+    Summarise a chunk of records for the data hub stats and the aggregate table
+    :param chunk: Data frame of records (or a chunk of them)
+    :param result_type: Result type of the records
+    :return: Number of rows, a dictionary of the distinct values per stats column and a dictionary of counts per dimension
+    """
+    distinct = {column: set(chunk[column].dropna().unique()) for column in result_types[result_type]['stats'].values() if column != 'rows'}
+    return len(chunk), distinct, count_dimensions(chunk, cube_dimensions[result_type])      # Includes the submissions per day
+
+
+def empty_summary(result_type):
+    """
+    Create the summary of no records, which the summaries of chunks are merged into
+    :param result_type: Result type of the records
+    :return: Summary of no records
+    """
+    return 0, {column: set() for column in result_types[result_type]['stats'].values() if column != 'rows'}, {}
+
+
+def merge_summaries(summary, other):
+    """
+    Merge the summaries of separate chunks of records, in any order
+    :param summary: Summary of some records, from summarise_chunk() or merge_summaries()
+    :param other: Summary of other records
+    :return: Summary of the records of both
+    """
+    distinct = {column: values | other[1][column] for column, values in summary[1].items()}
+    return summary[0] + other[0], distinct, merge_counts([summary[2], other[2]])
+
+
+def distinct_counts(summary):
+    """
+    Count the distinct values of each stats column of a summary, once every chunk has been merged in
+    :param summary: Summary of the records
+    :return: Number of rows, a dictionary of the number of distinct values per stats column and a dictionary of counts per dimension
+    """
+    rows, distinct, counts = summary
+    return rows, {column: len(values) for column, values in distinct.items()}, counts
+
+
+def to_cube(counts, result_type):
+    """
+    Convert counts for a result type to the rows of the aggregate table
+    :param counts: Dictionary of dimension to Series of counts, indexed by value (by integer period for 'day')
+    :param result_type: Result type the counts are for
+    :return: Data frame of result type, dimension, value and count
+    """
+    frames = []
+    for dimension, values in counts.items():
+        if dimension == 'day':
+            values = values.set_axis(day_labels(values.index))
+        frame = values.rename_axis('value').reset_index(name='count')
+        frame.insert(0, 'dimension', dimension)
+        frame.insert(0, 'result_type', result_type)
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=cube_columns)
+    return pd.concat(frames, ignore_index=True)[cube_columns].sort_values(['result_type', 'dimension', 'value'], ignore_index=True)
+
+
+def select(cube, dimension, result_type='read_run'):
+    """
+    Select the counts of a dimension from the aggregate table
+    :param cube: Data frame of the aggregate table
+    :param dimension: Dimension to select
+    :param result_type: Result type to select
+    :return: Data frame of value and count, largest count first
+    """
+    rows = cube[(cube['result_type'] == result_type) & (cube['dimension'] == dimension)]
+    return rows[['value', 'count']].sort_values('count', ascending=False, ignore_index=True)
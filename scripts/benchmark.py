@@ -0,0 +1,437 @@
+#!/usr/bin/env/python3
+# This script benchmarks the data download, data frame preparation and figure builds on synthetic data hubs
+
+__author__ = 'Nadim Rahman'
+
+import numpy as np
+import pandas as pd
+import argparse, datetime, json, os, platform, re, subprocess, sys, time
+from result_types import result_types
+
+scripts_directory = os.path.dirname(os.path.realpath(__file__))
+
+# Values of the synthetic records, with their relative frequencies, skewed as in a typical pathogen data hub
+platforms = {
+    'ILLUMINA': (0.82, ['Illumina MiSeq', 'Illumina NovaSeq 6000', 'NextSeq 500', 'Illumina HiSeq 2500']),
+    'OXFORD_NANOPORE': (0.13, ['MinION', 'GridION', 'PromethION']),
+    'PACBIO_SMRT': (0.03, ['Sequel II', 'PacBio RS II']),
+    'ION_TORRENT': (0.02, ['Ion Torrent S5', 'Ion Torrent PGM'])
+}
+countries = {
+    'United Kingdom': (0.35, ['England', 'Scotland', 'Wales', 'Northern Ireland']),
+    'USA': (0.15, ['California', 'New York', 'Texas', 'Washington']),
+    'Germany': (0.08, ['Berlin', 'Bavaria', 'Hamburg']),
+    'Denmark': (0.07, ['Copenhagen', 'Aarhus']),
+    'Brazil': (0.05, ['Sao Paulo', 'Rio de Janeiro']),
+    'South Africa': (0.05, ['Western Cape', 'Gauteng']),
+    'India': (0.04, ['Maharashtra', 'Kerala', 'Delhi']),
+    'Kenya': (0.03, ['Nairobi', 'Kilifi']),
+    'Japan': (0.03, ['Tokyo', 'Osaka']),
+    'Russia': (0.03, ['Moscow']),
+    'France': (0.03, ['Paris', 'Lyon']),
+    'Czech Republic': (0.02, ['Prague']),
+    'Australia': (0.02, ['Victoria', 'New South Wales']),
+    'not collected': (0.03, []),        # Values which cannot be placed on the map
+    'missing': (0.02, [])
+}
+library_values = {
+    'library_layout': {'PAIRED': 0.8, 'SINGLE': 0.2},
+    'library_selection': {'RT-PCR': 0.55, 'PCR': 0.25, 'RANDOM': 0.15, 'unspecified': 0.05},
+    'library_source': {'VIRAL RNA': 0.7, 'GENOMIC': 0.2, 'METAGENOMIC': 0.08, 'TRANSCRIPTOMIC': 0.02},
+    'library_strategy': {'AMPLICON': 0.7, 'WGS': 0.2, 'RNA-Seq': 0.07, 'Targeted-Capture': 0.03},
+    'analysis_type': {'SEQUENCE_CONSENSUS': 0.6, 'SEQUENCE_VARIATION': 0.3, 'GENOME_MAP': 0.1},
+    'pipeline_name': {'ncov2019-artic-nf': 0.6, 'ViralFlow': 0.2, 'nf-core/viralrecon': 0.15, 'covid-sequence-analysis-workflow': 0.05},
+    'pipeline_version': {'1.3.0': 0.5, '1.2.1': 0.3, '2.0': 0.2}
+}
+first_created_range = ('2016-01-01', '2023-12-31')      # Submissions grow over the years
+accession_prefixes = {'read_run': 'ERR', 'analysis': 'ERZ'}
+stage_names = ['fetch', 'prepare', 'aggregate', 'figures']
+
+
+def get_args():
+    """
+    Handle script arguments
+    :return: Script arguments
+    """
+    parser = argparse.ArgumentParser(prog='benchmark.py', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="""
+        + =========================================================== +
+        |  ENA Data Hubs Dashboard: benchmark.py                      |
+        |  Python script to time the data download, data frame        |
+        |  preparation and figure builds on synthetic data hubs.      |
+        + =========================================================== +
+        """)
+    parser.add_argument('-r', '--rows', help='Numbers of read_run records to benchmark, analyses being a quarter of these (default: 10000 1000000 10000000)', type=int, nargs='+', default=[10000, 1000000, 10000000])
+    parser.add_argument('-d', '--directory', help='Directory to save the synthetic data, snapshots and results in (default: benchmark)', type=str, default='benchmark')
+    parser.add_argument('-o', '--output', help='File to add the results to (default: benchmark_results.json in the directory)', type=str)
+    parser.add_argument('-m', '--mode', help='Download mode to benchmark (default: default)', choices=['default', 'stream', 'parallel'], default='default')
+    parser.add_argument('-t', '--map-tolerance', help='Simplification tolerance of the map polygons in degrees (default: 0.01)', type=float, default=0.01)
+    parser.add_argument('-w', '--aggregate-workers', help='Number of processes for the aggregate stage to summarise across (default: number of CPUs)', type=int, default=os.cpu_count())
+    parser.add_argument('--stage', help=argparse.SUPPRESS, choices=stage_names)     # Run a single stage, in a process of its own
+    parser.add_argument('--datahub', help=argparse.SUPPRESS, type=str)
+    parser.add_argument('--portal-url', help=argparse.SUPPRESS, type=str)
+    parser.add_argument('--stage-output', help=argparse.SUPPRESS, type=str)
+    args = parser.parse_args()
+    return args
+
+
+def choose(rng, values, rows):
+    """
+    Draw values at their relative frequencies
+    :param rng: Random number generator
+    :param values: Dictionary of value to relative frequency
+    :param rows: Number of values to draw
+    :return: Categorical of the drawn values
+    """
+    weights = np.array(list(values.values()), dtype=float)
+    codes = rng.choice(len(values), size=rows, p=weights / weights.sum())
+    return pd.Categorical.from_codes(codes, categories=list(values))
+
+
+def synthetic_records(result_type, start, rows, seed=0):
+    """
+    Generate synthetic records of a result type, with the fields of the result type registry
+    :param result_type: Result type to generate records of
+    :param start: Number of the first record, so that accessions are unique over chunks
+    :param rows: Number of records
+    :param seed: Seed of the random number generator
+    :return: Data frame of records, the accession being the first column
+    """
+    rng = np.random.default_rng([seed, start])
+    accession = '{}_accession'.format('run' if result_type == 'read_run' else result_type)
+    records = {accession: pd.Series(np.arange(start, start + rows)).astype(str).str.zfill(8).radd(accession_prefixes.get(result_type, 'ERX'))}
+
+    # Submissions become more frequent over time, and are made public a few days after being created
+    days = pd.date_range(*first_created_range, freq='D')
+    weights = np.exp(np.linspace(0, 3, len(days)))
+    first_created = days[rng.choice(len(days), size=rows, p=weights / weights.sum())]
+    first_public = first_created + pd.to_timedelta(rng.integers(0, 30, size=rows), unit='D')
+
+    # Each model is drawn from those of the platform of the record
+    platform = choose(rng, {name: weight for name, (weight, models) in platforms.items()}, rows)
+    model_counts = np.array([len(models) for weight, models in platforms.values()])
+    model_offsets = np.concatenate([[0], np.cumsum(model_counts)[:-1]])
+    model_codes = model_offsets[platform.codes] + (rng.random(rows) * model_counts[platform.codes]).astype(int)
+    model = pd.Categorical.from_codes(model_codes, categories=[model for weight, models in platforms.values() for model in models])
+    country = choose(rng, {name if not region else '{}:{}'.format(name, region): weight / (len(regions) + 1)
+                           for name, (weight, regions) in countries.items() for region in [None] + regions}, rows)
+
+    for field in result_types[result_type]['search_fields']:
+        if field == accession:
+            continue
+        elif field == 'first_created':
+            records[field] = first_created.strftime('%Y-%m-%d')
+        elif field == 'first_public':
+            records[field] = first_public.strftime('%Y-%m-%d')
+        elif field == 'collection_date':
+            records[field] = (first_created - pd.to_timedelta(rng.integers(1, 60, size=rows), unit='D')).strftime('%Y-%m-%d')
+        elif field == 'instrument_platform':
+            records[field] = platform
+        elif field == 'instrument_model':
+            records[field] = model
+        elif field == 'country':
+            records[field] = country
+        elif field in library_values:
+            records[field] = choose(rng, library_values[field], rows)
+        elif field == 'center_name':
+            records[field] = choose(rng, {'Centre {}'.format(i): 1 / i for i in range(1, 61)}, rows)        # A few centres submit most records
+        elif field == 'tax_id':
+            records[field] = '2697049'
+        elif field == 'scientific_name':
+            records[field] = 'Severe acute respiratory syndrome coronavirus 2'
+        elif field.endswith('_accession'):
+            records[field] = pd.Series(rng.integers(0, max(rows // 50, 1), size=rows)).astype(str).radd(field[:3].upper())
+        else:
+            records[field] = pd.Series(rng.integers(0, 1000, size=rows)).astype(str).radd('{} '.format(field))     # e.g. titles and names
+    return pd.DataFrame(records)
+
+
+def write_synthetic(result_type, rows, path, chunk_rows=1000000):
+    """
+    Write synthetic records of a result type to a tab-separated file, in chunks
+    :param result_type: Result type to generate records of
+    :param rows: Number of records
+    :param path: Path of the file
+    :param chunk_rows: Number of records generated at once
+    :return: Path of the file
+    """
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'w') as f:
+        for start in range(0, rows, chunk_rows):
+            synthetic_records(result_type, start, min(chunk_rows, rows - start)).to_csv(f, sep="\t", index=False, header=start == 0)
+    os.replace(temporary_path, path)
+    return path
+
+
+def stage_result(timings, **details):
+    """
+    Create the result of a stage
+    :param timings: Dictionary of step to seconds
+    :param details: Other details of the stage
+    :return: Dictionary of timings, peak memory and details
+    """
+    from data_import import peak_memory_mb
+    return dict({'timings': {step: round(seconds, 4) for step, seconds in timings.items()}, 'peak_rss_mb': round(peak_memory_mb(), 1)}, **details)
+
+
+def fetch_stage(datahub, portal_url, mode):
+    """
+    Download each result type from the portal
+    :param datahub: Name of data hub
+    :param portal_url: URL of the portal to download from
+    :param mode: Download mode ('default', 'stream' or 'parallel')
+    :return: Result of the stage
+    """
+    from data_import import retrieve_data
+    from portal_client import PortalClient
+    client = PortalClient(pool_size=4, validators_file=os.path.join('data', 'benchmark_validators.json'))
+    timings = {}
+    for result_type, search in result_types.items():
+        retrieval = retrieve_data(search, datahub, 'benchmark', portal_url, client)
+        start = time.perf_counter()
+        if mode == 'stream':
+            for chunk in retrieval.stream_retrieval():
+                pass
+        elif mode == 'parallel':
+            retrieval.paginated_retrieval()
+        else:
+            retrieval.coordinate_retrieval()
+        timings['retrieval_{}'.format(result_type)] = time.perf_counter() - start
+    return stage_result(timings, portal=client.totals())
+
+
+def prepare_stage(datahub, date):
+    """
+    Create the data frames for the plots from the downloaded snapshots, as visualisation_prep.py does
+    :param datahub: Name of data hub
+    :param date: Date of the snapshots (DDMMYYYY)
+    :return: Result of the stage
+    """
+    from aggregates import to_cube, select
+    from geography import CountryCodes
+    from visualisation_prep import prepDf
+    prep = prepDf(date, argparse.Namespace(username=datahub, workers=1, retries=0, timeout=1, max_rate=None))
+    timings = {}
+    statistics = {}
+    cube = []
+    for result_type in result_types:
+        start = time.perf_counter()
+        df = prep.store.read('ENA_Search_{}'.format(result_type), date)
+        timings['read_{}'.format(result_type)] = time.perf_counter() - start
+        start = time.perf_counter()
+        summary = prep.summarise([df], result_type)
+        timings['summarise_{}'.format(result_type)] = time.perf_counter() - start
+        del df
+        statistics = prep.add_datahub_stats(statistics, result_type, summary)
+        cube.append(to_cube(summary[2], result_type))
+
+    start = time.perf_counter()
+    prep.store.write(pd.DataFrame(list(statistics.items()), columns=['field', 'value']), 'Datahub_stats', date)
+    cube = pd.concat(cube, ignore_index=True)
+    prep.store.write(cube, 'aggregates', date)
+    timings['write'] = time.perf_counter() - start
+    start = time.perf_counter()
+    prep.submission_count(cube)
+    timings['submission_count'] = time.perf_counter() - start
+    start = time.perf_counter()
+    CountryCodes().resolve(select(cube, 'country'))
+    timings['resolve_countries'] = time.perf_counter() - start
+    return stage_result(timings, aggregate_rows=len(cube))
+
+
+def aggregate_stage(datahub, date, workers):
+    """
+    Summarise the downloaded snapshots in chunks across processes, checking that the data hub stats and aggregate table are
+    identical to those saved by the prepare stage
+    :param datahub: Name of data hub
+    :param date: Date of the snapshots (DDMMYYYY)
+    :param workers: Number of worker processes
+    :return: Result of the stage
+    """
+    from aggregates import to_cube
+    from parallel_aggregates import summarise_snapshot
+    from snapshot_store import to_table
+    from visualisation_prep import prepDf
+    prep = prepDf(date, argparse.Namespace(username=datahub, workers=1, retries=0, timeout=1, max_rate=None))
+    timings = {}
+    chunks = {}
+    worker_peaks = {}
+    statistics = {}
+    cube = []
+    for result_type in result_types:
+        start = time.perf_counter()
+        summary, details = summarise_snapshot(prep.store, date, result_type, workers)
+        timings['summarise_{}'.format(result_type)] = time.perf_counter() - start
+        chunks[result_type] = details['chunks']
+        worker_peaks[result_type] = details['worker_peak_mb']
+        statistics = prep.add_datahub_stats(statistics, result_type, summary)
+        cube.append(to_cube(summary[2], result_type))
+
+    # Compared as saved, so that the column types match those read back
+    stats = pd.DataFrame(list(statistics.items()), columns=['field', 'value'])
+    for name, df in [('Datahub_stats', stats), ('aggregates', pd.concat(cube, ignore_index=True))]:
+        if not to_table(df).equals(to_table(prep.store.read(name, date))):
+            raise ValueError('The {} summarised across {} processes differ from those of the prepare stage for {}'.format(name, workers, datahub))
+    return stage_result(timings, workers=workers, chunks=chunks, worker_peak_rss_mb=worker_peaks)
+
+
+def figures_stage(datahub, date, tolerance):
+    """
+    Build every figure of the application
+    :param datahub: Name of data hub
+    :param date: Date of the snapshots (DDMMYYYY)
+    :param tolerance: Simplification tolerance of the map polygons in degrees
+    :return: Result of the stage
+    """
+    import plotly
+    from geography import load_geometries
+    from plots import GeneratePlots, pie_variables
+    from responses import compact_figure, compress
+    from time_series import granularities
+    timings = {}
+    sizes = {}
+    compact_sizes = {}      # As sent by the application, rounded and then gzip compressed
+    gzip_sizes = {}
+    start = time.perf_counter()
+    load_geometries(tolerance)      # Once per process in the application, so timed apart from the map
+    timings['map_polygons'] = time.perf_counter() - start
+    start = time.perf_counter()
+    plots = GeneratePlots(datahub, date, tolerance)
+    timings['load'] = time.perf_counter() - start
+
+    figures = {'return_stats': [], 'submissions_map': [], 'pie_counts': []}
+    figures.update({'datahub_pie_{}'.format(variable): [variable] for variable in pie_variables})
+    for granularity in granularities:
+        figures['submissions_{}'.format(granularity)] = [granularity]
+        figures['cumulative_submissions_{}'.format(granularity)] = [granularity]
+    for figure_id, params in figures.items():
+        method = re.sub('_({})$'.format('|'.join(list(granularities) + pie_variables)), '', figure_id)
+        start = time.perf_counter()
+        figure = getattr(plots, method)(*params)
+        timings[figure_id] = time.perf_counter() - start
+        sizes[figure_id] = len(json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder))
+        content = json.dumps(compact_figure(figure), cls=plotly.utils.PlotlyJSONEncoder).encode('UTF-8')
+        compact_sizes[figure_id] = len(content)
+        gzip_sizes[figure_id] = len(compress(content, 'gzip'))
+    return stage_result(timings, figure_bytes=sizes, compact_figure_bytes=compact_sizes, gzip_figure_bytes=gzip_sizes)
+
+
+def run_stage(stage, args, date):
+    """
+    Run a stage in a process of its own, so that its peak memory is measured alone
+    :param stage: Name of the stage
+    :param args: Script arguments
+    :param date: Date of the snapshots (DDMMYYYY)
+    :return: Result of the stage
+    """
+    stage_output = os.path.join(args.directory, '{}.{}.json'.format(args.datahub, stage))
+    command = [sys.executable, os.path.realpath(__file__), '--stage', stage, '--datahub', args.datahub, '--stage-output', os.path.abspath(stage_output),
+               '--mode', args.mode, '--map-tolerance', str(args.map_tolerance), '--portal-url', args.portal_url or '', '--aggregate-workers', str(args.aggregate_workers)]
+    start = time.perf_counter()
+    process = subprocess.run(command, cwd=args.directory, stdout=subprocess.DEVNULL)
+    if process.returncode != 0:
+        raise RuntimeError('The {} stage failed for {}'.format(stage, args.datahub))
+    with open(stage_output) as f:
+        result = json.load(f)
+    os.remove(stage_output)
+    result['wall_seconds'] = round(time.perf_counter() - start, 4)     # Including starting Python and importing the modules
+    return result
+
+
+def start_portal(files):
+    """
+    Serve synthetic files from the mock portal, in a process of its own
+    :param files: Dictionary of result type to path of the file to serve
+    :return: Process of the mock portal and its URL
+    """
+    command = [sys.executable, '-u', os.path.join(scripts_directory, 'mock_portal.py'), '--port', '0']
+    for result_type, path in files.items():
+        command += ['-f', '{}={}'.format(result_type, path)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()        # Printed once the files are loaded
+    url = re.search(r'(http://\S+)', line)
+    if url is None:
+        process.kill()
+        raise RuntimeError('The mock portal did not start: {}'.format(line))
+    return process, url.group(1)
+
+
+def git_commit():
+    """
+    Obtain the commit of the code being benchmarked
+    :return: Commit hash, or None if not in a git repository
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=scripts_directory, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args, rows):
+    """
+    Benchmark each stage on a synthetic data hub
+    :param args: Script arguments
+    :param rows: Number of read_run records
+    :return: Dictionary of the results
+    """
+    args.datahub = 'dcc_benchmark{}'.format(rows)
+    date = datetime.date.today().strftime('%d%m%Y')
+
+    files = {}
+    start = time.perf_counter()
+    for result_type in result_types:
+        type_rows = rows if result_type == 'read_run' else max(rows // 4, 1)
+        files[result_type] = os.path.abspath(os.path.join(args.directory, 'synthetic', '{}_{}.tsv'.format(result_type, type_rows)))
+        if not os.path.exists(files[result_type]):
+            print('> Generating {:,} {} records...'.format(type_rows, result_type))
+            write_synthetic(result_type, type_rows, files[result_type])
+    generate_seconds = time.perf_counter() - start
+
+    stages = {}
+    portal, args.portal_url = start_portal(files)
+    try:
+        for stage in stage_names:
+            print('> Running the {} stage for {:,} records...'.format(stage, rows))
+            stages[stage] = run_stage(stage, args, date)
+    finally:
+        portal.terminate()
+        portal.wait()
+    return {'rows': rows, 'mode': args.mode, 'map_tolerance': args.map_tolerance, 'aggregate_workers': args.aggregate_workers, 'generate_seconds': round(generate_seconds, 4), 'stages': stages}
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.stage is not None:
+        date = datetime.date.today().strftime('%d%m%Y')
+        if args.stage == 'fetch':
+            result = fetch_stage(args.datahub, args.portal_url, args.mode)
+        elif args.stage == 'prepare':
+            result = prepare_stage(args.datahub, date)
+        elif args.stage == 'aggregate':
+            result = aggregate_stage(args.datahub, date, args.aggregate_workers)
+        else:
+            result = figures_stage(args.datahub, date, args.map_tolerance)
+        with open(args.stage_output, 'w') as f:
+            json.dump(result, f)
+        sys.exit(0)
+
+    print('---> Benchmarking...')
+    os.makedirs(os.path.join(args.directory, 'synthetic'), exist_ok=True)
+    os.makedirs(os.path.join(args.directory, 'data'), exist_ok=True)
+    output = args.output or os.path.join(args.directory, 'benchmark_results.json')
+    run = {'commit': git_commit(), 'started': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+           'pandas': pd.__version__, 'results': [benchmark(args, rows) for rows in args.rows]}
+
+    # Results of each run are kept, so that they can be compared between commits
+    runs = []
+    if os.path.exists(output):
+        with open(output) as f:
+            runs = json.load(f)
+    runs.append(run)
+    with open(output, 'w') as f:
+        json.dump(runs, f, indent=1)
+
+    table = [[result['rows'], stage, step, seconds, details['peak_rss_mb']]
+             for result in run['results'] for stage, details in result['stages'].items() for step, seconds in details['timings'].items()]
+    print(pd.DataFrame(table, columns=['rows', 'stage', 'step', 'seconds', 'stage_peak_rss_mb']).to_string(index=False))
+    print('---> Benchmarking... [COMPLETED] Results added to {}'.format(output))
@@ -3,9 +3,14 @@
 
 __author__ = 'Nadim Rahman'
 
+from concurrent.futures import ThreadPoolExecutor
 from requests.auth import HTTPBasicAuth
+from portal_client import PortalClient
+from instrumentation import spans
+from snapshot_store import SnapshotStore, categorical_columns, csv_types, date_columns, typed
+from result_types import result_types
 import pandas as pd
-import argparse, datetime, io, os, requests
+import argparse, datetime, io, resource, time
 
 
 def get_args():
@@ -23,46 +28,81 @@ def get_args():
         """)
     parser.add_argument('-u', '--username', help='Data Hub username (e.g. dcc_XXXXX)', type=str, required=True)
     parser.add_argument('-p', '--password', help='Password for the data hub', type=str, required=True)
+    parser.add_argument('-s', '--stream', help='Stream the search results to file in chunks, rather than buffering the whole response', action='store_true')
+    parser.add_argument('-c', '--chunk-rows', help='Maximum number of rows held in memory at once when streaming (default: 100000)', type=int, default=100000)
+    parser.add_argument('--parallel', help='Fetch the search results as pages of --page-size rows, concurrently', action='store_true')
+    parser.add_argument('--page-size', help='Number of rows per page when fetching in parallel (default: 50000)', type=int, default=50000)
+    parser.add_argument('--workers', help='Number of pages fetched at once when fetching in parallel (default: 4)', type=int, default=4)
+    parser.add_argument('-i', '--incremental', help='Only fetch records created since the latest saved search results, and merge them in', action='store_true')
+    parser.add_argument('--overlap-days', help='Number of days before the latest saved record to fetch again when running incrementally (default: 3)', type=int, default=3)
+    parser.add_argument('--timeout', help='Longest wait for data from the Portal API before retrying, in seconds (default: 300)', type=float, default=300)
+    parser.add_argument('--retries', help='Number of times a failed request is retried, with exponential backoff (default: 5)', type=int, default=5)
+    parser.add_argument('--portal-url', help='Base URL of the Portal API (default: {})'.format(PORTAL_API_URL), type=str, default=PORTAL_API_URL)
     args = parser.parse_args()
     return args
 
 
-# Dictionary containing all the search criteria for the CoV data types
-ena_searches = {
-    'run': {'search_fields': ['experiment_accession', 'study_accession', 'study_title', 'sample_accession', 'experiment_title', 'country', 'collection_date', 'center_name', 'broker_name', 'tax_id', 'scientific_name', 'instrument_platform', 'instrument_model', 'library_layout', 'library_name', 'library_selection', 'library_source', 'library_strategy', 'first_public', 'first_created'], 'result_type': 'read_run', 'data_portal': 'pathogen', 'authentication': 'True'},
-    'analysis': {'search_fields': ['analysis_accession', 'analysis_title', 'analysis_type', 'study_accession', 'study_title', 'sample_accession', 'center_name', 'first_public', 'first_created', 'tax_id', 'scientific_name', 'pipeline_name', 'pipeline_version', 'country', 'collection_date'], 'result_type': 'analysis', 'data_portal': 'pathogen', 'authentication': 'True'}
-}
+def peak_memory_mb():
+    """
+    Obtain the peak resident memory of the current process
+    :return: Peak resident set size in megabytes
+    """
+    try:
+        # Unlike ru_maxrss, this is not carried over from the parent process when a script is started by another
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:')) / 1024
+    except (OSError, StopIteration):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024       # ru_maxrss is reported in kilobytes on Linux
+
+
+def as_text(values):
+    """
+    Convert a column parsed as numbers back to text, as in the search results
+    :param values: Series of values
+    :return: Series of strings, keeping missing values
+    """
+    if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 == 0).all():
+        values = values.astype('Int64')     # Whole numbers parsed as floats because of missing values (e.g. years), written without a decimal point
+    return values.astype(str).where(values.notna())
+
+
+def merge_delta(previous, delta):
+    """
+    Merge newly fetched records into saved search results, newly fetched records replacing the saved ones
+    :param previous: Data frame of the saved search results, as read from the snapshot
+    :param delta: Data frame of the newly fetched records, as parsed from the search results
+    :return: Data frame
+    """
+    delta = typed(delta)
+    previous = previous.copy()
+    for column in previous.columns.intersection(delta.columns):
+        if column in categorical_columns or column in date_columns or previous[column].dtype == delta[column].dtype:
+            continue
+        if pd.api.types.is_numeric_dtype(previous[column]) and pd.api.types.is_numeric_dtype(delta[column]):
+            continue        # e.g. integers and floats, which are concatenated as floats
+        # Other columns are typed by their values when parsed (e.g. collection_date holding only years is parsed as integers), so are merged as text
+        previous[column], delta[column] = as_text(previous[column]), as_text(delta[column])
+    # The accession of the result type is the first column
+    return pd.concat([previous, delta], ignore_index=True).drop_duplicates(subset=previous.columns[0], keep='last')
+
+
+PORTAL_API_URL = 'https://www.ebi.ac.uk/ena/portal/api'
 
 class retrieve_data:
-    def __init__(self, ena_search, username, password):
+    def __init__(self, ena_search, username, password, portal_url=PORTAL_API_URL, client=None):
         self.ena_search = ena_search        # A dictionary of that includes: query and result type (to search), data portal (to search in) and search fields to return
         self.username = username
         self.password = password
-        self.BASE_PORTAL_API_SEARCH_URL = 'https://www.ebi.ac.uk/ena/portal/api/search'
+        self.client = client if client is not None else PortalClient()      # Can be shared by the result types, to reuse its connections
+        self.store = SnapshotStore(username)        # Search results are saved as snapshots of the data hub
+        self.snapshot_name = 'ENA_Search_{}'.format(ena_search['result_type'])
+        self.labels = {'datahub': username, 'result_type': ena_search['result_type']}       # Labels of the timing spans
+        self.BASE_PORTAL_API_SEARCH_URL = '{}/search'.format(portal_url)
+        self.BASE_PORTAL_API_COUNT_URL = '{}/count'.format(portal_url)
         self.ena_headers = {
             'accept': '*/*',
         }       # Define headers for the requests
 
-    def req(URL, headers, params, user="", password=""):
-        """
-        Run a request and retrieve the output
-        :param URL: URL used for the search
-        :param headers: Headers to be used in the search
-        :param params: Parameters for the request
-        :param user: Username (only if authentication required)
-        :param password: Username password (only if authentication required)
-        :return: A response object with the results of the search
-        """
-        if user == "":
-            # If a username was not provided
-            response = requests.get(URL, headers=headers, params=params)  # No authentication required in the query
-        else:
-            # If a username was provided
-            response = requests.get(URL, headers=headers, params=params,
-                                    auth=HTTPBasicAuth(user, password))  # Authentication required in the query
-            print(response.url)
-        return response
-
     def build_request_params(**kwargs):
         """
         Build parameters for the request search
@@ -78,37 +118,238 @@ class retrieve_data:
                 search_params[key] = value
         return search_params
 
+    def save(self, df):
+        """
+        Save search results as today's snapshot
+        :param df: Data frame of search results
+        :return: Path to the snapshot file
+        """
+        return self.store.write(df, self.snapshot_name, datetime.date.today().strftime('%d%m%Y'))
+
+    def search_params(self, created_since=None, **kwargs):
+        """
+        Build the parameters for the search of this result type
+        :param created_since: Only search for records created on or after this date (YYYY-MM-DD)
+        :param kwargs: Any additional parameters for the request (e.g. limit)
+        :return: A dictionary of the parameters to be used in the request search
+        """
+        query = self.ena_search.get('query')
+        if created_since is not None:
+            since = 'first_created>={}'.format(created_since)
+            query = since if query is None else '({}) AND {}'.format(query, since)
+        if query is not None:
+            kwargs['query'] = query
+        if 'authentication' in self.ena_search.keys():
+            # If there is an authentication flag for the result type to search for
+            kwargs['dccDataOnly'] = True
+        return retrieve_data.build_request_params(dataPortal=self.ena_search['data_portal'],
+                                                  fields=self.ena_search['search_fields'],
+                                                  result=self.ena_search['result_type'],
+                                                  **kwargs)  # Create the parameter tuple
+
+    def auth(self):
+        """
+        Obtain the authentication for requests of this result type
+        :return: Authentication object, or None if authentication is not required
+        """
+        if 'authentication' in self.ena_search.keys():
+            return HTTPBasicAuth(self.username, self.password)
+        return None
+
+    def run_search(self, stream=False, created_since=None, validators=None):
+        """
+        Build the search parameters and send the search request
+        :param stream: Whether to defer downloading the response body until it is read
+        :param created_since: Only search for records created on or after this date (YYYY-MM-DD)
+        :param validators: Validators of the saved search results, to only download the results if they have changed
+        :return: A response object with the results of the search
+        """
+        self.ena_search_params = self.search_params(created_since, limit=0)
+        print(self.ena_search_params)
+        self.ena_search_result = self.client.get(self.BASE_PORTAL_API_SEARCH_URL, self.ena_search_params, self.ena_headers,
+                                                 self.auth(), stream=stream, validators=validators)      # Search the query
+        return self.ena_search_result
+
+    def search_key(self):
+        """
+        Obtain the key that the validators of the full search results are saved under
+        :return: Key of the search
+        """
+        return '{} {}'.format(self.username, PortalClient.request_key(self.BASE_PORTAL_API_SEARCH_URL, self.search_params(limit=0)))
+
+    def saved_validators(self):
+        """
+        Obtain the validators of the last full search results, if the snapshot they were saved to still exists
+        :return: Dictionary of validators and the date of the snapshot, or None
+        """
+        validators = self.client.validators(self.search_key())
+        if validators is None or self.store.find(self.snapshot_name, validators['date']) is None:
+            return None
+        return validators
+
     def coordinate_retrieval(self):
         """
-        Run the retrieval of ENA data
+        Run the retrieval of ENA data, reusing the saved search results if they have not changed
         :return: Data frame
         """
-        today = datetime.date.today()
-        date = today.strftime('%d%m%Y')
         print('> Running data request... [{}]'.format(datetime.datetime.now()))
-        if 'authentication' in self.ena_search.keys():
-            # If there is an authentication flag for the result type to search for
-            self.ena_search_params = retrieve_data.build_request_params(dataPortal=self.ena_search['data_portal'],
-                                                          fields=self.ena_search['search_fields'],
-                                                          result=self.ena_search['result_type'],
-                                                          dccDataOnly=True,
-                                                          limit=0)  # Create the parameter tuple
-            print(self.ena_search_params)
-            self.ena_search_result = retrieve_data.req(self.BASE_PORTAL_API_SEARCH_URL, self.ena_headers, self.ena_search_params, self.username, self.password)
+        validators = self.saved_validators()
+        with spans.span('fetch', **self.labels):
+            self.run_search(validators=validators)
+        if self.ena_search_result.status_code == 304:
+            print('> Search results have not changed since {}, reusing them'.format(validators['date']))
+            with spans.span('read', **self.labels):
+                self.ena_results = self.store.read(self.snapshot_name, validators['date'])
         else:
-            self.ena_search_params = retrieve_data.build_request_params(dataPortal=self.ena_search['data_portal'],
-                                                          fields=self.ena_search['search_fields'],
-                                                          query=self.ena_search['query'],
-                                                          result=self.ena_search['result_type'],
-                                                          limit=0)
-            print(self.ena_search_params)
-            self.ena_search_result = retrieve_data.req(self.BASE_PORTAL_API_SEARCH_URL, self.ena_headers, self.ena_search_params)      # Search the query
-        self.ena_results = pd.read_csv(io.StringIO(self.ena_search_result.content.decode('UTF-8')), sep="\t")      # Save results in a dataframe
-        output_file = os.path.join('data', '{}_ENA_Search_{}_{}.txt'.format(self.username, self.ena_search['result_type'], date))
-        self.ena_results.to_csv(output_file, sep="\t", index=False)      # Save search results to a dataframe
+            self.ena_search_result.raise_for_status()       # Avoid saving an error page as search results
+            with spans.span('parse', **self.labels):
+                self.ena_results = pd.read_csv(io.BytesIO(self.ena_search_result.content), sep="\t", dtype=csv_types)      # Save results in a dataframe, without a decoded copy of the body
+        with spans.span('write', **self.labels):
+            self.save(self.ena_results)      # Save search results to a snapshot
+        self.client.remember(self.search_key(), self.ena_search_result, date=datetime.date.today().strftime('%d%m%Y'))
         print('> Running data request... [DONE] [{}]'.format(datetime.datetime.now()))
         return self.ena_results
 
+    def delta_retrieval(self, overlap_days=3):
+        """
+        Run the retrieval of ENA data created since the latest saved search results, and merge it into them.
+        Records that have been suppressed or changed since their creation are only picked up by a full retrieval.
+        :param overlap_days: Number of days before the latest saved record to fetch again
+        :return: Data frame
+        """
+        previous_date = self.store.latest(self.snapshot_name)
+        if previous_date is None:
+            print('> No saved search results for {}, running a full data request'.format(self.ena_search['result_type']))
+            return self.coordinate_retrieval()
+
+        print('> Running incremental data request... [{}]'.format(datetime.datetime.now()))
+        with spans.span('read', **self.labels):
+            previous = self.store.read(self.snapshot_name, previous_date)
+        latest = pd.to_datetime(previous['first_created']).max()
+        created_since = (latest - datetime.timedelta(days=overlap_days)).strftime('%Y-%m-%d')
+        with spans.span('fetch', **self.labels):
+            self.run_search(created_since=created_since)
+        self.ena_search_result.raise_for_status()
+        with spans.span('parse', **self.labels):
+            delta = pd.read_csv(io.BytesIO(self.ena_search_result.content), sep="\t", dtype=csv_types)      # Parsed as by a full retrieval
+        with spans.span('merge', **self.labels):
+            self.ena_results = merge_delta(previous, delta)
+        with spans.span('write', **self.labels):
+            self.save(self.ena_results)      # Save search results to a snapshot
+        print('> Running incremental data request... [DONE] [{}] [{:,} records since {}, {:,} new]'.format(
+            datetime.datetime.now(), len(delta), created_since, len(self.ena_results) - len(previous)))
+        return self.ena_results
+
+    def stream_retrieval(self, chunk_rows=100000):
+        """
+        Run the retrieval of ENA data, parsing and saving the response in chunks as it is downloaded.
+        If the search results have not changed, the saved search results are read in chunks instead.
+        :param chunk_rows: Maximum number of rows to hold in memory at once
+        :return: Generator of data frame chunks, each of at most chunk_rows rows
+        """
+        print('> Streaming data request... [{}]'.format(datetime.datetime.now()))
+        start = time.perf_counter()
+        validators = self.saved_validators()
+        with spans.span('fetch', **self.labels):
+            response = self.run_search(stream=True, validators=validators)
+        if response.status_code == 304:
+            print('> Search results have not changed since {}, reusing them'.format(validators['date']))
+            chunks = self.store.chunks(self.snapshot_name, validators['date'], chunk_rows)
+        else:
+            response.raise_for_status()     # Avoid writing an error page out as search results
+            response.raw.decode_content = True      # Decompress the body if the server applied a transfer encoding
+            # Values are parsed as strings so that every chunk is typed the same way when written
+            chunks = pd.read_csv(response.raw, sep="\t", dtype=str, chunksize=chunk_rows)
+
+        date = datetime.date.today().strftime('%d%m%Y')
+        with response, self.store.writer(self.snapshot_name, date) as writer:
+            # Chunks are parsed as they are downloaded, so the download of the body is timed with the parsing
+            waited = time.perf_counter()
+            for chunk in chunks:
+                spans.add('parse', time.perf_counter() - waited, **self.labels)
+                with spans.span('write', **self.labels):
+                    writer.write(chunk)
+                yield chunk
+                waited = time.perf_counter()
+        self.client.remember(self.search_key(), response, date=date)
+        rows = writer.rows
+
+        elapsed = time.perf_counter() - start
+        print('> Streaming data request... [DONE] [{}] [{:,} rows, {:,.0f} rows/sec, peak memory {:,.1f} MB]'.format(
+            datetime.datetime.now(), rows, rows / elapsed if elapsed else 0, peak_memory_mb()))
+
+    def count_results(self):
+        """
+        Obtain the total number of records that the search returns
+        :return: Number of records
+        """
+        params = self.search_params()
+        del params['fields']        # Fields are not accepted by the count endpoint
+        with spans.span('fetch', **self.labels):
+            response = self.client.get(self.BASE_PORTAL_API_COUNT_URL, params, self.ena_headers, self.auth())
+        response.raise_for_status()
+        return int(response.text.strip().splitlines()[-1])     # The count is the last line, whether or not a header is included
+
+    def fetch_page(self, offset, page_size):
+        """
+        Fetch a single page of search results
+        :param offset: Index of the first record in the page
+        :param page_size: Maximum number of records in the page
+        :return: Data frame of the page of results
+        """
+        with spans.span('fetch', **self.labels):
+            response = self.client.get(self.BASE_PORTAL_API_SEARCH_URL, self.search_params(offset=offset, limit=page_size),
+                                       self.ena_headers, self.auth())
+        response.raise_for_status()
+        with spans.span('parse', **self.labels):
+            return pd.read_csv(io.BytesIO(response.content), sep="\t", dtype=str)
+
+    def reassemble(self, pages, total, page_size):
+        """
+        Join pages of results back together, checking that no records are missing or duplicated
+        :param pages: Dictionary of page offset to data frame of the page
+        :param total: Total number of records expected
+        :param page_size: Number of records requested per page
+        :return: Data frame of all results, in offset order
+        """
+        if not pages:
+            return pd.DataFrame(columns=self.ena_search['search_fields'])
+        incomplete = ['{} ({} of {} rows)'.format(offset, len(page), min(page_size, total - offset))
+                      for offset, page in pages.items() if len(page) != min(page_size, total - offset)]
+        if incomplete:
+            raise RuntimeError('Pages at offsets {} are incomplete, the results may have changed during retrieval'.format(', '.join(incomplete)))
+
+        results = pd.concat([pages[offset] for offset in sorted(pages)], ignore_index=True)
+        duplicated = results.iloc[:, 0].duplicated()        # The accession of the result type is the first column
+        if duplicated.any():
+            raise RuntimeError('{} records were returned in more than one page (e.g. {}), the results may have changed during retrieval'.format(
+                duplicated.sum(), results.iloc[:, 0][duplicated].iloc[0]))
+        return results
+
+    def paginated_retrieval(self, page_size=50000, workers=4):
+        """
+        Run the retrieval of ENA data as pages of results, fetched concurrently
+        :param page_size: Number of records per page
+        :param workers: Number of pages to fetch at once
+        :return: Data frame
+        """
+        print('> Running paginated data request... [{}]'.format(datetime.datetime.now()))
+        start = time.perf_counter()
+        total = self.count_results()
+        offsets = range(0, total, page_size)
+        print('> {:,} records to retrieve in {} pages'.format(total, len(offsets)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pages = dict(zip(offsets, pool.map(lambda offset: self.fetch_page(offset, page_size), offsets)))
+
+        with spans.span('merge', **self.labels):
+            self.ena_results = self.reassemble(pages, total, page_size)
+        with spans.span('write', **self.labels):
+            self.save(self.ena_results)      # Save search results to a snapshot
+        elapsed = time.perf_counter() - start
+        print('> Running paginated data request... [DONE] [{}] [{:,} rows, {:,.0f} rows/sec]'.format(
+            datetime.datetime.now(), len(self.ena_results), len(self.ena_results) / elapsed if elapsed else 0))
+        return self.ena_results
+
 
 if __name__ == '__main__':
     args = get_args()
@@ -116,7 +357,18 @@ if __name__ == '__main__':
     today = datetime.date.today()
     date = today.strftime('%d%m%Y')
 
-    # Get ENA read data within the datahub
-    for key, value in ena_searches.items():
-        data_retrieval = retrieve_data(ena_searches[key], args.username, args.password)     # Instantiate class with information
-        ena_results = data_retrieval.coordinate_retrieval()
\ No newline at end of file
+    # Get ENA read data within the datahub, with connections to the Portal API shared by the result types
+    client = PortalClient(pool_size=args.workers, retries=args.retries, read_timeout=args.timeout)
+    for key, value in result_types.items():
+        data_retrieval = retrieve_data(value, args.username, args.password, args.portal_url, client)     # Instantiate class with information
+        if args.incremental:
+            ena_results = data_retrieval.delta_retrieval(args.overlap_days)
+        elif args.parallel:
+            ena_results = data_retrieval.paginated_retrieval(args.page_size, args.workers)
+        elif args.stream:
+            for chunk in data_retrieval.stream_retrieval(args.chunk_rows):
+                pass        # Chunks are written to file as they are consumed
+        else:
+            ena_results = data_retrieval.coordinate_retrieval()
+    print('> Portal API: {}'.format(client.summary()))
+    client.close()
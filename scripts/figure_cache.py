@@ -0,0 +1,83 @@
+#!/usr/bin/env/python3
+# This script handles the caching of figures built for the application
+
+__author__ = 'Nadim Rahman'
+
+from collections import OrderedDict
+import datetime, threading
+
+
+def snapshot_order(date):
+    """
+    Obtain a sortable form of a snapshot date
+    :param date: Date of the snapshot (DDMMYYYY)
+    :return: Date object
+    """
+    return datetime.datetime.strptime(date, '%d%m%Y').date()
+
+
+class FigureCache:
+    """
+    Bounded cache of built figures, keyed by (datahub, snapshot date, figure id, parameters), evicting the least recently used.
+    Figures of a data hub are dropped once a figure for a newer snapshot of it is cached, and figures of older snapshots are
+    not cached after that.
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.figures = OrderedDict()
+        self.latest = {}        # Data hub -> date of the newest snapshot figures were cached for
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, datahub, date, figure_id, build, *params):
+        """
+        Obtain a figure, building it if it is not cached
+        :param datahub: Name of data hub
+        :param date: Date of the snapshot the figure is built from (DDMMYYYY)
+        :param figure_id: Name of the figure (e.g. 'map')
+        :param build: Function to build the figure, called with the parameters
+        :param params: Parameters of the figure (e.g. the pie chart variable)
+        :return: Figure
+        """
+        key = (datahub, date, figure_id) + params
+        with self.lock:
+            if key in self.figures:
+                self.figures.move_to_end(key)
+                self.hits += 1
+                return self.figures[key]
+            self.misses += 1
+
+        figure = build(*params)     # Built outside of the lock, so that other figures can be served meanwhile
+        with self.lock:
+            if datahub in self.latest and snapshot_order(date) < snapshot_order(self.latest[datahub]):
+                return figure       # Of a snapshot read before the switch to a newer one, which is not cached again
+            self.invalidate(datahub, before=date)
+            self.latest[datahub] = date
+            self.figures[key] = figure
+            while len(self.figures) > self.maxsize:
+                self.figures.popitem(last=False)
+        return figure
+
+    def invalidate(self, datahub=None, before=None):
+        """
+        Drop cached figures
+        :param datahub: Name of data hub to drop figures of (default: all data hubs)
+        :param before: Only drop figures of snapshots older than this date (DDMMYYYY)
+        :return:
+        """
+        with self.lock:
+            for key in list(self.figures):
+                if datahub is not None and key[0] != datahub:
+                    continue
+                if before is not None and snapshot_order(key[1]) >= snapshot_order(before):
+                    continue
+                del self.figures[key]
+
+    def stats(self):
+        """
+        Obtain the usage of the cache
+        :return: Dictionary of the number of cached figures, hits and misses
+        """
+        with self.lock:
+            return {'size': len(self.figures), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,158 @@
+#!/usr/bin/env/python3
+# This script handles the filtering of a data hub snapshot by submission date and by facets (e.g. country or platform)
+
+__author__ = 'Nadim Rahman'
+
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from aggregates import day_periods, dimension_values, to_cube
+import threading
+
+
+def make_filters(first_created=None, **facets):
+    """
+    Create the key of a set of filters, which the counts of the filtered records are cached by
+    :param first_created: Tuple of the first and last day of submission to keep ('YYYY-MM-DD', either may be None)
+    :param facets: Values to keep per dimension (e.g. country=['Germany'])
+    :return: Tuple of (dimension, values) pairs, empty if nothing is filtered
+    """
+    filters = []
+    if first_created is not None and any(first_created):
+        filters.append(('first_created', tuple(date[:10] if date else None for date in first_created)))        # Dates may be given with a time
+    for dimension, values in sorted(facets.items()):
+        if values:
+            values = [values] if isinstance(values, str) else values
+            filters.append((dimension, tuple(sorted(set(values)))))
+    return tuple(filters)
+
+
+def day_period(date):
+    """
+    Convert a date to an integer daily period
+    :param date: Date ('YYYY-MM-DD')
+    :return: Days since 1 January 1970
+    """
+    return (pd.Timestamp(date) - pd.Timestamp('1970-01-01')).days
+
+
+class FilterIndex:
+    """
+    Index of the records of a result type, to count the records matching a set of filters without scanning every record.
+    Records are sorted by submission date, so that a date range is a slice of rows, and the rows of each value of a facet
+    are kept as a sorted array of row ids. Filters are combined by intersecting rows, and the counts are cached by filter key.
+    """
+    def __init__(self, df, dimensions, result_type='read_run', cache_size=32):
+        self.dimensions = dimensions        # Dimensions counted, as in the aggregate table
+        self.result_type = result_type
+        self.cache_size = cache_size
+        self.cache = OrderedDict()      # Filter key -> aggregate table rows of the filtered records
+        self.lock = threading.Lock()
+
+        days = day_periods(df['first_created']).to_numpy(dtype='float64')
+        order = np.argsort(days, kind='stable')       # Records without a submission date are sorted last
+        self.days = days[order]
+        self.dated = int(np.count_nonzero(~np.isnan(self.days)))      # Number of records with a submission date
+        self.first_day = int(self.days[0]) if self.dated else 0
+
+        self.labels = {}        # Facet -> Index of values
+        self.codes = {}     # Facet -> value code of each record (-1 where there is no value), in date order
+        self.rows = {}      # Facet -> (row ids sorted by value code, offset of the row ids of each value code)
+        for dimension in dimensions:
+            if dimension == 'day':
+                continue
+            codes, labels = pd.factorize(dimension_values(df, dimension).iloc[order])
+            codes = codes.astype(np.int16 if len(labels) < np.iinfo(np.int16).max else np.int32)
+            row_ids = np.argsort(codes, kind='stable').astype(np.int32)        # Row ids of each value stay in date order
+            self.labels[dimension] = pd.Index(labels.astype(str))
+            self.codes[dimension] = codes
+            self.rows[dimension] = (row_ids, np.searchsorted(codes[row_ids], np.arange(len(labels) + 1)))
+
+    def memory_usage(self):
+        """
+        Obtain the memory held by the index
+        :return: Memory in bytes
+        """
+        return int(self.days.nbytes + sum(codes.nbytes for codes in self.codes.values()) +
+                   sum(row_ids.nbytes + offsets.nbytes for row_ids, offsets in self.rows.values()))
+
+    def facet_rows(self, dimension, values):
+        """
+        Obtain the rows with any of the values of a facet
+        :param dimension: Facet to filter on
+        :param values: Values to keep
+        :return: Sorted array of row ids
+        """
+        if dimension not in self.rows:
+            raise ValueError('Cannot filter {} records on {}, only on first_created and {}'.format(self.result_type, dimension, ', '.join(self.rows)))
+        row_ids, offsets = self.rows[dimension]
+        parts = [row_ids[offsets[code]:offsets[code + 1]] for code in self.labels[dimension].get_indexer(list(values)) if code >= 0]
+        if len(parts) == 1:
+            return parts[0]
+        return np.sort(np.concatenate(parts)) if parts else np.array([], dtype=np.int32)
+
+    def select(self, filters):
+        """
+        Select the rows matching a set of filters
+        :param filters: Filter key (from make_filters())
+        :return: Slice of rows if only the submission date is filtered on, otherwise a sorted array of row ids
+        """
+        start, stop = 0, len(self.days)
+        selections = []
+        for dimension, values in filters:
+            if dimension == 'first_created':
+                first, last = values
+                stop = self.dated       # Records without a submission date are outside of any range
+                if first:
+                    start = int(np.searchsorted(self.days[:self.dated], day_period(first), 'left'))
+                if last:
+                    stop = int(np.searchsorted(self.days[:self.dated], day_period(last), 'right'))
+            else:
+                selections.append(self.facet_rows(dimension, values))
+        if not selections:
+            return slice(start, max(start, stop))
+
+        selections.sort(key=len)        # Intersect from the most selective facet
+        rows = selections[0]
+        rows = rows[(rows >= start) & (rows < stop)]
+        for other in selections[1:]:
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows
+
+    def count(self, rows):
+        """
+        Count the selected rows per value of each dimension
+        :param rows: Slice or array of row ids
+        :return: Dictionary of dimension to Series of counts, indexed by value (by integer period for 'day')
+        """
+        counts = {}
+        for dimension in self.dimensions:
+            if dimension == 'day':
+                days = self.days[rows]
+                days = (days[~np.isnan(days)] - self.first_day).astype(np.int64)
+                values = np.bincount(days)
+                index = np.flatnonzero(values)
+                counts[dimension] = pd.Series(values[index], index=index + self.first_day)
+            else:
+                codes = self.codes[dimension][rows]
+                values = pd.Series(np.bincount(codes[codes >= 0], minlength=len(self.labels[dimension])), index=self.labels[dimension])
+                counts[dimension] = values[values > 0]
+        return counts
+
+    def counts(self, filters):
+        """
+        Count the records matching a set of filters, per value of each dimension
+        :param filters: Filter key (from make_filters())
+        :return: Data frame of the aggregate table rows of the matching records
+        """
+        with self.lock:
+            if filters in self.cache:
+                self.cache.move_to_end(filters)
+                return self.cache[filters]
+
+        cube = to_cube(self.count(self.select(filters)), self.result_type)
+        with self.lock:
+            self.cache[filters] = cube
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return cube
@@ -0,0 +1,284 @@
+#!/usr/bin/env/python3
+# This script handles the resolution of country names to the codes used in the map
+
+__author__ = 'Nadim Rahman, Carla Cummins'
+
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import argparse, glob, json, os, time
+
+geojson_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'assets', 'custom_with_ids.geo.json')       # Polygons for each country, with ISO3 codes as the feature ids
+simplify_version = 1        # Increase when simplify_geometry() changes, so that the saved simplified polygons are not used
+countries_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'assets', 'countries.json')       # Name and continent of each country, precomputed from pycountry
+
+# these countries are not named according to their official pycountry names
+# we need to include custom mapping
+custom_codes = {
+    'Russia': 'RUS', 'USA': 'USA', 'Czech Republic': 'CZE', 'South Korea': 'KOR',
+    'State of Palestine': 'PSE', 'Iran': 'IRN', 'West Bank': 'PSE'
+}
+
+
+def get_args():
+    """
+    Handle script arguments
+    :return: Script arguments
+    """
+    parser = argparse.ArgumentParser(prog='geography.py', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="""
+        + =========================================================== +
+        |  ENA Data Hubs Dashboard: geography.py                      |
+        |  Python script to simplify the map polygons and compare     |
+        |  the size of the map for each level of simplification, and  |
+        |  to rebuild the table of countries.                         |
+        + =========================================================== +
+        """)
+    parser.add_argument('-u', '--username', help='Data Hub username (e.g. dcc_XXXXX)', type=str)
+    parser.add_argument('-d', '--date', help='Date of the snapshot to create the map for (DDMMYYYY)', type=str)
+    parser.add_argument('-t', '--tolerance', help='Simplification tolerances to compare, in degrees (default: 0.01 0.05 0.1)', type=float, nargs='+', default=[0.01, 0.05, 0.1])
+    parser.add_argument('--countries', help='Rebuild the table of countries (assets/countries.json) from pycountry and pycountry-convert, rather than comparing map figures', action='store_true')
+    args = parser.parse_args()
+    if not args.countries and (args.username is None or args.date is None):
+        parser.error('the following arguments are required to compare map figures: -u/--username, -d/--date')
+    return args
+
+
+def simplify_ring(points, tolerance):
+    """
+    Simplify a ring of a polygon with the Ramer-Douglas-Peucker algorithm
+    :param points: List of [longitude, latitude] points, the first and last being the same
+    :param tolerance: Maximum distance of a removed point from the simplified ring, in degrees
+    :return: List of the points that are kept
+    """
+    points = np.asarray(points, dtype=float)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    sections = [(0, len(points) - 1)]
+    while sections:
+        start, end = sections.pop()
+        if end - start < 2:
+            continue
+        inner = points[start + 1:end]
+        direction = points[end] - points[start]
+        length = np.hypot(*direction)
+        if length == 0:
+            distances = np.hypot(*(inner - points[start]).T)        # The section is closed, use the distance from its end points
+        else:
+            distances = np.abs(direction[0] * (points[start][1] - inner[:, 1]) - direction[1] * (points[start][0] - inner[:, 0])) / length
+        furthest = int(np.argmax(distances))
+        if distances[furthest] > tolerance:
+            keep[start + 1 + furthest] = True
+            sections += [(start, start + 1 + furthest), (start + 1 + furthest, end)]
+    return np.round(points[keep], 5).tolist()
+
+
+def as_polygons(geometry):
+    """
+    Obtain the polygons of a Polygon or MultiPolygon geometry
+    :param geometry: GeoJSON geometry
+    :return: List of polygons, each a list of rings
+    """
+    return geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+
+
+def simplify_geometry(geometry, tolerance):
+    """
+    Simplify a Polygon or MultiPolygon geometry, dropping rings which would collapse
+    :param geometry: GeoJSON geometry
+    :param tolerance: Maximum distance of a removed point from the simplified rings, in degrees
+    :return: Simplified GeoJSON geometry
+    """
+    polygons = as_polygons(geometry)
+    simplified = []
+    for polygon in polygons:
+        rings = [simplify_ring(ring, tolerance) for ring in polygon]
+        if len(rings[0]) < 4:
+            continue        # The outer ring collapses at this tolerance (e.g. a small island)
+        simplified.append([rings[0]] + [ring for ring in rings[1:] if len(ring) >= 4])
+    if not simplified:
+        simplified = [[simplify_ring(polygon[0], 0)] for polygon in polygons[:1]]     # Always keep the country on the map
+    return {'type': 'MultiPolygon', 'coordinates': simplified}
+
+
+@lru_cache(maxsize=None)
+def load_geometries(tolerance=None):
+    """
+    Load the polygons of each country, once per process for each tolerance.
+    Simplified polygons are saved in the data directory, so they are only simplified once for each version of the
+    polygons (by modification time and size) and of the simplification.
+    :param tolerance: Simplification tolerance in degrees (default: no simplification)
+    :return: Dictionary of ISO3 code to GeoJSON feature, without properties
+    """
+    if tolerance:
+        source = os.stat(geojson_path)
+        simplified_path = os.path.join('data', 'custom_with_ids.geo.{}.{:x}-{:x}-v{}.json'.format(tolerance, source.st_mtime_ns, source.st_size, simplify_version))
+        if os.path.exists(simplified_path):
+            with open(simplified_path) as json_file:
+                return json.load(json_file)
+
+    with open(geojson_path) as json_file:
+        countries = json.load(json_file)
+    features = {}
+    for feature in countries['features']:
+        geometry = simplify_geometry(feature['geometry'], tolerance) if tolerance else feature['geometry']
+        if feature['id'] in features:
+            # A country split over several features, join them together
+            previous = features[feature['id']]['geometry']
+            geometry = {'type': 'MultiPolygon', 'coordinates': as_polygons(previous) + as_polygons(geometry)}
+        features[feature['id']] = {'type': 'Feature', 'id': feature['id'], 'geometry': geometry}
+
+    if tolerance:
+        os.makedirs('data', exist_ok=True)
+        temporary_path = '{}.{}'.format(simplified_path, os.getpid())
+        with open(temporary_path, 'w') as json_file:
+            json.dump(features, json_file, separators=(',', ':'))
+        os.replace(temporary_path, simplified_path)
+        for stale_path in glob.glob(os.path.join('data', 'custom_with_ids.geo.{}.*.json'.format(tolerance))):
+            if stale_path != simplified_path:
+                os.remove(stale_path)       # Of an earlier version of the polygons or the simplification
+    return features
+
+
+def countries_geojson(codes=None, tolerance=None):
+    """
+    Create a GeoJSON of the polygons of the given countries
+    :param codes: ISO3 codes of the countries to include (default: all)
+    :param tolerance: Simplification tolerance in degrees (default: no simplification)
+    :return: GeoJSON feature collection
+    """
+    features = load_geometries(tolerance)
+    if codes is None:
+        codes = features.keys()
+    return {'type': 'FeatureCollection', 'features': [features[code] for code in codes if code in features]}
+
+
+def build_country_table(path=countries_path):
+    """
+    Precompute the name and continent of each country from pycountry and pycountry-convert, with the names each country
+    is looked up by, so that the application resolves country names without loading them
+    :param path: Path to save the table to
+    :return: Dictionary of the versions the table was built from, ISO3 code to name and continent code (None if the
+             country has no continent) and lower case name to ISO3 code
+    """
+    from importlib.metadata import version
+    import pycountry as pc      # Only needed to build the table
+    import pycountry_convert as pcc
+
+    countries = {}
+    for country in pc.countries:
+        try:
+            continent = pcc.country_alpha2_to_continent_code(country.alpha_2)
+        except KeyError:
+            continent = None        # e.g. Antarctica and some territories
+        countries[country.alpha_3] = [country.name, continent]
+
+    # Looked up as by pycountry: ignoring case, by name and then by common name, a later country taking a name from an earlier one
+    names = {country.name.lower(): country.alpha_3 for country in pc.countries}
+    common_names = {country.common_name.lower(): country.alpha_3 for country in pc.countries if hasattr(country, 'common_name')}
+    for name, alpha_3 in common_names.items():
+        names.setdefault(name, alpha_3)
+
+    table = {'source': {'pycountry': version('pycountry'), 'pycountry-convert': version('pycountry-convert')},
+             'countries': countries, 'names': names}
+    temporary_path = '{}.{}'.format(path, os.getpid())
+    with open(temporary_path, 'w') as f:
+        json.dump(table, f, separators=(',', ':'), sort_keys=True, ensure_ascii=False)
+    os.replace(temporary_path, path)
+    country_table.cache_clear()
+    return table
+
+
+@lru_cache(maxsize=None)
+def country_table(path=countries_path):
+    """
+    Load the precomputed table of countries, once per process
+    :param path: Path to the table (built by build_country_table())
+    :return: Dictionary of ISO3 code to name and continent code, and lower case name to ISO3 code
+    """
+    with open(path, encoding='UTF-8') as f:
+        return json.load(f)
+
+
+def country_entry(alpha_3):
+    """
+    Obtain the details of a country
+    :param alpha_3: ISO3 code of the country
+    :return: Dictionary of ISO3 code, name and continent code (None if the country has no continent)
+    """
+    name, continent = country_table()['countries'][alpha_3]
+    return {'alpha_3': alpha_3, 'name': name, 'continent': continent}
+
+
+class CountryCodes:
+    """
+    Resolve country names to ISO3 codes and continents, from the precomputed table of countries
+    """
+    def __init__(self, path=countries_path):
+        table = country_table(path)
+        self.countries = table['countries']
+        self.names = dict(table['names'])
+        self.names.update({name.lower(): code for name, code in custom_codes.items()})      # Custom mappings always take precedence
+
+    def lookup(self, name):
+        """
+        Resolve a single country name
+        :param name: Name of the country, as submitted
+        :return: Dictionary of ISO3 code, name and continent code, or None if the name cannot be resolved
+        """
+        alpha_3 = self.names.get(name.lower()) if isinstance(name, str) else None
+        if alpha_3 is None:
+            return None
+        name, continent = self.countries[alpha_3]
+        return {'alpha_3': alpha_3, 'name': name, 'continent': continent}
+
+    def resolve(self, country_counts):
+        """
+        Resolve the countries of counts per country, looking up each distinct name once
+        :param country_counts: Data frame of country name ('value') and count
+        :return: Data frame of ISO3 code, name, continent and count per country, and data frame of the names that could not be resolved with their counts
+        """
+        entries = country_counts['value'].map(self.lookup)
+        resolved = entries.notna()
+
+        countries = pd.DataFrame(list(entries[resolved]), columns=['alpha_3', 'name', 'continent'])
+        countries['count'] = country_counts['count'][resolved].to_numpy()
+        countries = countries.groupby(['alpha_3', 'name'], as_index=False, dropna=False).agg({'continent': 'first', 'count': 'sum'})      # Different names can resolve to the same country
+        unresolved = country_counts[~resolved].rename(columns={'value': 'country'}).reset_index(drop=True)
+        return countries, unresolved
+
+
+@lru_cache(maxsize=None)
+def shared_country_codes():
+    """
+    Obtain the country codes of this process, shared by every data hub it serves
+    :return: CountryCodes object
+    """
+    return CountryCodes()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.countries:
+        table = build_country_table()
+        print('> Saved {:,} countries and {:,} names to {} (pycountry {})'.format(len(table['countries']), len(table['names']), os.path.normpath(countries_path), table['source']['pycountry']))
+        raise SystemExit(0)
+
+    from plots import GeneratePlots       # Only needed for the comparison, avoids a circular import otherwise
+
+    print('---> Comparing map figures...')
+    results = []
+    for tolerance in [None] + args.tolerance:
+        plots = GeneratePlots(args.username, args.date, map_tolerance=tolerance)
+        start = time.perf_counter()
+        figure = plots.submissions_map()
+        build_seconds = time.perf_counter() - start
+        if tolerance is None:
+            # The map before polygons were filtered and simplified, with the full GeoJSON loaded for every figure
+            start = time.perf_counter()
+            with open(geojson_path) as json_file:
+                figure.data[0].geojson = json.load(json_file)
+            results.append(['original (all countries)', build_seconds + time.perf_counter() - start, len(figure.to_json()) / 1024 ** 2])
+            figure = plots.submissions_map()
+        results.append(['{}'.format(tolerance or 'none'), build_seconds, len(figure.to_json()) / 1024 ** 2])
+    print(pd.DataFrame(results, columns=['tolerance', 'build_seconds', 'figure_mb']).to_string(index=False))
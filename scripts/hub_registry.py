@@ -0,0 +1,226 @@
+#!/usr/bin/env/python3
+# This script handles the loading of data hub snapshots for the application, when serving several data hubs
+
+__author__ = 'Nadim Rahman'
+
+from collections import OrderedDict
+from figure_cache import snapshot_order
+import datetime, threading, time
+
+snapshot_names = ['Datahub_stats', 'cumulative_submissions', 'aggregates']      # Snapshots saved by visualisation_prep.py that the application reads, the aggregate table being saved last
+
+
+class HubRegistry:
+    """
+    Load the plots object of each data hub on first use, and keep them within a memory budget.
+    The least recently used data hubs are evicted first, as are data hubs that have not been used for a while.
+    """
+    def __init__(self, load, max_memory_mb=1024, idle_seconds=3600):
+        self.load = load        # Function to load the plots object of a data hub snapshot, called with (datahub, date)
+        self.max_memory_mb = max_memory_mb
+        self.idle_seconds = idle_seconds
+        self.hubs = OrderedDict()       # (datahub, date) -> dictionary of plots object, load time and last use
+        self.loading = {}       # (datahub, date) -> lock held while the snapshot is being loaded
+        self.presented = {}     # Data hub -> date of the snapshot switched to by drop(), older snapshots are not loaded again
+        self.lock = threading.Lock()
+
+    def get(self, datahub, date):
+        """
+        Obtain the plots object of a data hub snapshot, loading it if needed
+        :param datahub: Name of data hub
+        :param date: Date of the snapshot (DDMMYYYY)
+        :return: GeneratePlots object, of the presented snapshot if the date is of an older one
+        """
+        with self.lock:
+            key = (datahub, self.current_date(datahub, date))
+            self.evict_idle(keep=key)       # On every request, so that idle snapshots are released without waiting for another to load
+            if key in self.hubs:
+                return self.use(key)
+            loading = self.loading.setdefault(key, threading.Lock())
+
+        with loading:       # Only one request loads a snapshot, others for the same snapshot wait for it
+            with self.lock:
+                if key in self.hubs:
+                    return self.use(key)
+            start = time.perf_counter()
+            plots = self.load(*key)
+            load_seconds = time.perf_counter() - start
+
+            with self.lock:
+                del self.loading[key]
+                if self.current_date(*key) != key[1]:
+                    return plots        # Switched to a newer snapshot while loading, so this one is not kept
+                self.hubs[key] = {'plots': plots, 'load_seconds': load_seconds, 'last_used': time.time()}
+                self.evict(keep=key)
+                return self.use(key)
+
+    def current_date(self, datahub, date):
+        """
+        Obtain the snapshot to serve a request for a data hub snapshot from. Must be called with the lock held.
+        :param datahub: Name of data hub
+        :param date: Date of the snapshot requested (DDMMYYYY)
+        :return: Date of the presented snapshot if the one requested is older (i.e. its date was read before the switch), otherwise the date requested
+        """
+        presented = self.presented.get(datahub)
+        if presented is not None and snapshot_order(date) < snapshot_order(presented):
+            return presented
+        return date
+
+    def use(self, key):
+        """
+        Mark a loaded snapshot as used. Must be called with the lock held.
+        :param key: Tuple of data hub name and snapshot date
+        :return: GeneratePlots object
+        """
+        self.hubs.move_to_end(key)
+        self.hubs[key]['last_used'] = time.time()
+        return self.hubs[key]['plots']
+
+    def memory_mb(self, key):
+        """
+        Obtain the memory held by a loaded snapshot, which grows when it is first filtered. Must be called with the lock held.
+        :param key: Tuple of data hub name and snapshot date
+        :return: Memory in megabytes
+        """
+        return self.hubs[key]['plots'].memory_usage() / 1024 ** 2
+
+    def evict_idle(self, keep=None):
+        """
+        Evict the snapshots that have not been used for idle_seconds. Must be called with the lock held.
+        :param keep: Tuple of data hub name and snapshot date, which is never evicted
+        :return:
+        """
+        now = time.time()
+        for key in list(self.hubs):
+            if key != keep and now - self.hubs[key]['last_used'] > self.idle_seconds:
+                del self.hubs[key]
+
+    def sweep(self):
+        """
+        Evict idle snapshots, e.g. periodically when no requests are being made
+        :return:
+        """
+        with self.lock:
+            self.evict_idle()
+
+    def evict(self, keep):
+        """
+        Evict idle snapshots, then the least recently used ones until the memory budget is met. Must be called with the lock held.
+        :param keep: Tuple of data hub name and snapshot date, which is never evicted
+        :return:
+        """
+        self.evict_idle(keep)
+        for key in list(self.hubs):
+            if sum(self.memory_mb(loaded) for loaded in self.hubs) <= self.max_memory_mb:
+                break
+            if key != keep:
+                del self.hubs[key]
+
+    def loaded(self, datahub):
+        """
+        Check whether a snapshot of a data hub is loaded
+        :param datahub: Name of data hub
+        :return: Whether a snapshot is loaded
+        """
+        with self.lock:
+            return any(key[0] == datahub for key in self.hubs)
+
+    def drop(self, datahub, keep=None):
+        """
+        Drop the loaded snapshots of a data hub
+        :param datahub: Name of data hub
+        :param keep: Date of the snapshot switched to, which is not dropped (DDMMYYYY). Requests for older snapshots are served from it.
+        :return:
+        """
+        with self.lock:
+            if keep is not None:
+                self.presented[datahub] = keep      # Under the lock of get(), so that a request that read the previous date does not load it again
+            for key in [key for key in self.hubs if key[0] == datahub and key[1] != keep]:
+                del self.hubs[key]
+
+    def stats(self):
+        """
+        Obtain the memory and load time of each loaded snapshot
+        :return: List of dictionaries, one per loaded snapshot, most recently used last
+        """
+        now = time.time()
+        with self.lock:
+            return [{'datahub': datahub, 'date': date, 'memory_mb': round(self.memory_mb((datahub, date)), 3),
+                     'load_seconds': round(hub['load_seconds'], 3), 'idle_seconds': round(now - hub['last_used'], 1)}
+                    for (datahub, date), hub in self.hubs.items()]
+
+
+def latest_snapshot(datahub):
+    """
+    Find the most recent complete snapshot of a data hub
+    :param datahub: Name of data hub
+    :return: Date of the snapshot (DDMMYYYY), or None if there are none
+    """
+    from snapshot_store import SnapshotStore        # Loads pandas, deferred so that importing the registry does not load it before a data hub is viewed
+    store = SnapshotStore(datahub)
+    # Snapshots from before the aggregate table was introduced are used if no snapshot has one
+    return store.latest_complete(snapshot_names) or store.latest_complete(snapshot_names[:-1])
+
+
+class SnapshotWatcher(threading.Thread):
+    """
+    Poll the data directory for new snapshots of the data hubs, and switch to them once loaded.
+    A new snapshot of a loaded data hub is loaded in the background, and is only presented when it is fully loaded.
+    """
+    def __init__(self, registry, datahubs, interval=60):
+        super().__init__(daemon=True, name='SnapshotWatcher')
+        self.registry = registry
+        self.datahubs = datahubs
+        self.interval = interval
+        self.current = {datahub: latest_snapshot(datahub) for datahub in datahubs}      # Data hub -> date of the snapshot presented
+        self.reloads = {}       # Data hub -> details of the last reload
+
+    def snapshot_date(self, datahub):
+        """
+        Obtain the date of the snapshot to present for a data hub
+        :param datahub: Name of data hub
+        :return: Snapshot date (DDMMYYYY)
+        """
+        return self.current[datahub]
+
+    def check(self):
+        """
+        Check each data hub for a new snapshot, loading it if the data hub is loaded, and release idle snapshots
+        :return:
+        """
+        self.registry.sweep()
+        for datahub in self.datahubs:
+            date = latest_snapshot(datahub)
+            if date is None or date == self.current[datahub]:
+                continue
+            start = time.perf_counter()
+            if self.registry.loaded(datahub):
+                self.registry.get(datahub, date)        # Load before switching, so requests are served from the previous snapshot meanwhile
+            self.current[datahub] = date        # Single assignment, requests see either the previous or new snapshot
+            self.registry.drop(datahub, keep=date)      # Release the previous snapshot
+            self.reloads[datahub] = {'date': date, 'reload_seconds': round(time.perf_counter() - start, 3),
+                                     'reloaded_at': datetime.datetime.now().isoformat(timespec='seconds')}
+            print('> Switched {} to snapshot {} [{}s]'.format(datahub, date, self.reloads[datahub]['reload_seconds']))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                print('> Checking for new snapshots failed: {}'.format(e))      # Keep serving the current snapshots, and try again next time
+
+
+class IdleSweeper(threading.Thread):
+    """
+    Release idle snapshots periodically, when the snapshots are not being watched (which releases them too)
+    """
+    def __init__(self, registry, interval=60):
+        super().__init__(daemon=True, name='IdleSweeper')
+        self.registry = registry
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.registry.sweep()
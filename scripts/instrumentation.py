@@ -0,0 +1,176 @@
+#!/usr/bin/env/python3
+# This script handles the timing of pipeline stages and the metrics exposed by the application
+
+__author__ = 'Nadim Rahman'
+
+from contextlib import contextmanager
+import bisect, json, os, threading, time
+
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]      # Seconds
+size_buckets = [1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7]      # Bytes
+
+
+class Spans:
+    """
+    Record how long each stage of a run takes (e.g. fetch, parse, aggregate, write), with labels such as the data hub and result type
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """
+        Time the code within the block as a stage
+        :param stage: Name of the stage
+        :param labels: Labels of the span (e.g. result_type='read_run')
+        """
+        offset = time.time() - self.started
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, offset, **labels)
+
+    def add(self, stage, seconds, offset=None, **labels):
+        """
+        Record a span which has already been timed
+        :param stage: Name of the stage
+        :param seconds: Duration of the span
+        :param offset: Start of the span, in seconds since the run started (default: now less the duration)
+        :param labels: Labels of the span
+        :return:
+        """
+        if offset is None:
+            offset = time.time() - self.started - seconds
+        with self.lock:
+            self.spans.append(dict(labels, stage=stage, start=round(offset, 4), seconds=round(seconds, 4)))
+
+    def totals(self):
+        """
+        Total the spans of each stage and set of labels
+        :return: List of dictionaries of stage, labels, number of spans and seconds, slowest first
+        """
+        totals = {}
+        with self.lock:
+            for span in self.spans:
+                labels = {key: value for key, value in span.items() if key not in ['start', 'seconds']}
+                total = totals.setdefault(tuple(sorted(labels.items())), dict(labels, count=0, seconds=0))
+                total['count'] += 1
+                total['seconds'] += span['seconds']
+        return sorted([dict(total, seconds=round(total['seconds'], 4)) for total in totals.values()], key=lambda total: -total['seconds'])
+
+    def write_report(self, path, **details):
+        """
+        Save a JSON report of the run
+        :param path: Path of the report
+        :param details: Other details of the run (e.g. data hub and status)
+        :return: Path of the report
+        """
+        report = dict(details, started=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                      seconds=round(time.time() - self.started, 3), stages=self.totals(), spans=list(self.spans))
+        temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary_path, 'w') as f:
+            json.dump(report, f, indent=1, default=str)
+        os.replace(temporary_path, path)
+        return path
+
+
+spans = Spans()     # Spans of the run of this process
+
+
+def process_memory():
+    """
+    Obtain the resident memory of the current process (e.g. an application worker)
+    :return: Dictionary of the current and peak resident set size in megabytes, empty if it cannot be read (i.e. not on Linux)
+    """
+    fields = {'VmRSS:': 'resident_mb', 'VmHWM:': 'peak_resident_mb'}
+    try:
+        with open('/proc/self/status') as f:
+            return {fields[line.split()[0]]: round(int(line.split()[1]) / 1024, 1) for line in f if line.split()[0] in fields}      # Reported in kilobytes
+    except OSError:
+        return {}
+
+
+def format_labels(labels):
+    """
+    Format labels for the Prometheus text format
+    :param labels: Dictionary of label name to value
+    :return: Labels text (e.g. '{callback="generate_page"}'), empty if there are no labels
+    """
+    if not labels:
+        return ''
+    escaped = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels.items()]
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_metric(name, description, metric_type, samples):
+    """
+    Render a counter or gauge in the Prometheus text format
+    :param name: Name of the metric
+    :param description: Description of the metric
+    :param metric_type: 'counter' or 'gauge'
+    :param samples: List of (labels dictionary, value) tuples
+    :return: List of lines
+    """
+    lines = ['# HELP {} {}'.format(name, description), '# TYPE {} {}'.format(name, metric_type)]
+    return lines + ['{}{} {}'.format(name, format_labels(labels), value) for labels, value in samples]
+
+
+class Histogram:
+    """
+    Count observations (e.g. callback latencies) into cumulative buckets, for the Prometheus text format
+    """
+    def __init__(self, name, description, buckets=latency_buckets):
+        self.name = name
+        self.description = description
+        self.buckets = sorted(buckets)
+        self.series = {}        # Labels -> [count per bucket, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """
+        Count an observation
+        :param value: Value observed
+        :param labels: Labels of the observation (e.g. callback='generate_page')
+        :return:
+        """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.setdefault(key, [[0] * len(self.buckets), 0, 0])
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe how long the code within the block takes
+        :param labels: Labels of the observation
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        """
+        Render the histogram in the Prometheus text format
+        :return: List of lines
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                labels = dict(key)
+                cumulative = 0
+                for bucket, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{} {}'.format(self.name, format_labels(dict(labels, le='{:g}'.format(bucket))), cumulative))
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(dict(labels, le='+Inf')), count))
+                lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), round(total, 6)))
+                lines.append('{}_count{} {}'.format(self.name, format_labels(labels), count))
+        return lines
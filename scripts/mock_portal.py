@@ -0,0 +1,146 @@
+#!/usr/bin/env/python3
+# This script serves saved search results in the same way as the Portal API, for local development
+
+__author__ = 'Nadim Rahman'
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from snapshot_store import read_file
+import argparse, email.utils, gzip, hashlib, io, random, re, threading, time
+
+
+def get_args():
+    """
+    Handle script arguments
+    :return: Script arguments
+    """
+    parser = argparse.ArgumentParser(prog='mock_portal.py', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="""
+        + =========================================================== +
+        |  ENA Data Hubs Dashboard: mock_portal.py                    |
+        |  Python script to serve search results locally in the      |
+        |  Portal API format.                                         |
+        + =========================================================== +
+        """)
+    parser.add_argument('-f', '--file', help='Result type and the file of results to serve for it (e.g. read_run=data/dcc_XXXXX_ENA_Search_read_run_24032022.txt)', type=str, action='append', required=True)
+    parser.add_argument('--port', help='Port to serve on (default: 8000)', type=int, default=8000)
+    parser.add_argument('--error-rate', help='Fraction of requests answered with a 503 error, to exercise retries (default: 0)', type=float, default=0)
+    args = parser.parse_args()
+    return args
+
+
+class MockPortal:
+    """
+    Serve search results from memory through the /search and /count endpoints of the Portal API.
+    Responses are gzip compressed if the client accepts it, and carry an ETag and Last-Modified date to answer conditional requests.
+    """
+    def __init__(self, results, port=0, error_rate=0):
+        self.results = results      # Dictionary of result type to data frame of results
+        self.error_rate = error_rate
+        self.requests = []      # Query parameters of every request received, in order
+        self.modified = email.utils.formatdate(time.time(), usegmt=True)     # Results are not changed while served
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def from_files(files, port=0, error_rate=0):
+        """
+        Create a mock portal serving results saved by data_import.py
+        :param files: Dictionary of result type to path of the saved search results (Parquet or tab-separated)
+        :param port: Port to serve on (0 picks a free port)
+        :param error_rate: Fraction of requests answered with a 503 error
+        :return: MockPortal object
+        """
+        results = {result_type: read_file(path) for result_type, path in files.items()}
+        return MockPortal(results, port, error_rate)
+
+    def handler(self):
+        """
+        Create the request handler class, bound to this portal
+        :return: Request handler class
+        """
+        portal = self
+
+        class PortalRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                portal.requests.append(params)
+                if random.random() < portal.error_rate:
+                    return self.respond(503, 'Service Unavailable')
+                if params.get('result') not in portal.results:
+                    return self.respond(400, 'Invalid result: {}'.format(params.get('result')))
+
+                results = portal.results[params['result']]
+                if url.path.endswith('/count'):
+                    return self.respond(200, 'count\n{}\n'.format(len(results)))
+                elif url.path.endswith('/search'):
+                    return self.respond(200, portal.search(results, params), validate=True)
+                return self.respond(404, 'Not Found')
+
+            def respond(self, status, body, validate=False):
+                body = body.encode('UTF-8')
+                headers = {'Content-Type': 'text/plain'}
+                if validate:
+                    headers['ETag'] = '"{}"'.format(hashlib.md5(body).hexdigest())
+                    headers['Last-Modified'] = portal.modified
+                    if self.headers.get('If-None-Match') == headers['ETag'] or \
+                            ('If-None-Match' not in self.headers and self.headers.get('If-Modified-Since') == portal.modified):
+                        status, body = 304, b''
+                if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body, compresslevel=1)
+                    headers['Content-Encoding'] = 'gzip'
+                headers['Content-Length'] = str(len(body))
+
+                self.send_response(status)
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass        # Keep the console quiet
+
+        return PortalRequestHandler
+
+    def search(self, results, params):
+        """
+        Select the page of results and fields for a search request
+        :param results: Data frame of all results for the result type
+        :param params: Query parameters of the request
+        :return: Tab-separated text of the results
+        """
+        for field, value in re.findall(r'(\w+)>=([\w-]+)', params.get('query', '')):
+            results = results[results[field] >= value]      # Only lower bounds (e.g. first_created>=2022-03-01) are supported
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 0))
+        page = results.iloc[offset:offset + limit] if limit else results.iloc[offset:]      # A limit of 0 returns all results
+        if 'fields' in params:
+            # The accession of the result type is always returned, as the first column
+            fields = [results.columns[0]] + [field for field in params['fields'].split(',') if field in results.columns and field != results.columns[0]]
+            page = page[fields]
+        output = io.StringIO()
+        page.to_csv(output, sep="\t", index=False)
+        return output.getvalue()
+
+    def start(self):
+        """
+        Serve requests in a background thread
+        :return: URL of the portal API, to pass to retrieve_data
+        """
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    files = dict(file.split('=', 1) for file in args.file)
+    portal = MockPortal.from_files(files, args.port, args.error_rate)
+    print('---> Serving {} at {} (Ctrl+C to stop)'.format(', '.join(files), portal.url))
+    try:
+        portal.server.serve_forever()
+    except KeyboardInterrupt:
+        portal.stop()
@@ -0,0 +1,179 @@
+#!/usr/bin/env/python3
+# This script handles the summarising of saved snapshots in chunks across a pool of processes, for data hubs larger than memory
+
+__author__ = 'Nadim Rahman'
+
+import pyarrow.parquet as pq
+import argparse, multiprocessing, os, time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from aggregates import empty_summary, summarise_chunk, merge_summaries, distinct_counts, summary_columns, to_cube
+from instrumentation import process_memory
+from result_types import result_types
+from snapshot_store import SnapshotStore
+
+
+def get_args():
+    """
+    Handle script arguments
+    :return: Script arguments
+    """
+    parser = argparse.ArgumentParser(prog='parallel_aggregates.py', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="""
+        + =========================================================== +
+        |  ENA Data Hubs Dashboard: parallel_aggregates.py            |
+        |  Python script to summarise a saved snapshot in chunks      |
+        |  across processes, and verify it against the in-memory      |
+        |  summary.                                                   |
+        + =========================================================== +
+        """)
+    parser.add_argument('-u', '--username', help='Data Hub username (e.g. dcc_XXXXX)', type=str, required=True)
+    parser.add_argument('-d', '--date', help='Date of the snapshot to summarise (DDMMYYYY, default: latest)', type=str)
+    parser.add_argument('-w', '--workers', help='Numbers of worker processes to summarise with (default: number of CPUs)', type=int, nargs='+', default=[os.cpu_count()])
+    parser.add_argument('-c', '--chunk-rows', help='Maximum number of rows held in memory at once by each worker (default: 100000)', type=int, default=100000)
+    parser.add_argument('--verify', help='Check that the summaries are identical to summarising the snapshot in one data frame', action='store_true')
+    args = parser.parse_args()
+    return args
+
+
+def process_pool(workers):
+    """
+    Start a pool of processes to summarise snapshots with. Processes are started afresh rather than forked, so that they
+    do not inherit the threads (e.g. of the concurrent downloads) or the data of this process
+    :param workers: Number of worker processes
+    :return: ProcessPoolExecutor object
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def summarise_row_groups(path, row_groups, result_type, chunk_rows=100000):
+    """
+    Summarise row groups of a Parquet snapshot, in a worker process
+    :param path: Path to the snapshot file
+    :param row_groups: Row groups to summarise
+    :param result_type: Result type of the snapshot
+    :param chunk_rows: Maximum number of rows per chunk
+    :return: Summary of the records of the row groups, and the peak resident memory of the worker in megabytes
+    """
+    summary = empty_summary(result_type)
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, row_groups=row_groups, columns=summary_columns(result_type)):
+        summary = merge_summaries(summary, summarise_chunk(batch.to_pandas(date_as_object=False), result_type))
+    return summary, process_memory().get('peak_resident_mb')
+
+
+def summarise_rows(chunk, result_type):
+    """
+    Summarise a chunk of records read by the parent process (i.e. of a tab-separated snapshot), in a worker process
+    :param chunk: Data frame of records
+    :param result_type: Result type of the records
+    :return: Summary of the records, and the peak resident memory of the worker in megabytes
+    """
+    return summarise_chunk(chunk, result_type), process_memory().get('peak_resident_mb')
+
+
+def summarise_snapshot(store, date, result_type, workers=None, chunk_rows=100000, pool=None):
+    """
+    Summarise a saved snapshot of a result type in chunks, giving the same summary as summarising it in one data frame.
+    Parquet snapshots are split by row group, each worker reading only the summarised columns of its row groups, at most
+    chunk_rows rows at a time. Only the summaries of the chunks are sent back, and these are merged as they arrive.
+    :param store: SnapshotStore object of the data hub
+    :param date: Date of the snapshot (DDMMYYYY)
+    :param result_type: Result type of the snapshot
+    :param workers: Number of worker processes (default: number of CPUs), 1 to summarise in this process
+    :param chunk_rows: Maximum number of rows per chunk
+    :param pool: Pool of processes to use (e.g. shared by the result types), rather than starting one
+    :return: Summary of the snapshot (number of rows, number of distinct values per stats column and counts per dimension)
+             and a dictionary of the number of chunks, the number of workers and the peak memory of a worker in megabytes
+    """
+    name = 'ENA_Search_{}'.format(result_type)
+    path = store.find(name, date)
+    if path is None:
+        raise FileNotFoundError('No {} snapshot for {} on {}'.format(name, store.datahub, date))
+    workers = workers or os.cpu_count()
+    summary = empty_summary(result_type)
+    tasks = 0
+    peaks = []
+
+    if workers == 1 and pool is None:
+        for chunk in store.chunks(name, date, chunk_rows, summary_columns(result_type)):
+            summary = merge_summaries(summary, summarise_chunk(chunk, result_type))
+            tasks += 1
+        return distinct_counts(summary), {'chunks': tasks, 'workers': 1, 'worker_peak_mb': process_memory().get('peak_resident_mb')}
+
+    if path.endswith('.parquet'):
+        calls = ((summarise_row_groups, path, [row_group], result_type, chunk_rows) for row_group in range(pq.ParquetFile(path).num_row_groups))
+    else:
+        calls = ((summarise_rows, chunk, result_type) for chunk in store.chunks(name, date, chunk_rows, summary_columns(result_type)))
+
+    executor = pool or process_pool(workers)
+    try:
+        pending = set()
+        for call in calls:
+            pending.add(executor.submit(*call))
+            tasks += 1
+            if len(pending) >= 2 * workers:     # Chunks read by this process wait to be summarised, so only a few are held at once
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    partial, peak = future.result()
+                    summary = merge_summaries(summary, partial)
+                    peaks.append(peak)
+        for future in wait(pending).done:
+            partial, peak = future.result()
+            summary = merge_summaries(summary, partial)
+            peaks.append(peak)
+    finally:
+        if pool is None:
+            executor.shutdown(cancel_futures=True)
+    peaks = [peak for peak in peaks if peak is not None]
+    return distinct_counts(summary), {'chunks': tasks, 'workers': workers, 'worker_peak_mb': max(peaks) if peaks else None}
+
+
+def differences(expected, summary, result_type):
+    """
+    Compare two summaries of a snapshot
+    :param expected: Summary to compare against (e.g. of the snapshot in one data frame)
+    :param summary: Summary to compare
+    :param result_type: Result type of the snapshot
+    :return: List of what differs (the number of rows, stats columns and 'aggregates'), empty if the summaries are identical
+    """
+    different = [] if expected[0] == summary[0] else ['rows']
+    different += [column for column, nunique in expected[1].items() if summary[1].get(column) != nunique]
+    if not to_cube(expected[2], result_type).equals(to_cube(summary[2], result_type)):
+        different.append('aggregates')
+    return different
+
+
+if __name__ == '__main__':
+    import pandas as pd
+    args = get_args()
+    store = SnapshotStore(args.username)
+    date = args.date or store.latest_complete(['ENA_Search_{}'.format(result_type) for result_type in result_types])
+    if date is None:
+        raise SystemExit('No snapshot of every result type for {}'.format(args.username))
+
+    print('---> Summarising snapshots of {}...'.format(date))
+    results = []
+    summaries = {}      # (Result type, workers) -> summary
+    for result_type in result_types:
+        for workers in args.workers:
+            start = time.perf_counter()
+            summaries[result_type, workers], details = summarise_snapshot(store, date, result_type, workers, args.chunk_rows)
+            results.append([result_type, workers, details['chunks'], time.perf_counter() - start, summaries[result_type, workers][0], details['worker_peak_mb']])
+
+    # Summarised in one data frame last, as the peak memory of this process is that since it started
+    failed = []
+    if args.verify:
+        for result_type in result_types:
+            start = time.perf_counter()
+            expected = distinct_counts(summarise_chunk(store.read('ENA_Search_{}'.format(result_type), date), result_type))      # As by visualisation_prep.py
+            results.append([result_type, 'in memory', 1, time.perf_counter() - start, expected[0], process_memory().get('peak_resident_mb')])
+            for workers in args.workers:
+                different = differences(expected, summaries[result_type, workers], result_type)
+                if different:
+                    failed.append('{} with {} workers ({})'.format(result_type, workers, ', '.join(different)))
+
+    print(pd.DataFrame(results, columns=['result_type', 'workers', 'chunks', 'seconds', 'rows', 'peak_mb']).to_string(index=False))
+    if failed:
+        raise SystemExit('> Summaries differ from the in-memory summary: {}'.format('; '.join(failed)))
+    if args.verify:
+        print('> Summaries are identical to the in-memory summary')
+    print('---> Summarising snapshots of {}... [COMPLETED]'.format(date))
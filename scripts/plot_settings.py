@@ -0,0 +1,9 @@
+#!/usr/bin/env/python3
+# This script handles the settings of the plots which the application lays out, kept apart from plots.py so that the
+# application can be started without loading pandas and plotly
+
+__author__ = 'Nadim Rahman'
+
+pie_variables = ['instrument_platform', 'library_selection', 'library_source', 'library_strategy']     # Variables that the pie chart can be drawn for
+plot_columns = ['country', 'first_created'] + pie_variables       # Columns of the read_run snapshot that are plotted
+period_labels = {'month': 'Month/Year', 'week': 'Week', 'day': 'Day'}       # Axis labels of the submission plots for each granularity
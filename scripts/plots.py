@@ -3,13 +3,18 @@
 
 __author__ = 'Nadim Rahman, Carla Cummins'
 
-import json, math, os, sys
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
-import pycountry as pc
 import dash_html_components as html
-import pycountry_convert as pcc
 import plotly.express as px
+from snapshot_store import SnapshotStore
+from geography import shared_country_codes, countries_geojson
+from aggregates import cube_dimensions, count_dimensions, to_cube, select
+from time_series import daily_counts, submission_series
+from filter_index import FilterIndex
+from plot_settings import pie_variables, plot_columns, period_labels
+import threading
 
 continent_codes = {'EU': 'europe', 'AS': 'asia', 'AF': 'africa', 'NA': 'north america', 'SA': 'south america'}      # Note this is not a full list, these are continents that are within the scope of the Cholorpleth maps
 
@@ -17,30 +22,98 @@ class GeneratePlots:
     """
     Generate all plots and data to be presented in the application.
     """
-    def __init__(self, datahub, date):
+    def __init__(self, datahub, date, map_tolerance=None):
         self.datahub = datahub      # Name of data hub
         self.date_today = date      # Date (e.g. 03082021)
-        self.read_run = pd.read_csv('data/{}_ENA_Search_read_run_{}.txt'.format(self.datahub, self.date_today),
-                                    sep="\t")
-        self.counts = pd.read_csv('data/{}_cumulative_submissions_{}.txt'.format(self.datahub, self.date_today), sep="\t")
+        self.map_tolerance = map_tolerance      # Simplification tolerance of the map polygons in degrees (e.g. 0.01), None for full detail
+        self.store = SnapshotStore(self.datahub)
+        self.country_codes = shared_country_codes()
+        self.counts = self.store.read('cumulative_submissions', self.date_today)
+        if self.store.find('aggregates', self.date_today) is not None:
+            self.cube = self.store.read('aggregates', self.date_today)     # Counts per dimension, plots are built from these rather than every record
+        else:
+            # Snapshots from before the aggregate table was introduced, count the records once here
+            read_run = self.store.read('ENA_Search_read_run', self.date_today, columns=plot_columns)        # Only the columns that are plotted
+            self.cube = to_cube(count_dimensions(read_run, cube_dimensions['read_run']), 'read_run')
+        self.index = None       # Index of the read_run records for filtered views, built on the first filtered request
+        self.index_lock = threading.Lock()
 
         # Edit the data hub name to ensure it is in the format 'DCC_[A-Z][a-z]+'
         datahub_edited = self.datahub.split("_")
         self.datahub_edited = datahub_edited[0].replace('dcc', 'DCC') + "_" + datahub_edited[1][0].upper() + datahub_edited[1][1:]         # Convert lowercase to uppercase for 'dcc' and first letter of datahub name
 
+    def memory_usage(self):
+        """
+        Obtain the memory held by the data of the data hub
+        :return: Memory in bytes
+        """
+        index_memory = self.index.memory_usage() if self.index is not None else 0
+        return int(self.cube.memory_usage(deep=True).sum() + self.counts.memory_usage(deep=True).sum() + index_memory)
+
+    def filter_index(self):
+        """
+        Obtain the index of the read_run records, loading the records and building it if needed
+        :return: FilterIndex object
+        """
+        with self.index_lock:       # Built once, requests for other filters wait for it
+            if self.index is None:
+                read_run = self.store.read('ENA_Search_read_run', self.date_today, columns=plot_columns)        # Only the columns that can be filtered and plotted
+                self.index = FilterIndex(read_run, cube_dimensions['read_run'])
+            return self.index
+
+    def view(self, filters=()):
+        """
+        Obtain the aggregate table of the records matching a set of filters
+        :param filters: Filter key (from filter_index.make_filters()), empty for all records
+        :return: Data frame of the aggregate table
+        """
+        if not filters:
+            return self.cube
+        cube = self.filter_index().counts(filters)
+        if all(dimension == 'first_created' for dimension, values in filters):
+            # Other result types (e.g. analysis) are only filtered by submission date, as the facets describe runs
+            first, last = dict(filters)['first_created']
+            others = self.cube[(self.cube['result_type'] != 'read_run') & (self.cube['dimension'] == 'day')]
+            others = others[((others['value'] >= first) if first else True) & ((others['value'] <= last) if last else True)]
+            cube = pd.concat([cube, others], ignore_index=True)
+        return cube
+
+    def filter_options(self):
+        """
+        Obtain the values that the records can be filtered on
+        :return: Dictionary of the first and last day of submission, and the values of each pie chart variable and country, largest count first
+        """
+        days = self.cube.loc[(self.cube['result_type'] == 'read_run') & (self.cube['dimension'] == 'day'), 'value']
+        options = {'first_created': [days.min(), days.max()] if len(days) > 0 else [None, None]}
+        for dimension in ['country'] + pie_variables:
+            options[dimension] = select(self.cube, dimension)['value'].astype(str).tolist()
+        return options
+
+    def submission_counts(self, granularity='month', filters=()):
+        """
+        Obtain the submissions of each result type over time
+        :param granularity: Period to count the submissions over ('month', 'week' or 'day')
+        :param filters: Filter key (from filter_index.make_filters()), empty for all records
+        :return: Data frame of period start date (first_created), submissions, cumulative submissions and result type
+        """
+        days = daily_counts(self.view(filters))
+        if not filters and (granularity == 'month' or days.empty):
+            return self.counts      # Snapshots from before the submissions per day were counted only have monthly counts
+        return submission_series(days, granularity)
+
     def return_stats(self):
         """
         Obtain general data hubs statistics and create HTML for the application
         :return: HTML object housing data hub statistics
         """
-        datahub_stats = pd.read_csv('data/{}_Datahub_stats_{}.txt'.format(self.datahub, self.date_today), sep="\t")     # Read in data hub stats data
+        datahub_stats = self.store.read('Datahub_stats', self.date_today)     # Read in data hub stats data
         children = []       # Create empty children HTML list object
         for index, row in datahub_stats.iterrows():
             children.append(
                 html.Div(
                     children=[
-                        html.H2(children=row[1]),       # Value
-                        html.P(children=row[0],         # Field
+                        html.H2(children=row["value"]),       # Value
+                        html.P(children=row["field"],         # Field
                                className="banner-title"
                             ),
                     ],
@@ -49,55 +122,45 @@ class GeneratePlots:
             )
         return children
 
-    def submissions(self):
+    def submissions(self, granularity='month', filters=()):
         """
         Create a stacked line graph for raw number of submissions
+        :param granularity: Period to count the submissions over ('month', 'week' or 'day')
+        :param filters: Filter key (from filter_index.make_filters()), empty for all records
         :return: Stacked line graph object for the raw number of submissions
         """
-        stacked_raw_subs = px.line(self.counts, x='first_created', y='submissions', color='result_type', markers=True,
-                                   title='<b>Raw Number of Submissions per Month for {}</b>'.format(self.datahub_edited),
+        stacked_raw_subs = px.line(self.submission_counts(granularity, filters), x='first_created', y='submissions', color='result_type', markers=True,
+                                   title='<b>Raw Number of Submissions per {} for {}</b>'.format(granularity.capitalize(), self.datahub_edited),
                                    labels={
-                                       'first_created': 'Month/Year',
+                                       'first_created': period_labels[granularity],
                                        'submissions': 'No. of Submissions',
                                        'result_type': 'Type of Data'
                                    })
         return stacked_raw_subs
 
-    def cumulative_submissions(self):
+    def cumulative_submissions(self, granularity='month', filters=()):
         """
         Create a stacked line graph for cumulative number of submissions
+        :param granularity: Period to count the submissions over ('month', 'week' or 'day')
+        :param filters: Filter key (from filter_index.make_filters()), empty for all records
         :return: Stacked line graph object for the cumulative number of submissions
         """
-        stacked_cum_subs = px.line(self.counts, x='first_created', y='cumulative_submissions', color='result_type', markers=True,
-                                   title='<b>Cumulative Number of Submissions per Month for {}</b>'.format(self.datahub_edited),
+        stacked_cum_subs = px.line(self.submission_counts(granularity, filters), x='first_created', y='cumulative_submissions', color='result_type', markers=True,
+                                   title='<b>Cumulative Number of Submissions per {} for {}</b>'.format(granularity.capitalize(), self.datahub_edited),
                                    labels={
-                                       'first_created': 'Month/Year',
+                                       'first_created': period_labels[granularity],
                                        'cumulative_submissions': 'No. of Cumulative Submissions',
                                        'result_type': 'Type of Data'
                                    })
         return stacked_cum_subs
 
-    def get_continents(self, country_info):
+    def get_continents(self, continents):
         """
         Get the continent data to see if the map plot needs to focus to a region
-        :param country_info: The country information dictionary to be used for the plot
+        :param continents: The continent codes of the countries to be plotted
         :return: Whether a focused plot needs to be produced
         """
-        # Get a dictionary of alpha 2 codes in order to convert to continents
-        countries = {}
-        for country in pc.countries:
-            countries[country.name] = country.alpha_2
-        codes = [countries.get(country, 'Unknown code') for country in country_info.keys()]     # Assign alpha 2 codes for the data to be plotted
-
-        continents = []
-        for code in codes:
-            if code != "Unknown code":
-                try:
-                    continent = pcc.country_alpha2_to_continent_code(code)
-                except:
-                    continue
-                continents.append(continent)
-        continents = list(set(continents))      # Remove duplicates
+        continents = list(set(continents.dropna()))      # Remove duplicates and countries without a continent
         if len(continents) > 1:
             return True     # There is data from multiple continents in the dataset
         elif len(continents) == 1:
@@ -105,67 +168,32 @@ class GeneratePlots:
         elif len(continents) == 0:
             return True     # We don't necessarily know what is in the data, default to the large map
 
-    def submissions_map(self):
+    def submissions_map(self, filters=()):
         """
         Create a map of submissions
         ADAPTED FROM: https://github.com/enasequence/ena-content-dataflow/blob/master/scripts/plotly_map_advanced_search.py
+        :param filters: Filter key (from filter_index.make_filters()), empty for all records
         :return: Map figure object
         """
-        # load set of polygons for each country
-        geojson_path = "{0}/{1}".format("/".join(os.path.realpath(__file__).split('/')[:-1]),
-                                        '../assets/custom_with_ids.geo.json')
-        with open(geojson_path) as json_file:
-            countries = json.load(json_file)
-
-        # these countries are not named according to their official pycountry names
-        # we need to include custom mapping
-        custom_codes = {
-            'Russia': 'RUS', 'USA': 'USA', 'Czech Republic': 'CZE', 'South Korea': 'KOR',
-            'State of Palestine': 'PSE', 'Iran': 'IRN', 'West Bank': 'PSE'
-        }
-
-        ena_df = self.read_run[['run_accession', 'country', 'first_public']]
-
-        # fetch ISO3 codes and counts for each country
-        # and apply relevant filters
-        map_data = {}
-        for country in ena_df.country:
-            try:
-                country = country.split(':')[0]
-            except AttributeError:
-                continue
-
-            this_country_code = ''
-            try:
-                this_country_code = custom_codes[country]
-            except KeyError:
-                try:
-                    country_obj = pc.countries.get(name=country)
-                    if country_obj == None:
-                        country_obj = pc.countries.get(common_name=country)
-                    this_country_code = country_obj.alpha_3
-                except AttributeError:
-                    print("Cannot find ISO3 code for '{0}'".format(country))
-                    sys.exit()
-
-            try:
-                map_data[country] = [this_country_code, map_data[country][1]+1]
-            except KeyError:
-                map_data[country] = [this_country_code, 1]
+        # fetch ISO3 codes and counts for each country, resolving each distinct country name once
+        df, self.unresolved_countries = self.country_codes.resolve(select(self.view(filters), 'country'))
+        if len(self.unresolved_countries) > 0 and not filters:       # Those of a filtered view are among those of the whole data hub
+            print("Cannot find ISO3 code for {0}, these are left off the map".format(
+                ", ".join("'{0}' ({1:,})".format(country, count) for country, count in zip(self.unresolved_countries['country'], self.unresolved_countries['count']))))
 
         # get continents in data to identify whether a continent-zoomed in map is sufficient
-        continents = self.get_continents(map_data)     # True (for when there are multiple or no known continents) OR continent name (for when only one continent)
+        continents = self.get_continents(df['continent'])     # True (for when there are multiple or no known continents) OR continent name (for when only one continent)
 
-        # format the data  specifically for map display
-        for country in map_data:
-            country_code, country_count = map_data[country]
-            hover_text = 'Country : {0}<br>Count: {1}'.format(pc.countries.get(alpha_3=country_code).name, f"{country_count:,}")
-            map_data[country] = [country, country_code, country_count, math.log(country_count), hover_text]
+        # load set of polygons for each country in the data
+        countries = countries_geojson(df['alpha_3'], self.map_tolerance)
 
-        df = pd.DataFrame.from_dict(map_data, orient='index', columns=['country', 'country_code', 'count', 'log_count', 'text'])
+        # format the data  specifically for map display
+        df['log_count'] = np.log(df['count'])
+        df['text'] = ['Country : {0}<br>Count: {1:,}'.format(name, count) for name, count in zip(df['name'], df['count'])]
 
         # set up colorbar with raw counts in place of log values
-        min_max_count = [f"{x:,}" for x in (df['count'].min(), int(df['count'].mean()), df['count'].max())]
+        counts = df['count'] if len(df) > 0 else pd.Series([0])       # A filtered view may have no countries to map
+        min_max_count = [f"{x:,}" for x in (counts.min(), int(counts.mean()), counts.max())]
         min_max_log = [0, 6, 12] # is 12 always the max or just this time - and why?
         count_colorbar = go.choroplethmapbox.ColorBar(
             tickmode='array', tickvals=min_max_log, ticktext=min_max_count, tickfont={"size":20}
@@ -173,7 +201,7 @@ class GeneratePlots:
 
         # create the map and display
         map = go.Figure(go.Choroplethmapbox(
-            geojson=countries, locations=df.country_code, z=df.log_count, colorscale='Blues', # colorscale="Viridis",
+            geojson=countries, locations=df.alpha_3, z=df.log_count, colorscale='Blues', # colorscale="Viridis",
             zmin=0, zmax=12, marker_opacity=0.5, marker_line_width=0, colorbar=count_colorbar,
             text=df.text, hoverinfo='text'
         ))
@@ -185,11 +213,38 @@ class GeneratePlots:
             map.update_geos(scope=scope)
         return map
 
-    def datahub_pie(self, variable):
+    def datahub_pie(self, variable, filters=()):
         """
         Creates pie chart describing data hub holdings [INTERACTIVE]
         :param variable: The variable to create a pie chart on
+        :param filters: Filter key (from filter_index.make_filters()), empty for all records
         :return: Pie chart object
         """
-        fig = px.pie(self.read_run, names=variable, title="<b>Data hub holdings composition: {}</b>".format(variable.replace("_", " ").capitalize()))
-        return fig
\ No newline at end of file
+        fig = px.pie(select(self.view(filters), variable), names='value', values='count', title=pie_title(variable))
+        return fig
+
+    def pie_counts(self, filters=()):
+        """
+        Obtain the counts of every pie chart variable, for the pie chart to be switched between variables in the browser
+        :param filters: Filter key (from filter_index.make_filters()), empty for all records
+        :return: Dictionary of the pie chart trace and layout (without values), and the labels, values and title per variable
+        """
+        cube = self.view(filters)
+        fig = px.pie(select(cube, pie_variables[0]), names='value', values='count', title=pie_title(pie_variables[0]))        # Styling shared by the pie chart of every variable
+        trace = fig.data[0].to_plotly_json()
+        for key in ['labels', 'values']:
+            trace.pop(key, None)
+        counts = {}
+        for variable in pie_variables:
+            values = select(cube, variable)
+            counts[variable] = {'labels': values['value'].astype(str).tolist(), 'values': values['count'].tolist(), 'title': pie_title(variable)}
+        return {'trace': trace, 'layout': fig.layout.to_plotly_json(), 'counts': counts}
+
+
+def pie_title(variable):
+    """
+    Obtain the title of the pie chart of a variable
+    :param variable: The variable of the pie chart
+    :return: Title text
+    """
+    return "<b>Data hub holdings composition: {}</b>".format(variable.replace("_", " ").capitalize())
@@ -0,0 +1,164 @@
+#!/usr/bin/env/python3
+# This script handles the sending of requests to the Portal API
+
+__author__ = 'Nadim Rahman'
+
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
+import requests
+import json, os, threading, time
+
+
+def create_session(pool_size=4, retries=5, backoff_factor=1):
+    """
+    Create a session that keeps connections open and retries failed requests
+    :param pool_size: Number of connections to keep open to the Portal API
+    :param retries: Number of times a failed request is retried
+    :param backoff_factor: Factor for the exponential delay between retries, in seconds
+    :return: Session object to send requests with
+    """
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class PortalClient:
+    """
+    Send requests to the Portal API over a pool of kept-alive connections, retrying failed requests with exponential backoff.
+    Searches can be sent conditionally, so that results which have not changed since they were last saved are not downloaded again.
+    Requests can be limited to a maximum rate, so that data hubs refreshed at the same time share the Portal API.
+    The latency, bytes transferred and retries of each request are recorded.
+    """
+    def __init__(self, pool_size=4, retries=5, backoff_factor=1, connect_timeout=10, read_timeout=300,
+                 validators_file=os.path.join('data', 'portal_validators.json'), max_rate=None):
+        self.session = create_session(pool_size, retries, backoff_factor)
+        self.session.headers['Accept-Encoding'] = 'gzip'        # Tab-separated results compress well
+        self.timeout = (connect_timeout, read_timeout)      # The read timeout is the longest wait for data, not for the whole response
+        self.validators_file = validators_file
+        self.saved_validators = {}      # Request key -> ETag and Last-Modified of the response, and details of where its results were saved
+        if os.path.exists(self.validators_file):
+            with open(self.validators_file) as f:
+                self.saved_validators = json.load(f)
+        self.sent = []      # One dictionary per request sent
+        self.lock = threading.Lock()
+        self.interval = 1 / max_rate if max_rate else 0     # Least time between the start of requests, in seconds
+        self.next_request = 0       # Earliest time the next request can be sent (time.monotonic())
+        self.rate_lock = threading.Lock()
+
+    def request_key(url, params=None):
+        """
+        Obtain the key that validators of a request are saved under
+        :param url: URL of the request
+        :param params: Parameters of the request
+        :return: Full URL of the request
+        """
+        return requests.Request('GET', url, params=params).prepare().url
+
+    def get(self, url, params=None, headers=None, auth=None, stream=False, validators=None):
+        """
+        Send a GET request
+        :param url: URL of the request
+        :param params: Parameters of the request
+        :param headers: Headers of the request
+        :param auth: Authentication object, or None if authentication is not required
+        :param stream: Whether to defer downloading the response body until it is read
+        :param validators: Validators of a previous response (from validators()), to only download the body if it has changed
+        :return: Response object, with status 304 (Not Modified) if the body has not changed
+        """
+        headers = dict(headers or {})
+        if validators is not None:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        self.wait_for_rate()
+        start = time.perf_counter()
+        response = self.session.get(url, params=params, headers=headers, auth=auth, stream=stream, timeout=self.timeout)
+        retries = response.raw.retries
+        with self.lock:
+            self.sent.append({'path': urlparse(url).path, 'status': response.status_code,
+                              'seconds': time.perf_counter() - start,       # Until the headers are received for streamed responses
+                              'retries': len(retries.history) if retries is not None else 0,
+                              'raw': response.raw})     # Kept to obtain the bytes transferred, once the body has been read
+        return response
+
+    def wait_for_rate(self):
+        """
+        Wait until a request can be sent within the maximum rate, requests sent concurrently (e.g. pages) waiting in turn
+        :return: Seconds waited
+        """
+        if not self.interval:
+            return 0
+        with self.rate_lock:
+            now = time.monotonic()
+            send = max(now, self.next_request)
+            self.next_request = send + self.interval
+        if send > now:
+            time.sleep(send - now)
+        return send - now
+
+    def metrics(self):
+        """
+        Obtain the details of each request sent
+        :return: List of dictionaries of path, status, latency (seconds), bytes transferred (compressed) and retries per request
+        """
+        with self.lock:
+            return [{'path': request['path'], 'status': request['status'], 'seconds': round(request['seconds'], 3),
+                     'bytes': request['raw'].tell(), 'retries': request['retries']} for request in self.sent]
+
+    def totals(self):
+        """
+        Obtain the totals over all requests sent
+        :return: Dictionary of the number of requests, unchanged (304) responses, seconds, bytes transferred and retries
+        """
+        metrics = self.metrics()
+        return {'requests': len(metrics), 'not_modified': sum(request['status'] == 304 for request in metrics),
+                'seconds': round(sum(request['seconds'] for request in metrics), 3),
+                'bytes': sum(request['bytes'] for request in metrics), 'retries': sum(request['retries'] for request in metrics)}
+
+    def summary(self):
+        """
+        Describe the totals over all requests sent
+        :return: Summary text
+        """
+        totals = self.totals()
+        return '{:,} requests ({:,} unchanged), {:,.1f} MB transferred, {:,} retries, {:,.1f}s waiting for responses'.format(
+            totals['requests'], totals['not_modified'], totals['bytes'] / 1024 ** 2, totals['retries'], totals['seconds'])
+
+    def validators(self, key):
+        """
+        Obtain the saved validators of a request
+        :param key: Request key (from request_key())
+        :return: Dictionary of ETag, Last-Modified and details saved with them, or None if there are none
+        """
+        with self.lock:
+            return self.saved_validators.get(key)
+
+    def remember(self, key, response, **details):
+        """
+        Save the validators of a response, once its body has been saved
+        :param key: Request key (from request_key())
+        :param response: Response object
+        :param details: Details to save with the validators (e.g. the date of the snapshot the body was saved to)
+        :return:
+        """
+        with self.lock:
+            previous = self.saved_validators.get(key, {})
+            validators = {'etag': response.headers.get('ETag', previous.get('etag')),
+                          'last_modified': response.headers.get('Last-Modified', previous.get('last_modified'))}     # Not always repeated in a 304 response
+            if not any(validators.values()):
+                return      # The server does not support conditional requests
+            self.saved_validators[key] = dict(validators, **details)
+            os.makedirs(os.path.dirname(self.validators_file) or '.', exist_ok=True)
+            temporary_file = '{}.{}'.format(self.validators_file, os.getpid())
+            with open(temporary_file, 'w') as f:
+                json.dump(self.saved_validators, f, indent=1, sort_keys=True)
+            os.replace(temporary_file, self.validators_file)
+
+    def close(self):
+        self.session.close()
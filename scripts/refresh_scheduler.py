@@ -0,0 +1,290 @@
+#!/usr/bin/env/python3
+# This script handles the scheduled refresh of several data hubs, running visualisation_prep.py for each of them
+
+__author__ = 'Nadim Rahman'
+
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from hub_registry import snapshot_names
+from result_types import config_file
+from snapshot_store import SnapshotStore
+import argparse, datetime, fcntl, json, os, signal, subprocess, sys, threading, time, yaml
+
+scripts_directory = os.path.dirname(os.path.realpath(__file__))
+time_format = '%Y-%m-%dT%H:%M:%S'
+
+
+def get_args():
+    """
+    Handle script arguments
+    :return: Script arguments
+    """
+    parser = argparse.ArgumentParser(prog='refresh_scheduler.py', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="""
+        + =========================================================== +
+        |  ENA Data Hubs Dashboard: refresh_scheduler.py              |
+        |  Python script to refresh the data hubs listed in           |
+        |  config.yaml, a few at a time.                              |
+        + =========================================================== +
+        """)
+    parser.add_argument('-c', '--config', help='Configuration file listing the data hubs to refresh (default: config.yaml)', type=str, default=config_file)
+    parser.add_argument('-u', '--username', help='Only refresh these data hubs (e.g. dcc_XXXXX)', type=str, nargs='+')
+    parser.add_argument('--max-concurrent', help='Number of data hubs refreshed at once (default: REFRESH_CONCURRENCY in the configuration file)', type=int)
+    parser.add_argument('--force', help='Refresh data hubs even if they were refreshed recently', action='store_true')
+    parser.add_argument('--restart', help='Start a new run, rather than resuming an interrupted one', action='store_true')
+    parser.add_argument('--status', help='Show the state of each data hub, without refreshing any', action='store_true')
+    parser.add_argument('--portal-url', help='Base URL of the Portal API, passed to visualisation_prep.py (e.g. of scripts/mock_portal.py)', type=str)
+    args = parser.parse_args()
+    return args
+
+
+def load_schedule(path=config_file):
+    """
+    Load the data hubs to refresh and the limits of the refresh from the configuration file
+    :param path: Path to the configuration file
+    :return: Dictionary of data hub to its settings (password_env, max_rate, fresh_hours and args), and a dictionary of
+             the number of data hubs refreshed at once and the path to the state file
+    """
+    with open(path) as f:
+        configuration = yaml.safe_load(f)
+    if not configuration.get('REFRESH_HUBS'):
+        raise ValueError('No data hubs to refresh, list them under REFRESH_HUBS in {}'.format(path))
+
+    hubs = {}
+    for datahub, settings in configuration['REFRESH_HUBS'].items():
+        settings = settings or {}
+        hubs[datahub] = {'password_env': settings.get('password_env', '{}_PASSWORD'.format(datahub.upper())),
+                         'max_rate': settings.get('max_rate', configuration.get('REFRESH_MAX_RATE')),
+                         'fresh_hours': settings.get('fresh_hours', configuration.get('REFRESH_FRESH_HOURS', 20)),
+                         'args': [str(arg) for arg in settings.get('args') or []]}
+    limits = {'concurrency': configuration.get('REFRESH_CONCURRENCY', 2),
+              'state_file': configuration.get('REFRESH_STATE_FILE', os.path.join('data', 'refresh_state.json'))}
+    return hubs, limits
+
+
+class RefreshScheduler:
+    """
+    Refresh several data hubs, a few at a time, each by a run of visualisation_prep.py in a process of its own.
+    Data hubs refreshed recently are skipped, and the state of each is kept in a JSON file: the run it was last
+    attempted in and the time, duration and rows of its last success. A run that was interrupted is resumed by the
+    next, which refreshes the data hubs it had not completed first.
+    """
+    def __init__(self, hubs, state_file, concurrency=2, portal_url=None, force=False):
+        self.hubs = hubs        # Data hub -> settings, from load_schedule()
+        self.state_file = state_file
+        self.concurrency = concurrency
+        self.portal_url = portal_url
+        self.force = force
+        self.state = {'run': None, 'hubs': {}}
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                self.state = json.load(f)
+        self.processes = set()      # Refreshes running
+        self.stopping = False       # Whether the run has been interrupted
+        self.lock = threading.Lock()
+
+    def save(self):
+        """
+        Save the state of the refresh. Must be called with the lock held.
+        :return: Path to the state file
+        """
+        os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+        temporary_file = '{}.{}.tmp'.format(self.state_file, os.getpid())
+        with open(temporary_file, 'w') as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(temporary_file, self.state_file)     # Never left partly written, even if the run is interrupted
+        return self.state_file
+
+    def update(self, datahub, **fields):
+        """
+        Update and save the state of a data hub
+        :param datahub: Name of data hub
+        :param fields: Fields of the state to set (e.g. status='running')
+        :return:
+        """
+        with self.lock:
+            self.state['hubs'].setdefault(datahub, {}).update(fields)
+            self.save()
+
+    def is_fresh(self, datahub):
+        """
+        Check whether a data hub was refreshed recently enough to skip, and its snapshot is still saved
+        :param datahub: Name of data hub
+        :return: True if the data hub does not need refreshing
+        """
+        success = self.state['hubs'].get(datahub, {}).get('last_success')
+        if self.force or success is None:
+            return False
+        age = datetime.datetime.now() - datetime.datetime.strptime(success['finished'], time_format)
+        return age < datetime.timedelta(hours=self.hubs[datahub]['fresh_hours']) and \
+            SnapshotStore(datahub).find(snapshot_names[-1], success['snapshot']) is not None
+
+    def plan(self, restart=False):
+        """
+        Start a run, or resume the last run if it was interrupted, and choose the data hubs to refresh in it
+        :param restart: Start a new run even if the last run was interrupted
+        :return: List of data hubs to refresh, in order
+        """
+        run = self.state.get('run')
+        resumed = run is not None and run.get('finished') is None and not restart
+        if resumed:
+            print('> Resuming the run started {}'.format(run['started']))
+        else:
+            now = datetime.datetime.now().strftime(time_format)
+            run = {'id': now, 'started': now, 'finished': None, 'hubs': []}
+
+        queue = []
+        for datahub in self.hubs:
+            hub = self.state['hubs'].get(datahub, {})
+            if hub.get('run') == run['id'] and hub.get('status') == 'completed':
+                print('> Skipping {}, refreshed earlier in this run'.format(datahub))
+            elif resumed and datahub in run['hubs']:
+                queue.append(datahub)       # Not completed when the run was interrupted, however recently it was refreshed before
+            elif self.is_fresh(datahub):
+                print('> Skipping {}, refreshed {}'.format(datahub, hub['last_success']['finished']))
+            else:
+                queue.append(datahub)
+        queue.sort(key=lambda datahub: self.state['hubs'].get(datahub, {}).get('run') != run['id'])      # Interrupted data hubs first
+
+        run['hubs'] = sorted(set(run['hubs']) | set(queue))     # Data hubs to refresh in this run
+        with self.lock:
+            self.state['run'] = run
+            self.save()
+        return queue
+
+    def command(self, datahub):
+        """
+        Build the command to refresh a data hub
+        :param datahub: Name of data hub
+        :return: List of command arguments
+        """
+        settings = self.hubs[datahub]
+        command = [sys.executable, '-u', os.path.join(scripts_directory, 'visualisation_prep.py'), '-u', datahub]
+        if settings['max_rate']:
+            command += ['--max-rate', str(settings['max_rate'])]
+        if self.portal_url:
+            command += ['--portal-url', self.portal_url]
+        return command + settings['args']
+
+    def refresh(self, datahub):
+        """
+        Refresh a data hub, saving the output of the run to a log file
+        :param datahub: Name of data hub
+        :return: True if the refresh succeeded
+        """
+        password = os.environ.get(self.hubs[datahub]['password_env'])
+        started = datetime.datetime.now()
+        store = SnapshotStore(datahub)
+        log = store.path('refresh', started.strftime('%d%m%Y'), 'log')
+        self.update(datahub, run=self.state['run']['id'], status='running', started=started.strftime(time_format), log=log, error=None)
+        if password is None:
+            self.update(datahub, status='failed', error='No password, set the {} environment variable'.format(self.hubs[datahub]['password_env']))
+            print('> {} failed: no password in {}'.format(datahub, self.hubs[datahub]['password_env']))
+            return False
+
+        print('> Refreshing {}...'.format(datahub))
+        start = time.perf_counter()
+        os.makedirs(os.path.dirname(log) or '.', exist_ok=True)
+        with open(log, 'w') as f:
+            # The password is passed in the environment, so that it is not shown in the list of processes
+            process = subprocess.Popen(self.command(datahub), stdout=f, stderr=subprocess.STDOUT, env=dict(os.environ, DATAHUB_PASSWORD=password))
+            with self.lock:
+                self.processes.add(process)
+                if self.stopping:
+                    process.terminate()     # Started as the run was interrupted
+            process.wait()
+            with self.lock:
+                self.processes.discard(process)
+        seconds = round(time.perf_counter() - start, 3)
+        if self.stopping:
+            self.update(datahub, status='interrupted', seconds=seconds, error='Interrupted, the next run resumes it')
+            print('> Refreshing {}... [INTERRUPTED]'.format(datahub))
+            return False
+
+        report = None
+        for date in {datetime.date.today().strftime('%d%m%Y'), started.strftime('%d%m%Y')}:     # The run may pass midnight
+            if os.path.exists(store.path('run_report', date, 'json')):
+                with open(store.path('run_report', date, 'json')) as f:
+                    report = dict(json.load(f), date=date)
+        if process.returncode != 0 or report is None or report['status'] != 'completed':
+            error = report['error'] if report is not None and report.get('error') else 'Exited with code {}, see {}'.format(process.returncode, log)
+            self.update(datahub, status='failed', seconds=seconds, error=error)
+            print('> Refreshing {}... [FAILED] [{}]'.format(datahub, error))
+            return False
+
+        rows = sum(report['rows'].values())
+        self.update(datahub, status='completed', seconds=seconds, last_success={'finished': datetime.datetime.now().strftime(time_format), 'snapshot': report['date'],
+                                                                                 'seconds': seconds, 'rows': rows, 'rows_by_type': report['rows']})
+        print('> Refreshing {}... [DONE] [{:,} rows, {:,.1f}s]'.format(datahub, rows, seconds))
+        return True
+
+    def run(self, restart=False):
+        """
+        Refresh the data hubs that need it, at most concurrency at once
+        :param restart: Start a new run even if the last run was interrupted
+        :return: Dictionary of data hub to whether its refresh succeeded
+        """
+        queue = self.plan(restart)
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            results = dict(zip(queue, executor.map(self.refresh, queue)))
+        except BaseException:
+            # Data hubs not yet refreshed are left to the next run, which resumes this one
+            executor.shutdown(wait=False, cancel_futures=True)
+            with self.lock:
+                self.stopping = True
+                for process in self.processes:
+                    process.terminate()
+            raise
+        executor.shutdown()
+        with self.lock:
+            self.state['run'].update(finished=datetime.datetime.now().strftime(time_format),
+                                     failed=sorted(datahub for datahub, succeeded in results.items() if not succeeded))
+            self.save()
+        return results
+
+    def status(self):
+        """
+        Describe the state of each data hub
+        :return: Data frame of the status, last success, duration and rows of each data hub
+        """
+        rows = []
+        for datahub in self.hubs:
+            hub = self.state['hubs'].get(datahub, {})
+            success = hub.get('last_success') or {}
+            rows.append([datahub, hub.get('status'), success.get('finished'), success.get('snapshot'), success.get('seconds'), success.get('rows'), hub.get('error')])
+        return pd.DataFrame(rows, columns=['datahub', 'status', 'last_success', 'snapshot', 'seconds', 'rows', 'error']).astype({'rows': 'Int64'})
+
+
+if __name__ == '__main__':
+    args = get_args()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)       # Stopped as if interrupted, e.g. by a service manager
+    hubs, limits = load_schedule(args.config)
+    if args.username:
+        unknown = sorted(set(args.username) - set(hubs))
+        if unknown:
+            raise SystemExit('Not listed under REFRESH_HUBS in {}: {}'.format(args.config, ', '.join(unknown)))
+        hubs = {datahub: settings for datahub, settings in hubs.items() if datahub in args.username}
+    if args.status:
+        print(RefreshScheduler(hubs, limits['state_file']).status().to_string(index=False))
+        sys.exit(0)
+
+    # Only one scheduler runs at once, e.g. if a refresh takes longer than the interval between scheduled runs
+    os.makedirs(os.path.dirname(limits['state_file']) or '.', exist_ok=True)
+    lock_file = open(limits['state_file'] + '.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        raise SystemExit('Another refresh is running (locked {})'.format(lock_file.name))
+
+    print('---> Refreshing data hubs...')
+    scheduler = RefreshScheduler(hubs, limits['state_file'], args.max_concurrent or limits['concurrency'], args.portal_url, args.force)
+    try:
+        results = scheduler.run(args.restart)
+    except KeyboardInterrupt:
+        raise SystemExit('---> Refreshing data hubs... [INTERRUPTED] [resumed by the next run]')
+    print(scheduler.status().to_string(index=False))
+    failed = [datahub for datahub, succeeded in results.items() if not succeeded]
+    if failed:
+        raise SystemExit('---> Refreshing data hubs... [FAILED] [{}]'.format(', '.join(failed)))
+    print('---> Refreshing data hubs... [COMPLETED] [{} refreshed]'.format(len(results)))
@@ -0,0 +1,153 @@
+#!/usr/bin/env/python3
+# This script handles the compaction of figures and the compression of the responses of the application
+
+__author__ = 'Nadim Rahman'
+
+from collections import OrderedDict
+import datetime, gzip, hashlib, math, threading
+try:
+    import brotli       # Optional, responses are gzip compressed without it
+except ImportError:
+    brotli = None
+
+compressible_types = ['application/json', 'text/html', 'text/css', 'text/plain', 'application/javascript', 'text/javascript']
+minimum_size = 1024     # Bytes, smaller responses are sent uncompressed as compressing them saves little
+repeated_size = 32      # Number of compressed GET responses kept
+repeated_responses = OrderedDict()      # (Digest of the content, encoding) to compressed content, least recently used first
+repeated_lock = threading.Lock()
+
+
+def compact(value, decimals=3):
+    """
+    Compact the values of a figure for JSON: floats are rounded, whole floats are written as integers and dates without
+    a time are written without one (e.g. '2021-03-01' rather than '2021-03-01T00:00:00')
+    :param value: Value of a figure (e.g. a dictionary of a trace, an array or a number)
+    :param decimals: Number of decimal places to round floats to (e.g. 3 for map coordinates to about 100m)
+    :return: Value of plain Python types
+    """
+    if isinstance(value, dict):
+        return {key: compact(item, decimals) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [compact(item, decimals) for item in value]
+    if hasattr(value, 'dtype'):
+        import numpy as np      # Loaded already, by whatever made a value with a dtype (e.g. a numpy array)
+        if isinstance(value, np.ndarray):
+            if value.dtype.kind == 'f' and np.isfinite(value).all():
+                rounded = np.round(value, decimals)
+                return rounded.astype(np.int64).tolist() if (rounded == np.round(rounded)).all() else rounded.tolist()
+            if value.dtype.kind == 'M':
+                value = value.astype('datetime64[us]')      # Converted to datetime objects by tolist()
+            return [compact(item, decimals) for item in value.tolist()]
+        if isinstance(value, np.integer):
+            return int(value)
+        if isinstance(value, np.floating):
+            value = float(value)
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return float(value)
+        rounded = round(float(value), decimals)
+        return int(rounded) if rounded == int(rounded) else rounded
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d') if value.time() == datetime.time() else value.isoformat()
+    return value
+
+
+def compact_figure(figure, decimals=3):
+    """
+    Compact a figure before it is cached and sent to the browser
+    :param figure: Figure object or dictionary (e.g. the pie chart counts), other objects (e.g. HTML) are returned as they are
+    :param decimals: Number of decimal places to round floats to
+    :return: Figure as a dictionary of plain Python types
+    """
+    import plotly.graph_objects as go
+    if isinstance(figure, go.Figure):
+        return compact(figure.to_plotly_json(), decimals)
+    if isinstance(figure, dict):
+        return compact(figure, decimals)
+    return figure
+
+
+def accepted_encoding(accept_encoding, available=None):
+    """
+    Choose the compression of a response
+    :param accept_encoding: Accept-Encoding header of the request
+    :param available: Encodings available, most preferred first (default: 'br' if brotli is installed, and 'gzip')
+    :return: The first available encoding accepted, or None if none are accepted
+    """
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        encoding, _, parameters = part.strip().partition(';')
+        if parameters.strip().replace(' ', '') not in ['q=0', 'q=0.0', 'q=0.00', 'q=0.000']:
+            accepted.add(encoding.strip().lower())
+    if available is None:
+        available = ['br', 'gzip'] if brotli is not None else ['gzip']
+    for encoding in available:
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return None
+
+
+def compress(content, encoding):
+    """
+    Compress the content of a response
+    :param content: Content (bytes)
+    :param encoding: 'br' or 'gzip'
+    :return: Compressed content
+    """
+    if encoding == 'br':
+        return brotli.compress(content, quality=5)
+    return gzip.compress(content, compresslevel=6, mtime=0)
+
+
+def compress_repeated(content, encoding):
+    """
+    Compress the content of a GET response, keeping recent results as the same responses (e.g. scripts) are sent repeatedly.
+    Results are kept by a digest of the content, so that the content itself is not kept as well.
+    :param content: Content (bytes)
+    :param encoding: 'br' or 'gzip'
+    :return: Compressed content
+    """
+    key = (hashlib.sha1(content).digest(), encoding)
+    with repeated_lock:
+        if key in repeated_responses:
+            repeated_responses.move_to_end(key)
+            return repeated_responses[key]
+    compressed = compress(content, encoding)        # Outside the lock, so that other responses are not held up
+    with repeated_lock:
+        repeated_responses[key] = compressed
+        while len(repeated_responses) > repeated_size:
+            repeated_responses.popitem(last=False)
+    return compressed
+
+
+def prepare_response(response, request):
+    """
+    Compress a response for the client, and give GET responses an ETag so that unchanged content is not sent again
+    :param response: Flask response
+    :param request: Flask request the response is for
+    :return: Flask response, 304 (Not Modified) if the client has the content already
+    """
+    if response.direct_passthrough or response.is_streamed or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response     # Files sent as they are read, errors and responses compressed already
+    content = response.get_data()
+    encoding = None
+    if response.mimetype in compressible_types and len(content) >= minimum_size:
+        response.vary.add('Accept-Encoding')
+        encoding = accepted_encoding(request.headers.get('Accept-Encoding'))
+
+    if request.method == 'GET':
+        etag, weak = response.get_etag()
+        if etag is None:
+            response.add_etag()     # Of the uncompressed content
+            etag, weak = response.get_etag()
+            if 'Cache-Control' not in response.headers:
+                response.headers['Cache-Control'] = 'no-cache'      # Revalidated on each use, with a 304 if unchanged
+        if encoding is not None:
+            response.set_etag('{}-{}'.format(etag, encoding), weak)      # Each encoding is a different representation
+        if request.if_none_match.contains_weak(response.get_etag()[0]):
+            return response.make_conditional(request)       # Not compressed, as it is not sent
+
+    if encoding is not None:
+        response.set_data(compress_repeated(content, encoding) if request.method == 'GET' else compress(content, encoding))        # Callback responses are rarely the same
+        response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,40 @@
+#!/usr/bin/env/python3
+# This script handles the registry of ENA result types searched for and summarised, which are defined in config.yaml
+
+__author__ = 'Nadim Rahman'
+
+import os, yaml
+
+config_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'config.yaml')
+
+
+def load_result_types(path=config_file):
+    """
+    Load the result types to search for and summarise from the configuration file
+    :param path: Path to the configuration file
+    :return: Dictionary of result type to its search (fields, data portal, query and whether authentication is required),
+             data hub stats (label to 'rows' or a column to count the distinct values of) and dimensions to aggregate
+    """
+    with open(path) as f:
+        configuration = yaml.safe_load(f)
+
+    result_types = {}
+    for result_type, definition in configuration['RESULT_TYPES'].items():
+        search = {'search_fields': definition['fields'], 'result_type': result_type, 'data_portal': definition.get('data_portal', 'pathogen'),
+                  'stats': definition.get('stats') or {}, 'aggregations': definition.get('aggregations') or ['day']}
+        if definition.get('authentication', True):
+            search['authentication'] = 'True'
+        if definition.get('query'):
+            search['query'] = definition['query']
+
+        # Check that everything summarised is searched for, rather than failing once the data has been downloaded
+        columns = [column for column in search['stats'].values() if column != 'rows']
+        columns += ['first_created' if dimension == 'day' else dimension for dimension in search['aggregations']]
+        missing = sorted(set(columns) - set(search['search_fields']))
+        if missing:
+            raise ValueError('Result type {} in {} summarises fields that are not searched for: {}'.format(result_type, path, ', '.join(missing)))
+        result_types[result_type] = search
+    return result_types
+
+
+result_types = load_result_types()      # Result types in the order they are presented
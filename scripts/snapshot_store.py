@@ -0,0 +1,309 @@
+#!/usr/bin/env/python3
+# This script handles the saving and loading of data hub snapshots in a typed, columnar format
+
+__author__ = 'Nadim Rahman'
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import argparse, datetime, glob, os, time
+
+# Low cardinality columns, which are dictionary encoded
+categorical_columns = ['instrument_platform', 'instrument_model', 'library_layout', 'library_selection', 'library_source',
+                       'library_strategy', 'country', 'center_name', 'broker_name', 'tax_id', 'scientific_name',
+                       'analysis_type', 'pipeline_name', 'pipeline_version', 'result_type']
+date_columns = ['first_public', 'first_created']        # collection_date is free text (e.g. '2020', 'missing'), so is kept as a string
+csv_types = {column: 'category' for column in categorical_columns}     # Types to parse tab-separated results as, so that categorical columns are never held as strings
+row_group_rows = 100000     # Maximum rows per Parquet row group, the unit that snapshots are aggregated in parallel by
+
+
+def get_args():
+    """
+    Handle script arguments
+    :return: Script arguments
+    """
+    parser = argparse.ArgumentParser(prog='snapshot_store.py', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="""
+        + =========================================================== +
+        |  ENA Data Hubs Dashboard: snapshot_store.py                 |
+        |  Python script to convert saved tab-separated snapshots to  |
+        |  Parquet and compare their load times.                      |
+        + =========================================================== +
+        """)
+    parser.add_argument('-u', '--username', help='Data Hub username (e.g. dcc_XXXXX)', type=str, required=True)
+    parser.add_argument('--convert', help='Convert all tab-separated snapshots of the data hub to Parquet', action='store_true')
+    parser.add_argument('--benchmark', help='Compare the load time and memory of the tab-separated and Parquet snapshot of a date', action='store_true')
+    parser.add_argument('-d', '--date', help='Date of the snapshot to benchmark (DDMMYYYY, default: latest)', type=str)
+    args = parser.parse_args()
+    return args
+
+
+def string_array(values):
+    """
+    Convert a column to an array of strings, keeping missing values as nulls
+    :param values: Series of values
+    :return: Arrow string array
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype(object)
+    if not (pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)):
+        values = values.astype(str).where(values.notna())
+    return pa.array(values, type=pa.string(), from_pandas=True)
+
+
+def to_table(df):
+    """
+    Convert a data frame to a typed Arrow table, with dictionary encoded categorical columns and date columns
+    :param df: Data frame to convert
+    :return: Arrow table
+    """
+    arrays = []
+    for column in df.columns:
+        values = df[column]
+        if column in date_columns:
+            arrays.append(pa.array(pd.to_datetime(values, errors='coerce'), from_pandas=True).cast(pa.date32()))
+        elif column in categorical_columns:
+            arrays.append(string_array(values).dictionary_encode())
+        else:
+            array = pa.array(values, from_pandas=True)
+            if pa.types.is_null(array.type) or pa.types.is_large_string(array.type):
+                array = array.cast(pa.string())     # Keeps text columns the same type, even when every value is missing
+            arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=[str(column) for column in df.columns])
+
+
+def typed(df):
+    """
+    Apply the snapshot column types to a data frame read from a tab-separated file
+    :param df: Data frame to convert
+    :return: Data frame with categorical and date columns
+    """
+    for column in df.columns:
+        if column in date_columns:
+            df[column] = pd.to_datetime(df[column], errors='coerce')
+        elif column in categorical_columns:
+            df[column] = df[column].astype('category')
+    return df
+
+
+def read_file(path, columns=None):
+    """
+    Read a snapshot file, in either Parquet or tab-separated format
+    :param path: Path to the snapshot file
+    :param columns: Columns to load (default: all)
+    :return: Data frame
+    """
+    if path.endswith('.parquet'):
+        return pq.read_table(path, columns=columns).to_pandas(date_as_object=False)
+    return typed(pd.read_csv(path, sep="\t", usecols=columns, dtype=csv_types))
+
+
+class SnapshotWriter:
+    """
+    Write a snapshot to file in chunks, so that it does not need to be held in memory in full
+    """
+    def __init__(self, path):
+        self.path = path
+        self.temporary_path = '{}.{}.tmp'.format(path, os.getpid())        # Written to, then moved into place once complete
+        self.writer = None      # Created with the schema of the first chunk
+        self.rows = 0
+
+    def write(self, chunk):
+        table = to_table(chunk)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.temporary_path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema), row_group_size=row_group_rows)
+        self.rows += len(chunk)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.temporary_path, self.path)
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.writer is not None:
+            self.writer.close()
+            os.remove(self.temporary_path)      # Do not leave an incomplete snapshot behind
+            self.writer = None
+        self.close()
+
+
+class SnapshotStore:
+    """
+    Save and load the daily snapshots of a data hub, named '{datahub}_{name}_{DDMMYYYY}.parquet' in the data directory.
+    Snapshots saved as tab-separated files (.txt) are read if there is no Parquet snapshot.
+    """
+    def __init__(self, datahub, directory='data'):
+        self.datahub = datahub      # Name of data hub
+        self.directory = directory
+
+    def path(self, name, date, extension='parquet'):
+        """
+        Obtain the path of a snapshot
+        :param name: Name of the snapshot (e.g. ENA_Search_read_run)
+        :param date: Date of the snapshot (DDMMYYYY)
+        :param extension: File extension of the snapshot
+        :return: Path to the snapshot file
+        """
+        return os.path.join(self.directory, '{}_{}_{}.{}'.format(self.datahub, name, date, extension))
+
+    def find(self, name, date):
+        """
+        Find the file of a snapshot, preferring Parquet over tab-separated
+        :return: Path to the snapshot file, or None if it does not exist
+        """
+        for extension in ['parquet', 'txt']:
+            if os.path.exists(self.path(name, date, extension)):
+                return self.path(name, date, extension)
+        return None
+
+    def dates(self, name):
+        """
+        List the dates that a snapshot exists for
+        :param name: Name of the snapshot
+        :return: Sorted list of dates (DDMMYYYY), oldest first
+        """
+        dates = set()
+        prefix = os.path.join(self.directory, '{}_{}_'.format(self.datahub, name))
+        for path in glob.glob(prefix + '*.parquet') + glob.glob(prefix + '*.txt'):
+            date = os.path.splitext(path[len(prefix):])[0]
+            try:
+                datetime.datetime.strptime(date, '%d%m%Y')
+            except ValueError:
+                continue        # Not a snapshot of this name (e.g. a longer name sharing the prefix)
+            dates.add(date)
+        return sorted(dates, key=lambda date: datetime.datetime.strptime(date, '%d%m%Y'))
+
+    def latest(self, name):
+        """
+        Obtain the date of the most recent snapshot
+        :param name: Name of the snapshot
+        :return: Date of the snapshot (DDMMYYYY), or None if there are none
+        """
+        dates = self.dates(name)
+        return dates[-1] if dates else None
+
+    def latest_complete(self, names):
+        """
+        Obtain the date of the most recent snapshot for which all of the named snapshots exist
+        :param names: Names of the snapshots
+        :return: Date of the snapshots (DDMMYYYY), or None if there are none
+        """
+        dates = set.intersection(*[set(self.dates(name)) for name in names])
+        return max(dates, key=lambda date: datetime.datetime.strptime(date, '%d%m%Y')) if dates else None
+
+    def read(self, name, date, columns=None):
+        """
+        Load a snapshot
+        :param name: Name of the snapshot
+        :param date: Date of the snapshot (DDMMYYYY)
+        :param columns: Columns to load (default: all)
+        :return: Data frame
+        """
+        path = self.find(name, date)
+        if path is None:
+            raise FileNotFoundError('No {} snapshot for {} on {}'.format(name, self.datahub, date))
+        return read_file(path, columns)
+
+    def chunks(self, name, date, chunk_rows=100000, columns=None):
+        """
+        Load a snapshot in chunks, so that it does not need to be held in memory in full
+        :param name: Name of the snapshot
+        :param date: Date of the snapshot (DDMMYYYY)
+        :param chunk_rows: Maximum number of rows per chunk
+        :param columns: Columns to load (default: all)
+        :return: Generator of data frame chunks
+        """
+        path = self.find(name, date)
+        if path is None:
+            raise FileNotFoundError('No {} snapshot for {} on {}'.format(name, self.datahub, date))
+        if path.endswith('.parquet'):
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=columns):
+                yield batch.to_pandas(date_as_object=False)
+        else:
+            yield from pd.read_csv(path, sep="\t", dtype=str, usecols=columns, chunksize=chunk_rows)
+
+    def write(self, df, name, date):
+        """
+        Save a snapshot
+        :param df: Data frame to save
+        :param name: Name of the snapshot
+        :param date: Date of the snapshot (DDMMYYYY)
+        :return: Path to the snapshot file
+        """
+        path = self.path(name, date)
+        temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        pq.write_table(to_table(df), temporary_path, row_group_size=row_group_rows)
+        os.replace(temporary_path, path)        # Moved into place in one step, so a snapshot is never read while partly written
+        return path
+
+    def writer(self, name, date):
+        """
+        Create a writer to save a snapshot in chunks
+        :param name: Name of the snapshot
+        :param date: Date of the snapshot (DDMMYYYY)
+        :return: SnapshotWriter object
+        """
+        return SnapshotWriter(self.path(name, date))
+
+    def convert(self):
+        """
+        Convert all tab-separated snapshots of the data hub to Parquet
+        :return: List of paths to the converted snapshots
+        """
+        converted = []
+        for path in sorted(glob.glob(os.path.join(self.directory, '{}_*.txt'.format(self.datahub)))):
+            output = path[:-len('.txt')] + '.parquet'
+            pq.write_table(to_table(pd.read_csv(path, sep="\t", dtype=str)), output, row_group_size=row_group_rows)
+            print('> Converted {} -> {}'.format(path, output))
+            converted.append(output)
+        return converted
+
+    def benchmark(self, name, date, columns=None, repeats=3):
+        """
+        Compare the load time and memory of the tab-separated and Parquet files of a snapshot
+        :param name: Name of the snapshot
+        :param date: Date of the snapshot (DDMMYYYY)
+        :param columns: Columns to load for the projected Parquet load
+        :param repeats: Number of loads to take the fastest time of
+        :return: Data frame of load time (seconds) and memory (MB) per load method
+        """
+        loads = {
+            'tsv (untyped)': lambda: pd.read_csv(self.path(name, date, 'txt'), sep="\t"),
+            'tsv (typed)': lambda: read_file(self.path(name, date, 'txt')),
+            'parquet': lambda: read_file(self.path(name, date)),
+        }
+        if columns is not None:
+            loads['tsv (typed, projected)'] = lambda: read_file(self.path(name, date, 'txt'), columns)
+            loads['parquet (projected)'] = lambda: read_file(self.path(name, date), columns)
+
+        results = []
+        for method, load in loads.items():
+            timings = []
+            for i in range(repeats):
+                start = time.perf_counter()
+                df = load()
+                timings.append(time.perf_counter() - start)
+            results.append([method, len(df.columns), min(timings), df.memory_usage(deep=True).sum() / 1024 ** 2])
+        return pd.DataFrame(results, columns=['method', 'columns', 'load_seconds', 'memory_mb'])
+
+
+if __name__ == '__main__':
+    args = get_args()
+    store = SnapshotStore(args.username)
+
+    if args.convert:
+        print('---> Converting snapshots to Parquet...')
+        store.convert()
+        print('---> Converting snapshots to Parquet... [COMPLETED]')
+
+    if args.benchmark:
+        date = args.date or store.latest('ENA_Search_read_run')
+        if not os.path.exists(store.path('ENA_Search_read_run', date, 'txt')) or not os.path.exists(store.path('ENA_Search_read_run', date)):
+            raise SystemExit('Both a tab-separated and a Parquet read_run snapshot are required for {}, run with --convert first'.format(date))
+        from plot_settings import plot_columns       # Columns read by the application, without loading plots.py (and so plotly)
+        print(store.benchmark('ENA_Search_read_run', date, plot_columns).to_string(index=False))
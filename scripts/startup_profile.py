@@ -0,0 +1,167 @@
+#!/usr/bin/env/python3
+# This script profiles the start of the application: the time to import it, the time until it can serve the dashboard
+# and the import time of each package, as paid by every new worker
+
+__author__ = 'Nadim Rahman'
+
+import argparse, datetime, json, os, statistics, subprocess, sys, time
+
+root_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+ready_marker = 'startup_profile: ready'     # Written to stderr once the dashboard can be served, separating the imports of the start from those of the first view
+ready_paths = ['/', '/_dash-layout', '/_dash-dependencies']     # Requested by the browser before any callback
+
+
+def get_args():
+    """
+    Handle script arguments
+    :return: Script arguments
+    """
+    parser = argparse.ArgumentParser(prog='startup_profile.py', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="""
+        + =========================================================== +
+        |  ENA Data Hubs Dashboard: startup_profile.py                |
+        |  Python script to profile the import time of the            |
+        |  application and its time to serve the dashboard in new     |
+        |  worker processes.                                          |
+        + =========================================================== +
+        """)
+    parser.add_argument('-u', '--username', help='Data Hub to time the first view of (default: DATAHUB in config.yaml)', type=str)
+    parser.add_argument('-r', '--repeats', help='Number of worker processes to start, the median of each time being reported (default: 5)', type=int, default=5)
+    parser.add_argument('-n', '--top', help='Number of packages to list by import time (default: 15)', type=int, default=15)
+    parser.add_argument('-o', '--output', help='File to add the results to, so that they can be compared between commits', type=str)
+    parser.add_argument('--worker-output', help=argparse.SUPPRESS, type=str)        # Profile a single worker, in a process of its own
+    parser.add_argument('--launched', help=argparse.SUPPRESS, type=float)
+    args = parser.parse_args()
+    return args
+
+
+def profile_worker(datahub, launched):
+    """
+    Start the application as a new worker would, timing each step
+    :param datahub: Name of data hub to time the first view of (default: DATAHUB in config.yaml)
+    :param launched: Time the process was launched at (seconds since the epoch)
+    :return: Dictionary of the time taken by each step, in seconds
+    """
+    start = time.perf_counter()
+    import app
+    timings = {'import_app': time.perf_counter() - start}
+    client = app.app.server.test_client()
+    for path in ready_paths:
+        response = client.get(path)
+        if response.status_code != 200:
+            raise RuntimeError('{} returned {}'.format(path, response.status_code))
+    timings['import_to_ready'] = time.perf_counter() - start
+    timings['launch_to_ready'] = time.time() - launched        # Including starting Python, as when scaling out
+    print(ready_marker, file=sys.stderr, flush=True)
+
+    datahub = datahub or app.configuration['DATAHUB']
+    date = app.snapshot_date(datahub)
+    start = time.perf_counter()
+    app.hub_registry.get(datahub, date)
+    timings['first_hub_load'] = time.perf_counter() - start
+    start = time.perf_counter()
+    app.cached_figure(datahub, 'submissions_map', ())
+    timings['first_map'] = time.perf_counter() - start
+    return timings
+
+
+def import_times(stderr):
+    """
+    Sum the import time of each package from the output of python -X importtime
+    :param stderr: Standard error of the worker process
+    :return: Dictionaries of package to import time (seconds) before and after the dashboard could be served
+    """
+    startup, first_view = {}, {}
+    packages = startup
+    for line in stderr.splitlines():
+        if line == ready_marker:
+            packages = first_view
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        package = module.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(self_us) / 1e6      # Time of the module alone, without the modules it imports
+    return startup, first_view
+
+
+def run_worker(datahub):
+    """
+    Profile a new worker, in a process of its own so that nothing is imported already
+    :param datahub: Name of data hub to time the first view of
+    :return: Dictionary of the time taken by each step and the import times of each package
+    """
+    worker_output = os.path.join(root_directory, 'data', 'startup_profile.{}.json'.format(os.getpid()))
+    command = [sys.executable, '-X', 'importtime', os.path.realpath(__file__), '--worker-output', worker_output, '--launched', str(time.time())]
+    if datahub:
+        command += ['--username', datahub]
+    process = subprocess.run(command, cwd=root_directory, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if process.returncode != 0:
+        raise RuntimeError('The worker failed:\n{}'.format('\n'.join(line for line in process.stderr.splitlines() if not line.startswith('import time:'))))
+    with open(worker_output) as f:
+        timings = json.load(f)
+    os.remove(worker_output)
+    startup, first_view = import_times(process.stderr)
+    return {'timings': timings, 'startup_imports': startup, 'first_view_imports': first_view}
+
+
+def interpreter_seconds():
+    """
+    Time starting and stopping Python alone, which every worker pays before importing anything
+    :return: Seconds
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    return time.perf_counter() - start
+
+
+def median_times(dictionaries):
+    """
+    Obtain the median of each time over repeated runs
+    :param dictionaries: List of dictionaries of name to seconds, a name missing from a run counting as 0
+    :return: Dictionary of name to median seconds
+    """
+    names = set(name for dictionary in dictionaries for name in dictionary)
+    return {name: statistics.median(dictionary.get(name, 0) for dictionary in dictionaries) for name in names}
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.worker_output is not None:
+        sys.path.insert(0, root_directory)      # The application is imported from the root directory, as when it is served
+        timings = profile_worker(args.username, args.launched)
+        with open(args.worker_output, 'w') as f:
+            json.dump(timings, f)
+        sys.exit(0)
+
+    import pandas as pd     # Only needed for the report, the workers import what the application imports
+    print('---> Profiling the start of the application...')
+    os.makedirs(os.path.join(root_directory, 'data'), exist_ok=True)
+    interpreter = statistics.median(interpreter_seconds() for _ in range(args.repeats))
+    workers = []
+    for repeat in range(args.repeats):
+        print('> Starting worker {} of {}...'.format(repeat + 1, args.repeats))
+        workers.append(run_worker(args.username))
+    timings = dict(median_times([worker['timings'] for worker in workers]), interpreter=interpreter)
+    startup = median_times([worker['startup_imports'] for worker in workers])
+    first_view = median_times([worker['first_view_imports'] for worker in workers])
+
+    if args.output:
+        # Results of each run are kept, so that they can be compared between commits
+        from benchmark import git_commit
+        runs = []
+        if os.path.exists(args.output):
+            with open(args.output) as f:
+                runs = json.load(f)
+        runs.append({'commit': git_commit(), 'started': datetime.datetime.now().isoformat(timespec='seconds'), 'repeats': args.repeats,
+                     'timings': timings, 'startup_imports': startup, 'first_view_imports': first_view})
+        with open(args.output, 'w') as f:
+            json.dump(runs, f, indent=1)
+
+    steps = ['interpreter', 'import_app', 'import_to_ready', 'launch_to_ready', 'first_hub_load', 'first_map']
+    print(pd.DataFrame([[step, timings[step] * 1000] for step in steps], columns=['step', 'median_ms']).to_string(index=False, float_format='{:,.1f}'.format))
+    packages = pd.DataFrame({'startup_ms': pd.Series(startup, dtype=float), 'first_view_ms': pd.Series(first_view, dtype=float)}).fillna(0) * 1000
+    packages = packages.sort_values('startup_ms', ascending=False).rename_axis('package').reset_index()
+    print('> Import time of each package, before the dashboard can be served and on the first view of a data hub:')
+    print(packages.head(args.top).to_string(index=False, float_format='{:,.1f}'.format))
+    print('> Total import time: {:,.1f} ms at start, {:,.1f} ms on the first view'.format(sum(startup.values()) * 1000, sum(first_view.values()) * 1000))
+    print('---> Profiling the start of the application... [COMPLETED]')
@@ -0,0 +1,289 @@
+#!/usr/bin/env/python3
+# This script handles the export of a data hub snapshot as a static dashboard, which can be served by any static file server
+
+__author__ = 'Nadim Rahman'
+
+from html import escape
+from string import Template
+import argparse, datetime, gzip, json, os, shutil, time, yaml
+
+assets_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'assets')
+config_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'config.yaml')
+bundle_assets = ['style.css', 'dashboard.js', 'favicon.ico']        # Copied from the assets directory into each bundle
+plotly_js_name = 'plotly-{}.min.js'     # plotly.js of each version, shared by the bundles of a data hub rather than copied into each
+
+# Page of the static dashboard, laid out as the application. Figures are fetched from the figures directory, the
+# pie chart is built in the browser from the counts of every variable as in the application (assets/dashboard.js)
+page_template = Template("""<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>Data Hubs Dashboard</title>
+<link rel="icon" href="favicon.ico">
+<link rel="stylesheet" href="style.css">
+<style>
+.row-two { display: flex; }
+.row-two > div { flex: 1; min-width: 0; }
+.export-date { font-size: 14px; }
+</style>
+</head>
+<body>
+<div class="header">
+<h1 class="header-title">Data Hub Dashboard</h1>
+<h3 class="sub-header">$datahub</h3>
+<p class="header-description">This dashboard presents information related to your data hub. <span class="export-date">Snapshot of $date.</span></p>
+</div>
+<div class="banner"><div class="tiles">$stats</div></div>
+<div class="wide-wrapper"><div class="large-card"><div id="submissions_map"></div></div></div>
+<div class="row-two">
+<div class="card"><select id="variable">$variables</select><div id="pie-chart"></div></div>
+</div>
+<div class="granularity">$granularities</div>
+<div class="row-two">
+<div class="card"><div id="stacked_cumulative_submissions"></div></div>
+<div class="card"><div id="stacked_raw_submissions"></div></div>
+</div>
+<div class="footer"><p class="header-description">Powered by</p></div>
+<script>window.dash_clientside = {no_update: null};</script>
+<script src="dashboard.js"></script>
+<script src="../$plotly_js"></script>
+<script>
+var figures = {};
+function load(name) {
+    if (!figures[name]) {
+        figures[name] = fetch('figures/' + name + '.json').then(function(response) { return response.json(); });
+    }
+    return figures[name];
+}
+function plot(id, name) {
+    load(name).then(function(figure) { Plotly.react(id, figure.data, figure.layout, {displayModeBar: id === 'submissions_map'}); });
+}
+function pie() {
+    load('pie_counts').then(function(counts) {
+        var figure = window.dash_clientside.dashboard.pie_chart(counts, document.getElementById('variable').value);
+        Plotly.react('pie-chart', figure.data, figure.layout);
+    });
+}
+function submissions() {
+    var granularity = document.querySelector('input[name=granularity]:checked').value;
+    plot('stacked_cumulative_submissions', 'cumulative_submissions_' + granularity);
+    plot('stacked_raw_submissions', 'submissions_' + granularity);
+}
+document.getElementById('variable').addEventListener('change', pie);
+document.querySelectorAll('input[name=granularity]').forEach(function(input) { input.addEventListener('change', submissions); });
+plot('submissions_map', 'submissions_map');
+pie();
+submissions();
+</script>
+</body>
+</html>
+""")
+
+
+def get_args():
+    """
+    Handle script arguments
+    :return: Script arguments
+    """
+    parser = argparse.ArgumentParser(prog='static_export.py', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="""
+        + =========================================================== +
+        |  ENA Data Hubs Dashboard: static_export.py                  |
+        |  Python script to export a data hub snapshot as a static    |
+        |  dashboard of HTML and compressed figure JSON.              |
+        + =========================================================== +
+        """)
+    parser.add_argument('-u', '--username', help='Data Hub username (e.g. dcc_XXXXX)', type=str, required=True)
+    parser.add_argument('-d', '--date', help='Date of the snapshot to export (DDMMYYYY, default: latest)', type=str)
+    parser.add_argument('-o', '--output', help='Directory to export to, the bundle being saved to <output>/<datahub>/<date> (default: EXPORT_DIR in config.yaml, or export)', type=str)
+    parser.add_argument('-t', '--map-tolerance', help='Simplification tolerance of the map polygons in degrees (default: MAP_TOLERANCE in config.yaml)', type=float)
+    parser.add_argument('-k', '--keep', help='Number of bundles of the data hub to keep, the oldest being removed (default: EXPORT_KEEP in config.yaml, or 30)', type=int)
+    args = parser.parse_args()
+    return args
+
+
+def configured(key, default=None, path=config_file):
+    """
+    Obtain a setting the application is configured with, so that the export matches the application
+    :param key: Name of the setting (e.g. 'MAP_TOLERANCE')
+    :param default: Value if the setting is not configured
+    :param path: Path to the configuration file
+    :return: Value of the setting
+    """
+    with open(path) as f:
+        return yaml.safe_load(f).get(key, default)
+
+
+def render_html(component):
+    """
+    Render a Dash HTML component (e.g. the data hub stats tiles) as HTML
+    :param component: Component, text or list of them
+    :return: HTML text
+    """
+    if component is None:
+        return ''
+    if isinstance(component, (list, tuple)):
+        return ''.join(render_html(child) for child in component)
+    if not hasattr(component, 'to_plotly_json'):
+        return escape(str(component))
+    tag = component._type.lower()
+    attributes = ''.join(' {}="{}"'.format(name, escape(str(getattr(component, prop))))
+                         for prop, name in [('id', 'id'), ('className', 'class')] if getattr(component, prop, None) is not None)
+    return '<{0}{1}>{2}</{0}>'.format(tag, attributes, render_html(getattr(component, 'children', None)))
+
+
+def write_compressed(path, content):
+    """
+    Save a file with a gzip compressed copy, for static file servers that serve precompressed files (e.g. nginx gzip_static)
+    :param path: Path to save the file to, the compressed copy being saved to <path>.gz
+    :param content: Content of the file (text)
+    :return: Size of the file and of the compressed copy, in bytes
+    """
+    content = content.encode('UTF-8')
+    compressed = gzip.compress(content, compresslevel=9, mtime=0)       # Unchanged files give identical compressed copies
+    with open(path, 'wb') as f:
+        f.write(content)
+    with open(path + '.gz', 'wb') as f:
+        f.write(compressed)
+    return len(content), len(compressed)
+
+
+def write_figure(figure, path, decimals=3):
+    """
+    Save a figure as JSON, compacted as by the application, with a gzip compressed copy
+    :param figure: Figure object, or dictionary
+    :param path: Path to save the JSON to
+    :param decimals: Number of decimal places to round floats to
+    :return: Size of the JSON and of the compressed copy, in bytes
+    """
+    import plotly
+    from responses import compact_figure
+    return write_compressed(path, json.dumps(compact_figure(figure, decimals), cls=plotly.utils.PlotlyJSONEncoder, separators=(',', ':')))
+
+
+def export_bundle(datahub, date, output='export', map_tolerance=None, decimals=3, keep=None):
+    """
+    Export a data hub snapshot as a static dashboard: the page with the data hub stats, every figure (the pie chart
+    counts of every variable included) and the styling. plotly.js is saved once per version for the bundles of the data hub.
+    :param datahub: Name of data hub
+    :param date: Date of the snapshot (DDMMYYYY)
+    :param output: Directory to export to
+    :param map_tolerance: Simplification tolerance of the map polygons in degrees, None for full detail
+    :param decimals: Number of decimal places to round figure values to
+    :param keep: Number of bundles of the data hub to keep, the oldest being removed (default: all)
+    :return: Path to the bundle directory and a dictionary of the size of each figure and its compressed copy, in bytes
+    """
+    import plotly.offline
+    from plots import GeneratePlots, pie_variables
+    from time_series import granularities
+
+    bundle = os.path.join(output, datahub, date)
+    plotly_js = plotly_js_name.format(plotly.offline.get_plotlyjs_version())
+    shared_plotly_js = [plotly_js, plotly_js + '.gz']
+    temporary_bundle = '{}.{}.tmp'.format(bundle, os.getpid())       # Written to, then moved into place once complete
+    os.makedirs(os.path.join(temporary_bundle, 'figures'))
+    try:
+        plots = GeneratePlots(datahub, date, map_tolerance)
+        figures = {'submissions_map': plots.submissions_map(), 'pie_counts': plots.pie_counts()}
+        for granularity in granularities:
+            figures['submissions_{}'.format(granularity)] = plots.submissions(granularity)
+            figures['cumulative_submissions_{}'.format(granularity)] = plots.cumulative_submissions(granularity)
+        sizes = {name: write_figure(figure, os.path.join(temporary_bundle, 'figures', name + '.json'), decimals) for name, figure in figures.items()}
+
+        page = page_template.substitute(
+            datahub=escape(plots.datahub_edited), date=escape('{}/{}/{}'.format(date[:2], date[2:4], date[4:])),
+            stats=render_html(plots.return_stats()),
+            variables=''.join('<option value="{}">{}</option>'.format(x, x.replace("_", " ").capitalize()) for x in pie_variables),
+            plotly_js=plotly_js, granularities=''.join('<label><input type="radio" name="granularity" class="granularity-input" value="{0}"{1}>{2}</label>'.format(
+                x, ' checked' if x == 'month' else '', x.capitalize()) for x in granularities))
+        write_compressed(os.path.join(temporary_bundle, 'index.html'), page)
+        if not all(os.path.exists(os.path.join(output, datahub, name)) for name in shared_plotly_js):
+            write_compressed(os.path.join(temporary_bundle, plotly_js), plotly.offline.get_plotlyjs())       # Moved out of the bundle once complete
+        for asset in bundle_assets:
+            shutil.copy(os.path.join(assets_directory, asset), temporary_bundle)
+        with open(os.path.join(temporary_bundle, 'manifest.json'), 'w') as f:
+            json.dump({'datahub': datahub, 'date': date, 'exported': time.strftime('%Y-%m-%dT%H:%M:%S'), 'plotly_js': plotly_js,
+                       'figures': {name: {'bytes': size, 'gzip_bytes': gzip_size} for name, (size, gzip_size) in sizes.items()}}, f, indent=1)
+    except Exception:
+        shutil.rmtree(temporary_bundle)     # Do not leave an incomplete bundle behind
+        raise
+
+    for name in shared_plotly_js:
+        if os.path.exists(os.path.join(temporary_bundle, name)):
+            os.replace(os.path.join(temporary_bundle, name), os.path.join(output, datahub, name))
+    if os.path.exists(bundle):
+        shutil.rmtree(bundle)       # A bundle of the same snapshot exported earlier
+    os.replace(temporary_bundle, bundle)
+    if keep:
+        prune_bundles(output, datahub, keep)
+    latest = latest_export(output, datahub)
+    with open(os.path.join(output, datahub, 'index.html'), 'w') as f:
+        f.write('<!DOCTYPE html><meta http-equiv="refresh" content="0; url={}/">'.format(latest))       # Points to the bundle of the latest snapshot
+    return bundle, sizes
+
+
+def exported_dates(output, datahub):
+    """
+    List the snapshot dates exported for a data hub
+    :param output: Directory exported to
+    :param datahub: Name of data hub
+    :return: List of dates (DDMMYYYY)
+    """
+    dates = []
+    for name in os.listdir(os.path.join(output, datahub)):
+        try:
+            datetime.datetime.strptime(name, '%d%m%Y')
+        except ValueError:
+            continue        # Not a bundle (e.g. the index page, or a bundle being written)
+        dates.append(name)
+    return dates
+
+
+def prune_bundles(output, datahub, keep):
+    """
+    Remove the oldest bundles of a data hub, and the copies of plotly.js no remaining bundle uses
+    :param output: Directory exported to
+    :param datahub: Name of data hub
+    :param keep: Number of the latest bundles to keep
+    :return: List of the dates of the bundles removed (DDMMYYYY)
+    """
+    dates = sorted(exported_dates(output, datahub), key=lambda date: datetime.datetime.strptime(date, '%d%m%Y'))
+    removed = dates[:-keep] if len(dates) > keep else []
+    for date in removed:
+        shutil.rmtree(os.path.join(output, datahub, date))
+
+    used = set()
+    for date in dates[len(removed):]:
+        try:
+            with open(os.path.join(output, datahub, date, 'manifest.json')) as f:
+                used.add(json.load(f).get('plotly_js'))
+        except (OSError, ValueError):
+            continue        # Bundles exported before plotly.js was shared hold a copy of their own
+    for name in os.listdir(os.path.join(output, datahub)):
+        if name.startswith('plotly-') and name.rsplit('.gz', 1)[0] not in used:
+            os.remove(os.path.join(output, datahub, name))
+    return removed
+
+
+def latest_export(output, datahub):
+    """
+    Obtain the date of the latest snapshot exported for a data hub
+    :param output: Directory exported to
+    :param datahub: Name of data hub
+    :return: Date of the snapshot (DDMMYYYY), or None if none have been exported
+    """
+    dates = exported_dates(output, datahub)
+    return max(dates, key=lambda date: datetime.datetime.strptime(date, '%d%m%Y')) if dates else None
+
+
+if __name__ == '__main__':
+    from hub_registry import latest_snapshot
+    args = get_args()
+    date = args.date or latest_snapshot(args.username)
+    tolerance = args.map_tolerance if args.map_tolerance is not None else configured('MAP_TOLERANCE')
+    print('---> Exporting static dashboard...')
+    bundle, sizes = export_bundle(args.username, date, args.output or configured('EXPORT_DIR', 'export'), tolerance, configured('FIGURE_DECIMALS', 3),
+                                  args.keep or configured('EXPORT_KEEP', 30))
+    print('> Exported {} figures to {} ({:,.1f} kB, {:,.1f} kB compressed)'.format(
+        len(sizes), bundle, sum(size for size, gzip_size in sizes.values()) / 1024, sum(gzip_size for size, gzip_size in sizes.values()) / 1024))
+    print('---> Exporting static dashboard... [COMPLETED]')
@@ -0,0 +1,47 @@
+#!/usr/bin/env/python3
+# This script handles the creation of the submission time series plotted in the application
+
+__author__ = 'Nadim Rahman'
+
+import numpy as np
+import pandas as pd
+
+granularities = {'month': 'M', 'week': 'W', 'day': 'D'}      # Granularities the submissions can be plotted at, with their pandas period frequency
+series_columns = ['first_created', 'submissions', 'cumulative_submissions', 'result_type']
+
+
+def daily_counts(cube):
+    """
+    Select the submissions per day from the aggregate table
+    :param cube: Data frame of the aggregate table
+    :return: Data frame of result type, date and count
+    """
+    rows = cube[cube['dimension'] == 'day']
+    return pd.DataFrame({'result_type': rows['result_type'].astype(str).to_numpy(),
+                         'date': pd.to_datetime(rows['value']).to_numpy(), 'count': rows['count'].to_numpy()})
+
+
+def submission_series(counts, granularity='month'):
+    """
+    Create the time series of submissions and cumulative submissions of each result type, over a shared continuous
+    range of periods starting the period before the earliest submission. Periods without submissions are counted as 0.
+    :param counts: Data frame of result type, date and count (e.g. per day)
+    :param granularity: Period of the time series ('month', 'week' or 'day')
+    :return: Data frame of period start date (first_created), submissions, cumulative submissions and result type
+    """
+    if counts.empty:
+        return pd.DataFrame(columns=series_columns)
+    frequency = granularities[granularity]
+    periods = pd.DatetimeIndex(counts['date']).to_period(frequency)
+    result_types = list(dict.fromkeys(counts['result_type']))      # Keep the order the result types are given in
+
+    # One row per period and one column per result type, reindexed so that every period is present
+    table = pd.pivot_table(counts.assign(period=periods), index='period', columns='result_type', values='count', aggfunc='sum', fill_value=0)
+    table = table.reindex(index=pd.period_range(table.index.min() - 1, table.index.max(), freq=frequency), columns=result_types, fill_value=0)
+
+    return pd.DataFrame({
+        'first_created': np.tile(table.index.start_time, len(result_types)),
+        'submissions': table.to_numpy().T.ravel(),
+        'cumulative_submissions': table.cumsum().to_numpy().T.ravel(),
+        'result_type': np.repeat(result_types, len(table))
+    })
@@ -4,14 +4,22 @@
 __author__ = 'Nadim Rahman'
 
 import pandas as pd
-import argparse, datetime, requests
-from data_import import retrieve_data
+import argparse, datetime, os, requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from data_import import retrieve_data, PORTAL_API_URL
+from portal_client import PortalClient
+from instrumentation import spans
+from data_import import peak_memory_mb
+from result_types import result_types
+from snapshot_store import SnapshotStore
+from aggregates import empty_summary, summarise_chunk, merge_summaries, distinct_counts, to_cube, select
+from time_series import daily_counts, submission_series
+from geography import CountryCodes
+from static_export import export_bundle, configured
+from parallel_aggregates import process_pool, summarise_snapshot
 
 months = {1: 'January', 2: 'February', 3: 'March', 4: 'April', 5: 'May', 6: 'June', 7: 'July', 8: 'August', 9: 'September', 10: 'October', 11: 'November', 12: 'December'}
-ena_searches = {
-    'read_run': {'search_fields': ['experiment_accession', 'study_accession', 'study_title', 'sample_accession', 'experiment_title', 'country', 'collection_date', 'center_name', 'broker_name', 'tax_id', 'scientific_name', 'instrument_platform', 'instrument_model', 'library_layout', 'library_name', 'library_selection', 'library_source', 'library_strategy', 'first_public', 'first_created'], 'result_type': 'read_run', 'data_portal': 'pathogen', 'authentication': 'True'},
-    'analysis': {'search_fields': ['analysis_accession', 'analysis_title', 'analysis_type', 'study_accession', 'study_title', 'sample_accession', 'center_name', 'first_public', 'first_created', 'tax_id', 'scientific_name', 'pipeline_name', 'pipeline_version', 'country', 'collection_date'], 'result_type': 'analysis', 'data_portal': 'pathogen', 'authentication': 'True'}
-}
 
 def get_args():
     """
@@ -26,8 +34,25 @@ def get_args():
         + =========================================================== +
         """)
     parser.add_argument('-u', '--username', help='Data Hub username (e.g. dcc_XXXXX)', type=str, required=True)
-    parser.add_argument('-p', '--password', help='Password for the data hub', type=str, required=True)
+    parser.add_argument('-p', '--password', help='Password for the data hub (default: the DATAHUB_PASSWORD environment variable)', type=str, default=os.environ.get('DATAHUB_PASSWORD'))
+    parser.add_argument('-s', '--stream', help='Stream the search results to file in chunks, rather than buffering the whole response', action='store_true')
+    parser.add_argument('-c', '--chunk-rows', help='Maximum number of rows held in memory at once when streaming or summarising across processes (default: 100000)', type=int, default=100000)
+    parser.add_argument('--parallel', help='Fetch the search results as pages of --page-size rows, concurrently', action='store_true')
+    parser.add_argument('--page-size', help='Number of rows per page when fetching in parallel (default: 50000)', type=int, default=50000)
+    parser.add_argument('--workers', help='Number of pages fetched at once when fetching in parallel (default: 4)', type=int, default=4)
+    parser.add_argument('-i', '--incremental', help='Only fetch records created since the latest saved search results, and merge them in', action='store_true')
+    parser.add_argument('--overlap-days', help='Number of days before the latest saved record to fetch again when running incrementally (default: 3)', type=int, default=3)
+    parser.add_argument('--aggregate-workers', help='Summarise the saved search results in chunks of --chunk-rows rows across this many processes, rather than in this process', type=int)
+    parser.add_argument('--type-workers', help='Number of result types fetched and summarised at once (default: all)', type=int)
+    parser.add_argument('--timeout', help='Longest wait for data from the Portal API before retrying, in seconds (default: 300)', type=float, default=300)
+    parser.add_argument('--max-rate', help='Most requests per second sent to the Portal API (default: no limit)', type=float)
+    parser.add_argument('--retries', help='Number of times a failed request is retried, with exponential backoff (default: 5)', type=int, default=5)
+    parser.add_argument('-e', '--export-dir', help='Directory to export the static dashboard of the snapshot to (default: EXPORT_DIR in config.yaml, or export)', type=str)
+    parser.add_argument('--no-export', help='Do not export the static dashboard of the snapshot', action='store_true')
+    parser.add_argument('--portal-url', help='Base URL of the Portal API (default: {})'.format(PORTAL_API_URL), type=str, default=PORTAL_API_URL)
     args = parser.parse_args()
+    if args.password is None:
+        parser.error('the password for the data hub is required, with -p/--password or the DATAHUB_PASSWORD environment variable')
     return args
 
 class prepDf:
@@ -37,85 +62,171 @@ class prepDf:
     def __init__(self, date_today, args):
         self.date_today = date_today
         self.args = args
-
-    def add_datahub_stats(self, stats, result_type):
+        self.store = SnapshotStore(args.username)
+        self.rows = {}      # Result type -> number of records summarised
+        self.aggregation = {}       # Result type -> chunks, workers and peak worker memory, when summarised across processes
+        self.pool = None        # Processes summarising the saved search results, shared by the result types
+        self.client = PortalClient(pool_size=args.workers * len(result_types), retries=args.retries, read_timeout=args.timeout,
+                                   max_rate=args.max_rate)     # Shared by the result types fetched concurrently
+
+    def summarise(self, chunks, result_type):
         """
-        Create a dataframe of data hub stats for the application
-        :return:
+        Summarise the data for the data hub stats, submission counts and aggregate table in a single pass, one chunk at a time
+        :param chunks: Iterable of data frames making up the data for the result type
+        :param result_type: Result type of the data
+        :return: Number of rows, a dictionary of the number of distinct values per stats column and a dictionary of counts per dimension
+        """
+        summary = empty_summary(result_type)
+        for chunk in chunks:
+            with spans.span('aggregate', datahub=self.args.username, result_type=result_type):
+                summary = merge_summaries(summary, summarise_chunk(chunk, result_type))      # Only distinct values and counts are kept, not the chunk itself
+        self.rows[result_type] = summary[0]
+        return distinct_counts(summary)
+
+    def add_datahub_stats(self, stats, result_type, summary):
         """
-        if result_type == 'read_run':
-            stats['Total raw sequence datasets'] = len(self.data)
-            stats['Total sequencing platforms'] = self.data['instrument_platform'].nunique()
-            stats['Total sequencing platform models'] = self.data['instrument_model'].nunique()
-            stats['Data Providers (Collaborators)'] = self.data['center_name'].nunique()
-        elif result_type == 'analysis':
-            stats['Total analyses'] = len(self.data)
-            stats['Analysis pipelines'] = self.data['pipeline_name'].nunique()
+        Add the data hub stats of a result type, as defined in the result type registry
+        :param stats: Dictionary of data hub stats to add to
+        :param result_type: Result type of the data
+        :param summary: Summary of the data, from summarise()
+        :return: Dictionary of data hub stats
+        """
+        rows, nunique, counts = summary
+        for label, column in result_types[result_type]['stats'].items():
+            stats[label] = rows if column == 'rows' else nunique[column]
         return stats
 
-    def create_earliest_row(self, df, cols, result_type):
-        # Identify earliest date and set to 0
-        earliest = df['first_created'].iloc[0] + '-01'
-        earliest = datetime.datetime.strptime(earliest, '%Y-%m-%d')
-        lastMonth = earliest - datetime.timedelta(days=1)
-        lastMonth = str(lastMonth.date())[:-3]
-
-        # Create a new row of data and add to the first row of the data frame
-        row = pd.DataFrame([[lastMonth, 0, 0, result_type]], columns=cols)
-        updated_df = pd.concat([row, df]).reset_index(drop=True)
-        return updated_df
-
-    def submission_count(self, result_types):
+    def refresh(self, result_type):
         """
-        Create a cumulative submissions dataframe
-        :return:
+        Fetch and summarise the data of a result type
+        :param result_type: Result type to fetch
+        :return: Summary of the data, from summarise()
+        """
+        data_retrieval = retrieve_data(result_types[result_type], self.args.username,
+                                       self.args.password, self.args.portal_url, self.client)  # Instantiate class with information
+        if self.args.incremental:
+            chunks = [data_retrieval.delta_retrieval(self.args.overlap_days)]
+        elif self.args.parallel:
+            chunks = [data_retrieval.paginated_retrieval(self.args.page_size, self.args.workers)]
+        elif self.args.stream:
+            chunks = data_retrieval.stream_retrieval(self.args.chunk_rows)        # Data is never held in memory in full
+        else:
+            chunks = [data_retrieval.coordinate_retrieval()]
+        if not self.args.aggregate_workers:
+            return self.summarise(chunks, result_type)
+
+        deque(chunks, maxlen=0)     # Saves the search results as today's snapshot, which is then summarised from file
+        del chunks, data_retrieval      # So that the search results are not held in memory while they are summarised
+        with spans.span('aggregate', datahub=self.args.username, result_type=result_type):
+            summary, self.aggregation[result_type] = summarise_snapshot(self.store, self.date_today, result_type, self.args.aggregate_workers,
+                                                                        self.args.chunk_rows, self.pool)
+        self.rows[result_type] = summary[0]
+        return summary
+
+    def submission_count(self, cube):
+        """
+        Create a cumulative submissions dataframe, with a row for every month of each result type
+        :param cube: Data frame of the aggregate table, holding the submissions per day
+        :return: Data frame of month, submissions and cumulative submissions per result type
         """
-        cols = ['first_created', 'submissions', 'cumulative_submissions', 'result_type']
-        total_counts = pd.DataFrame(columns=cols)
-        for result_type in result_types:
-            df = pd.read_csv('data/{}_ENA_Search_{}_{}.txt'.format(self.args.username, result_type, self.date_today), sep="\t")
-            first_created = df[['first_created']]           # Grab the first_created column
-            first_created['first_created'] = first_created['first_created'].str[:-3]            # Remove the day from the first_created column values
+        with spans.span('aggregate', datahub=self.args.username, snapshot='cumulative_submissions'):
+            total_counts = submission_series(daily_counts(cube), 'month')
+        self.write(total_counts, 'cumulative_submissions')
+        return total_counts
 
-            counts = first_created['first_created'].value_counts(sort=True).rename_axis('first_created').reset_index(name='submissions'.format(result_type))           # Create a count for each month's submissions
-            counts = counts.sort_values(by='first_created')             # Sort by the first_created column to calculate cumulative sum appropriately
-            counts['cumulative_submissions'.format(result_type)] = counts['submissions'.format(result_type)].cumsum()
+    def write(self, df, name):
+        """
+        Save a data frame as a snapshot of today
+        :param df: Data frame to save
+        :param name: Name of the snapshot
+        :return: Path to the snapshot file
+        """
+        with spans.span('write', datahub=self.args.username, snapshot=name):
+            return self.store.write(df, name, self.date_today)
 
-            counts = self.create_earliest_row(counts, cols, result_type)            # Insert a row for the month of 0 submissions
-            counts['result_type'] = result_type
+    def mode(self):
+        """
+        Obtain the download mode of the run
+        :return: Name of the mode
+        """
+        for mode in ['incremental', 'parallel', 'stream']:
+            if getattr(self.args, mode):
+                return mode
+        return 'default'
 
-            total_counts = pd.concat([total_counts, counts], ignore_index=True)
-        total_counts.to_csv('data/{}_cumulative_submissions_{}.txt'.format(self.args.username, self.date_today), sep="\t", index=False)
-        return total_counts
+    def report(self, status, error=None):
+        """
+        Save a JSON report of the run, with the time taken by each stage
+        :param status: Status of the run ('completed' or 'failed')
+        :param error: Error the run failed with
+        :return: Path to the report
+        """
+        path = self.store.path('run_report', self.date_today, 'json')
+        spans.write_report(path, datahub=self.args.username, date=self.date_today, status=status, error=error, mode=self.mode(),
+                           rows=self.rows, aggregation=self.aggregation, peak_rss_mb=round(peak_memory_mb(), 1), portal=self.client.totals(), requests=self.client.metrics())
+        slowest = ', '.join('{} {}s'.format(' '.join(str(value) for key, value in total.items() if key not in ['datahub', 'count', 'seconds']), total['seconds'])
+                            for total in spans.totals()[:3])
+        print('> Run report saved to {} (slowest stages: {})'.format(path, slowest))
+        return path
 
     def create_dfs(self):
         """
         Create all dataframes required for the application plots
         :return:
         """
-        # Get ENA read data within the datahub
+        # Get ENA data within the datahub, fetching and summarising the result types concurrently
+        if self.args.aggregate_workers and self.args.aggregate_workers > 1:
+            self.pool = process_pool(self.args.aggregate_workers)
+        try:
+            with ThreadPoolExecutor(max_workers=self.args.type_workers or len(result_types)) as executor:
+                summaries = dict(zip(result_types, executor.map(self.refresh, result_types)))
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+        print('> Portal API: {}'.format(self.client.summary()))
+
+        # Obtain statistics for data hub, the data itself is no longer needed
         datahub_statistics = {}
-        for key, value in ena_searches.items():
-            data_retrieval = retrieve_data(ena_searches[key], self.args.username,
-                                       self.args.password)  # Instantiate class with information
-            self.data = data_retrieval.coordinate_retrieval()
-
-            # Obtain statistics for data hub
-            datahub_statistics = prepDf.add_datahub_stats(self, datahub_statistics, key)
+        cube = []
+        for key, summary in summaries.items():
+            datahub_statistics = prepDf.add_datahub_stats(self, datahub_statistics, key, summary)
+            cube.append(to_cube(summary[2], key))
 
         # Convert the dictionary and save as a dataframe
         print('> Creating finalised data hub statistics data frame...')
         datahub_items = list(datahub_statistics.items())
-        datahub_stats = pd.DataFrame(datahub_items, columns=['field', 'value'], index=[0, 1, 2, 3, 4, 5])
-        datahub_stats.to_csv('data/{}_Datahub_stats_{}.txt'.format(self.args.username, self.date_today), sep="\t",
-                             index=False)
+        datahub_stats = pd.DataFrame(datahub_items, columns=['field', 'value'])
+        self.write(datahub_stats, 'Datahub_stats')
         print('> Creating finalised data hub statistics data frame... [DONE]')
 
         # Create a cumulative submissions dataframe
         print('> Creating counts data frame...')
-        counts = prepDf.submission_count(self, ena_searches.keys())
+        cube = pd.concat(cube, ignore_index=True)
+        counts = prepDf.submission_count(self, cube)
         print('> Creating counts data frame... [DONE]')
 
+        # Save the counts per dimension, which the plots are built from
+        print('> Creating aggregate table...')
+        self.write(cube, 'aggregates')
+        print('> Creating aggregate table... [DONE]')
+
+        # Resolve the country names for the map, as the application will, to report those left off it
+        print('> Resolving countries...')
+        with spans.span('resolve', datahub=self.args.username):
+            countries, unresolved = CountryCodes().resolve(select(cube, 'country'))
+        if len(unresolved) > 0:
+            report = self.write(unresolved, 'unresolved_countries')
+            print('> {} country names could not be resolved and will be left off the map, see {} (add them to custom_codes in scripts/geography.py)'.format(len(unresolved), report))
+        print('> Resolving countries... [DONE]')
+
+        # Export the snapshot as a static dashboard, for read-only viewing from a static file server
+        if not self.args.no_export:
+            print('> Exporting static dashboard...')
+            with spans.span('export', datahub=self.args.username):
+                bundle, sizes = export_bundle(self.args.username, self.date_today, self.args.export_dir or configured('EXPORT_DIR', 'export'),
+                                             configured('MAP_TOLERANCE'), configured('FIGURE_DECIMALS', 3), configured('EXPORT_KEEP', 30))
+            print('> Exporting static dashboard to {}... [DONE]'.format(bundle))
+
 
 
 if __name__ == '__main__':
@@ -125,5 +236,10 @@ if __name__ == '__main__':
 
     args = get_args()       # Obtain script arguments
     prepare_dfs = prepDf(date, args)        # Instantiate preparation of dataframe
-    prepare_dfs.create_dfs()
+    try:
+        prepare_dfs.create_dfs()
+    except Exception as e:
+        prepare_dfs.report('failed', '{}: {}'.format(type(e).__name__, e))     # Shows which stage the run failed after
+        raise
+    prepare_dfs.report('completed')
     print('---> Downloading data and creating dataframes... [COMPLETED]')
@@ -0,0 +1,41 @@
+import io
+import pandas as pd
+from data_import import merge_delta
+from snapshot_store import SnapshotStore, csv_types
+
+
+def parse(text):
+    """
+    Parse search results as retrieve_data does
+    """
+    return pd.read_csv(io.StringIO(text), sep="\t", dtype=csv_types)
+
+
+def test_merge_delta_into_typed_snapshot(tmp_path):
+    store = SnapshotStore('dcc_test', directory=str(tmp_path))
+    store.write(parse('run_accession\tcountry\tfirst_created\tcollection_date\tread_count\n'
+                      'ERR1\tGermany\t2021-01-01\t2020\t10\n'
+                      'ERR2\tKenya\t2021-01-02\t2021\t20\n'), 'ENA_Search_read_run', '01012021')
+    previous = store.read('ENA_Search_read_run', '01012021')
+    assert previous['collection_date'].dtype == 'int64'       # Typed by its values when first parsed
+
+    delta = parse('run_accession\tcountry\tfirst_created\tcollection_date\tread_count\n'
+                  'ERR2\tKenya\t2021-01-02\tmissing\t25\n'
+                  'ERR3\tUSA\t2021-01-03\t\t30\n')
+    merged = merge_delta(previous, delta)
+    store.write(merged, 'ENA_Search_read_run', '02012021')        # Failed when the years were merged with text
+    saved = store.read('ENA_Search_read_run', '02012021').set_index('run_accession')
+
+    assert list(saved.index) == ['ERR1', 'ERR2', 'ERR3']
+    assert saved['collection_date'].tolist()[:2] == ['2020', 'missing']
+    assert pd.isna(saved.loc['ERR3', 'collection_date'])
+    assert saved['read_count'].tolist() == [10, 25, 30]
+    assert saved['country'].astype(str).tolist() == ['Germany', 'Kenya', 'USA']
+    assert saved['first_created'].tolist() == list(pd.to_datetime(['2021-01-01', '2021-01-02', '2021-01-03']))
+
+
+def test_merge_delta_of_whole_numbers_with_missing_values():
+    previous = pd.DataFrame({'run_accession': ['ERR1', 'ERR2'], 'collection_date': ['2020', 'missing']})
+    delta = parse('run_accession\tcollection_date\nERR3\t2022\nERR4\t\n')
+    merged = merge_delta(previous, delta)
+    assert merged['collection_date'].tolist()[:3] == ['2020', 'missing', '2022']       # Not '2022.0'
@@ -0,0 +1,9 @@
+from figure_cache import FigureCache
+
+
+def test_figure_of_an_older_snapshot_is_not_cached_again():
+    cache = FigureCache()
+    cache.get('dcc_test', '02012021', 'map', lambda: 'new')
+    assert cache.get('dcc_test', '01012021', 'map', lambda: 'old') == 'old'
+    assert cache.get('dcc_test', '01012021', 'map', lambda: 'rebuilt') == 'rebuilt'
+    assert cache.stats()['size'] == 1
@@ -0,0 +1,59 @@
+import threading
+from hub_registry import HubRegistry
+
+
+class Snapshot:
+    """
+    Stand-in for the plots object of a data hub snapshot
+    """
+    def __init__(self, datahub, date):
+        self.datahub = datahub
+        self.date = date
+
+    def memory_usage(self):
+        return 0
+
+
+def test_request_for_a_dropped_snapshot_is_served_from_the_presented_one():
+    loads = []
+    registry = HubRegistry(lambda datahub, date: loads.append(date) or Snapshot(datahub, date))
+    registry.get('dcc_test', '01012021')
+    registry.get('dcc_test', '02012021')        # Loaded by the watcher before switching
+    registry.drop('dcc_test', keep='02012021')
+
+    assert registry.get('dcc_test', '01012021').date == '02012021'      # Date read before the switch
+    assert loads == ['01012021', '02012021']
+    assert [hub['date'] for hub in registry.stats()] == ['02012021']
+
+
+def test_snapshot_switched_from_while_loading_is_not_kept():
+    started, release = threading.Event(), threading.Event()
+
+    def load(datahub, date):
+        started.set()
+        release.wait()
+        return Snapshot(datahub, date)
+    registry = HubRegistry(load)
+    result = []
+    request = threading.Thread(target=lambda: result.append(registry.get('dcc_test', '01012021')))
+    request.start()
+    started.wait()
+    registry.drop('dcc_test', keep='02012021')
+    release.set()
+    request.join()
+
+    assert result[0].date == '01012021'     # Served to the request that read the date before the switch
+    assert registry.stats() == []
+
+
+def test_idle_snapshot_is_released_without_another_loading():
+    registry = HubRegistry(lambda datahub, date: Snapshot(datahub, date), idle_seconds=60)
+    registry.get('dcc_test', '01012021')
+    registry.get('dcc_other', '01012021')
+    registry.hubs['dcc_test', '01012021']['last_used'] -= 120
+    registry.get('dcc_other', '01012021')       # Already loaded, so nothing else loads
+    assert [hub['datahub'] for hub in registry.stats()] == ['dcc_other']
+
+    registry.hubs['dcc_other', '01012021']['last_used'] -= 120
+    registry.sweep()        # Without any request, as by the snapshot watcher
+    assert registry.stats() == []
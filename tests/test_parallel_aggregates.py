@@ -0,0 +1,37 @@
+import argparse
+import pytest
+from aggregates import to_cube
+from benchmark import synthetic_records
+from parallel_aggregates import summarise_snapshot
+from result_types import result_types
+from snapshot_store import SnapshotStore
+from visualisation_prep import prepDf
+
+date = '01012021'
+chunk_rows = 1500       # Several row groups and chunks, with a partial last one
+
+
+@pytest.fixture(scope='module')
+def store(tmp_path_factory):
+    """
+    Save synthetic snapshots of each result type, read_run as Parquet in several row groups and analysis as tab-separated
+    """
+    store = SnapshotStore('dcc_synthetic', directory=str(tmp_path_factory.mktemp('data')))
+    with store.writer('ENA_Search_read_run', date) as writer:
+        for start in range(0, 5000, chunk_rows):
+            writer.write(synthetic_records('read_run', start, min(chunk_rows, 5000 - start)))       # A row group per chunk
+    synthetic_records('analysis', 0, 4000).to_csv(store.path('ENA_Search_analysis', date, 'txt'), sep='\t', index=False)
+    return store
+
+
+@pytest.mark.parametrize('result_type', list(result_types))
+@pytest.mark.parametrize('workers', [1, 2])
+def test_summary_matches_in_memory_summary(store, result_type, workers):
+    prep = prepDf(date, argparse.Namespace(username=store.datahub, workers=1, retries=0, timeout=1, max_rate=None))
+    expected = prep.summarise([store.read('ENA_Search_{}'.format(result_type), date)], result_type)
+
+    summary, details = summarise_snapshot(store, date, result_type, workers, chunk_rows=1000)
+    assert details['chunks'] > 1
+    assert summary[0] == expected[0]
+    assert summary[1] == expected[1]
+    assert to_cube(summary[2], result_type).equals(to_cube(expected[2], result_type))
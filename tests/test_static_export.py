@@ -0,0 +1,27 @@
+import json, os
+from static_export import prune_bundles
+
+
+def make_bundle(output, date, plotly_js=None):
+    """
+    Create an exported bundle of dcc_test, as saved by export_bundle()
+    """
+    os.makedirs(os.path.join(output, 'dcc_test', date))
+    manifest = {'datahub': 'dcc_test', 'date': date}
+    if plotly_js is not None:
+        manifest['plotly_js'] = plotly_js
+    with open(os.path.join(output, 'dcc_test', date, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+
+def test_prune_bundles_keeps_the_latest_and_the_plotly_js_they_use(tmp_path):
+    output = str(tmp_path)
+    make_bundle(output, '30122020')      # Exported before plotly.js was shared
+    make_bundle(output, '31122020', 'plotly-1.0.0.min.js')
+    make_bundle(output, '01012021', 'plotly-2.0.0.min.js')
+    make_bundle(output, '02012021', 'plotly-2.0.0.min.js')
+    for name in ['plotly-1.0.0.min.js', 'plotly-1.0.0.min.js.gz', 'plotly-2.0.0.min.js', 'plotly-2.0.0.min.js.gz', 'index.html']:
+        open(os.path.join(output, 'dcc_test', name), 'w').close()
+
+    assert prune_bundles(output, 'dcc_test', 2) == ['30122020', '31122020']
+    assert sorted(os.listdir(os.path.join(output, 'dcc_test'))) == ['01012021', '02012021', 'index.html', 'plotly-2.0.0.min.js', 'plotly-2.0.0.min.js.gz']